@@ -0,0 +1,134 @@
+import argparse
+from libcloud.compute.types import Provider
+from libcloud.compute.providers import get_driver
+
+from vectorize_cli.autoscaler import Autoscaler, NodePool, Policy
+
+# The autoscaler against a simulated queue, on libcloud's dummy driver,
+# so scaling decisions can be tried out offline and in no time:
+#
+#   python -m benchmarks.autoscale
+#   python -m benchmarks.autoscale --tasks 40 --target-seconds 1800 --max-nodes 16
+#
+# Workers on the launched nodes start after --boot-seconds, and go
+# through one task at a time at --rate records per second, reporting
+# progress the way vectorize-server does. Tasks of nodes that are
+# destroyed while busy go back into the queue, as the task monitor
+# would do.
+
+class SimulatedQueue:
+    # what the autoscaler reads from and writes to etcd, kept in memory
+    def __init__(self, tasks, records, rate, tokens_per_record, boot_seconds):
+        self.states = {f'task-{i}': {'status': 'pending', 'init': {'input_file': f'in-{i}.jsonl', 'output_file': f'out-{i}.vec'},
+                                     'progress': {'count': 0, 'total': records}} for i in range(tasks)}
+        self.queued = set(self.states)
+        self.claims = {}
+        self.node_records = {}
+        self.drained = set()
+        # drained nodes whose worker stopped
+        self.stopped = set()
+        self.rate = rate
+        self.tokens_per_record = tokens_per_record
+        self.boot_seconds = boot_seconds
+
+    def snapshot(self):
+        return (self.states, set(self.queued), dict(self.claims))
+
+    def nodes(self):
+        return dict(self.node_records)
+
+    def put_node(self, name, record):
+        self.node_records[name] = record
+
+    def delete_node(self, name):
+        self.node_records.pop(name, None)
+        self.drained.discard(name)
+        self.stopped.discard(name)
+
+    def drain(self, name):
+        self.drained.add(name)
+
+    def undrain(self, name):
+        if name in self.stopped:
+            return False
+        self.drained.discard(name)
+        return True
+
+    def done(self):
+        return all(state['status'] == 'complete' for state in self.states.values())
+
+    def advance(self, now, seconds):
+        workers = {identity: task_id for (task_id, identity) in self.claims.items()}
+        for (task_id, identity) in list(self.claims.items()):
+            if identity not in self.node_records:
+                del self.claims[task_id]
+                self.states[task_id]['status'] = 'resuming'
+                self.queued.add(task_id)
+        for (name, record) in self.node_records.items():
+            if now - record['launched'] < self.boot_seconds:
+                continue
+            task_id = workers.get(name)
+            if task_id is None:
+                if name in self.drained:
+                    self.stopped.add(name)
+                    continue
+                if not self.queued:
+                    continue
+                task_id = min(self.queued)
+                self.queued.remove(task_id)
+                self.claims[task_id] = name
+                self.states[task_id]['status'] = 'running'
+            progress = self.states[task_id]['progress']
+            progress['count'] = min(progress['total'], progress['count'] + self.rate * seconds)
+            progress['avg_rate'] = self.rate
+            progress['avg_token_rate'] = self.rate * self.tokens_per_record
+            if progress['count'] == progress['total']:
+                self.states[task_id]['status'] = 'complete'
+                del self.claims[task_id]
+
+def main():
+    parser = argparse.ArgumentParser(description='run the autoscaler against a simulated queue')
+    parser.add_argument('--tasks', type=int, default=20)
+    parser.add_argument('--records', type=int, default=200000, help='records per task')
+    parser.add_argument('--rate', type=float, default=100, help='records per second of a worker')
+    parser.add_argument('--tokens-per-record', type=float, default=200)
+    parser.add_argument('--target-seconds', type=float, default=7200)
+    parser.add_argument('--min-nodes', type=int, default=0)
+    parser.add_argument('--max-nodes', type=int, default=8)
+    parser.add_argument('--boot-seconds', type=float, default=300)
+    parser.add_argument('--cooldown', type=float, default=300)
+    parser.add_argument('--interval', type=float, default=60)
+    parser.add_argument('--max-seconds', type=float, default=7 * 24 * 3600, help='give up after this much simulated time')
+    args = parser.parse_args()
+
+    queue = SimulatedQueue(args.tasks, args.records, args.rate, args.tokens_per_record, args.boot_seconds)
+    driver = get_driver(Provider.DUMMY)(0)
+    size = driver.list_sizes()[0]
+    pool = NodePool(driver, size, driver.list_images()[0], queue)
+    # the rolling target becomes a deadline, to see whether it is met
+    policy = Policy(min_nodes=args.min_nodes, max_nodes=args.max_nodes, deadline=args.target_seconds,
+                    boot_seconds=args.boot_seconds, cooldown=args.cooldown, worker_rate=args.rate)
+    autoscaler = Autoscaler(queue, pool, policy)
+
+    now = 0
+    node_seconds = 0
+    finished = None
+    while now < args.max_seconds:
+        (workload, desired) = autoscaler.step(now)
+        if finished is None and queue.done():
+            finished = now
+        if finished is not None and len(pool.nodes) == args.min_nodes:
+            break
+        print(f'{now:7.0f}s: {workload}, {len(pool.nodes)} nodes ({len(queue.claims)} busy), aiming for {desired}')
+        queue.advance(now, args.interval)
+        node_seconds += len(pool.nodes) * args.interval
+        now += args.interval
+
+    if finished is None:
+        print(f'not done after {args.max_seconds:.0f}s')
+    else:
+        print(f'done after {finished:.0f}s, target was {args.target_seconds:.0f}s ({"met" if finished <= args.target_seconds else "missed"})')
+    print(f'{node_seconds / 3600:.1f} node hours, {node_seconds / 3600 * size.price:.2f} at {size.price} per hour')
+
+if __name__ == '__main__':
+    main()
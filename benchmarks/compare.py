@@ -0,0 +1,50 @@
+import sys
+import json
+import argparse
+
+# Compares two result files of benchmarks.run, for instance from
+# before and after a change. Exits with status 1 when throughput of any
+# configuration dropped by more than the threshold.
+KEYS = ['mode', 'distribution', 'chunk_size', 'sort_window', 'token_budget', 'duplicates', 'processes']
+
+def key(result):
+    return tuple(result.get(k) for k in KEYS)
+
+def describe(result):
+    return ' '.join(f'{k}={result[k]}' for k in KEYS if result.get(k) is not None)
+
+def main():
+    parser = argparse.ArgumentParser(description='compare two benchmark result files')
+    parser.add_argument('before', type=str)
+    parser.add_argument('after', type=str)
+    parser.add_argument('--threshold', type=float, default=0.05, help='the relative drop in records/s that counts as a regression')
+    args = parser.parse_args()
+
+    with open(args.before) as fp:
+        before = json.load(fp)
+    with open(args.after) as fp:
+        after = json.load(fp)
+    print(f'before: {before.get("commit")}, after: {after.get("commit")}')
+    if before.get('settings') != after.get('settings'):
+        print('warning: the runs used different settings', file=sys.stderr)
+
+    baseline = {key(result): result for result in before['results']}
+    regressions = 0
+    for result in after['results']:
+        old = baseline.get(key(result))
+        if old is None:
+            print(f'{describe(result)}: not in {args.before}')
+            continue
+        ratio = result['records_per_sec'] / old['records_per_sec']
+        regressed = ratio < 1 - args.threshold
+        regressions += regressed
+        print(f'{describe(result)}: {old["records_per_sec"]:.1f} -> {result["records_per_sec"]:.1f} records/s ({ratio:.2f}x), '
+              f'padding {old["padding_ratio"]:.2f} -> {result["padding_ratio"]:.2f}, '
+              f'peak rss {old["peak_rss_mb"]:.0f} -> {result["peak_rss_mb"]:.0f}MB'
+              + (' REGRESSION' if regressed else ''))
+    if regressions != 0:
+        print(f'{regressions} regressions', file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import json
+import numpy
+
+# Synthetic corpora, so benchmarks don't depend on data we can't ship.
+# Records are made of words from a fixed vocabulary that the tiny
+# benchmark tokenizer knows one token per word of, so record lengths
+# in tokens follow the chosen distribution exactly.
+VOCABULARY = [f'w{i}' for i in range(1000)]
+DISTRIBUTIONS = ['fixed', 'uniform', 'lognormal', 'bimodal']
+MAX_LENGTH = 2000
+
+def record_lengths(distribution, count, mean=64, seed=0):
+    rng = numpy.random.default_rng(seed)
+    match distribution:
+        case 'fixed':
+            lengths = numpy.full(count, mean)
+        case 'uniform':
+            lengths = rng.integers(1, 2 * mean, count)
+        case 'lognormal':
+            # a long tail, like most real text
+            sigma = 1.0
+            lengths = rng.lognormal(numpy.log(mean) - sigma ** 2 / 2, sigma, count)
+        case 'bimodal':
+            # mostly short records with some long ones mixed in
+            long = rng.random(count) < 0.1
+            lengths = numpy.where(long, rng.normal(mean * 5.5, mean, count), rng.normal(mean / 2, mean / 8, count))
+        case _:
+            raise ValueError(f'unknown distribution {distribution}')
+    return numpy.clip(numpy.rint(lengths), 1, MAX_LENGTH).astype(int)
+
+def make_corpus(distribution, count, mean=64, seed=0):
+    rng = numpy.random.default_rng(seed + 1)
+    words = rng.integers(0, len(VOCABULARY), record_lengths(distribution, count, mean, seed).sum())
+    strings = []
+    offset = 0
+    for length in record_lengths(distribution, count, mean, seed):
+        strings.append(' '.join(VOCABULARY[w] for w in words[offset:offset+length]))
+        offset += length
+    return strings
+
+def with_duplicates(strings, ratio, seed=0):
+    # the corpus with about ratio of its records replaced by repeats
+    # of earlier ones, like crawled text tends to have
+    rng = numpy.random.default_rng(seed + 2)
+    strings = list(strings)
+    for i in range(1, len(strings)):
+        if rng.random() < ratio:
+            strings[i] = strings[rng.integers(0, i)]
+    return strings
+
+def write_corpus(path, strings):
+    with open(path, 'w') as fp:
+        for string in strings:
+            fp.write(json.dumps(string) + '\n')
@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import torch
+
+from vectorize_cli import vectorize_etcd
+from vectorize_cli.batching import AdaptiveBatcher, current_rss
+from vectorize_cli.cache import EmbeddingCache
+from vectorize_cli.cpu_pool import CpuPool
+from vectorize_cli.metrics import metrics
+from benchmarks.corpus import DISTRIBUTIONS, make_corpus, with_duplicates, write_corpus
+from benchmarks.tiny_bloom import TinyBloomBackend, init_tiny_bloom
+
+# Throughput benchmarks, runnable on a cpu without network access:
+#
+#   python -m benchmarks.run --output before.json
+#   (make changes)
+#   python -m benchmarks.run --output after.json
+#   python -m benchmarks.compare before.json after.json
+#
+# Three modes are measured for every corpus and chunk size:
+# - chunk calls process_chunk_to_array on chunks in input order, so
+#   this is the model and tokenizer alone
+# - loop runs the worker's start_ loop on the corpus, with the
+#   pipeline, sorting and batching, against a stand-in for the task
+#   instead of etcd
+# - cache is the loop with an empty embedding cache, on the corpus with
+#   --duplicates of its records repeated, so lookups hit and vectors
+#   get stored all along
+#
+# With --processes, the loop and cache modes also run with the model
+# in that many cpu inference processes, for comparing against one
+# process using --threads cores:
+#
+#   python -m benchmarks.run --modes loop --threads 16 --processes 1 4 8
+#
+# Every measurement is the median of --repeat runs.
+
+class BenchTask:
+    # what start_ needs of a task, without etcd
+    def __init__(self, init):
+        self.state = {'status': 'running', 'init': init}
+
+    def init(self):
+        return self.state['init']
+
+    def progress(self):
+        return self.state.get('progress')
+
+    def checkpoint(self):
+        return self.state.get('checkpoint')
+
+    def vectors(self):
+        return self.state.get('vectors')
+
+    def set_vectors(self, description):
+        self.state['vectors'] = description
+
+    def alive(self):
+        pass
+
+    def set_progress(self, progress, checkpoint=None):
+        self.state['progress'] = progress
+        if checkpoint is not None:
+            self.state['checkpoint'] = checkpoint
+
+    def finish(self, result):
+        self.state['status'] = 'complete'
+        self.state['result'] = result
+
+class PeakRss:
+    # samples the resident memory of this process while running
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.stopping = threading.Event()
+
+    def _sample(self):
+        while not self.stopping.is_set():
+            self.peak = max(self.peak, current_rss())
+            self.stopping.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopping.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss())
+
+class PaddingMeter:
+    # counts the tokens, real and padded, that go into the model
+    def __init__(self, backend):
+        self.backend = backend
+        self.infer_prepared = backend.infer_prepared
+        self.tokens = 0
+        self.padded = 0
+
+    def __call__(self, inputs):
+        self.tokens += int(inputs['attention_mask'].sum())
+        self.padded += inputs['attention_mask'].numel()
+        return self.infer_prepared(inputs)
+
+    def __enter__(self):
+        self.backend.infer_prepared = self
+        return self
+
+    def __exit__(self, *exc):
+        del self.backend.infer_prepared
+
+def run_chunks(backend, strings, chunk_size):
+    with PaddingMeter(backend) as meter:
+        start = time.perf_counter()
+        for offset in range(0, len(strings), chunk_size):
+            backend.output_to_array(backend.infer_prepared(backend.prepare_chunk(strings[offset:offset+chunk_size])))
+        duration = time.perf_counter() - start
+    return (duration, meter.tokens, meter.padded)
+
+def run_loop(backend, corpus_path, chunk_size, sort_window, token_budget, tokenizer_threads):
+    # configured the way vectorize_etcd.main does
+    vectorize_etcd.directory = os.path.dirname(corpus_path)
+    vectorize_etcd.backend = backend
+    vectorize_etcd.chunk_size = chunk_size
+    vectorize_etcd.sort_window = sort_window
+    vectorize_etcd.tokenizer_threads = tokenizer_threads
+    vectorize_etcd.pipeline_depth = 2
+    vectorize_etcd.prefetcher = None
+    vectorize_etcd.batcher = AdaptiveBatcher(chunk_size, max_tokens=token_budget)
+    task = BenchTask({'input_file': os.path.basename(corpus_path), 'output_file': 'bench-output.vec', 'format': {'dtype': 'f32'}})
+    # counted by the loop, as the inputs of a cpu pool are strings
+    before = metrics.snapshot()
+    start = time.perf_counter()
+    vectorize_etcd.start_(task)
+    duration = time.perf_counter() - start
+    summary = metrics.summary(before)
+    return (duration, summary['tokens'], summary['padded_tokens'])
+
+def run_cache(backend, corpus_path, chunk_size, sort_window, token_budget, tokenizer_threads):
+    # a new cache every run, so they all start out the same
+    with tempfile.TemporaryDirectory() as directory:
+        backend.cache = EmbeddingCache(os.path.join(directory, 'cache.sqlite'))
+        try:
+            return run_loop(backend, corpus_path, chunk_size, sort_window, token_budget, tokenizer_threads)
+        finally:
+            backend.cache.connection.close()
+            backend.cache = None
+
+def measure(run, repeat):
+    runs = []
+    for _ in range(repeat):
+        with PeakRss() as rss:
+            (duration, tokens, padded) = run()
+        runs.append((duration, tokens, padded, rss.peak))
+    runs.sort()
+    return runs[len(runs) // 2]
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='measure vectorization throughput with a tiny random bloom model')
+    parser.add_argument('--output', type=str, help='write the results to this json file')
+    parser.add_argument('--modes', nargs='+', choices=['chunk', 'loop', 'cache'], default=['chunk', 'loop', 'cache'])
+    parser.add_argument('--distributions', nargs='+', choices=DISTRIBUTIONS, default=['fixed', 'lognormal', 'bimodal'])
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--records', type=int, default=2000, help='the amount of records per corpus')
+    parser.add_argument('--mean-length', type=int, default=64, help='the mean record length in tokens')
+    parser.add_argument('--sort-window', type=int, default=8, help='sort window for the loop mode')
+    parser.add_argument('--duplicates', type=float, default=0.5, help='the share of repeated records for the cache mode')
+    parser.add_argument('--token-budget', type=int, help='token budget for the loop mode')
+    parser.add_argument('--tokenizer-threads', type=int, default=2, help='tokenizer threads for the loop mode')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1], help='inference processes for the loop and cache modes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=4, help='torch threads, fixed so results are comparable')
+    parser.add_argument('--hidden-size', type=int, default=256)
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    backend = TinyBloomBackend(hidden_size=args.hidden_size, layers=args.layers, seed=args.seed)
+    # warm up, so the first measurement doesn't pay for lazy setup
+    backend.process_chunk_to_array(make_corpus('fixed', 8, seed=args.seed))
+    pools = {}
+    for processes in args.processes:
+        if processes > 1:
+            pools[processes] = CpuPool('tiny-bloom', processes, init_backend=init_tiny_bloom,
+                                       hidden_size=args.hidden_size, layers=args.layers, seed=args.seed)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for distribution in args.distributions:
+            strings = make_corpus(distribution, args.records, mean=args.mean_length, seed=args.seed)
+            corpus_path = os.path.join(directory, f'{distribution}.jsonl')
+            write_corpus(corpus_path, strings)
+            duplicated_path = os.path.join(directory, f'{distribution}-duplicates.jsonl')
+            write_corpus(duplicated_path, with_duplicates(strings, args.duplicates, seed=args.seed))
+            for chunk_size in args.chunk_sizes:
+                for (mode, processes) in [(mode, processes) for mode in args.modes
+                                          for processes in ([1] if mode == 'chunk' else args.processes)]:
+                    model = pools.get(processes, backend)
+                    if mode == 'chunk':
+                        run = lambda: run_chunks(backend, strings, chunk_size)
+                    elif mode == 'loop':
+                        run = lambda: run_loop(model, corpus_path, chunk_size, args.sort_window, args.token_budget, args.tokenizer_threads)
+                    else:
+                        run = lambda: run_cache(model, duplicated_path, chunk_size, args.sort_window, args.token_budget, args.tokenizer_threads)
+                    (duration, tokens, padded, peak_rss) = measure(run, args.repeat)
+                    result = {'mode': mode, 'distribution': distribution, 'chunk_size': chunk_size,
+                              'records': len(strings), 'seconds': duration,
+                              'records_per_sec': len(strings) / duration,
+                              'tokens_per_sec': tokens / duration,
+                              'padding_ratio': padded / tokens,
+                              'peak_rss_mb': peak_rss / 1024 / 1024}
+                    if mode != 'chunk':
+                        result['sort_window'] = args.sort_window
+                        result['token_budget'] = args.token_budget
+                    if mode == 'cache':
+                        result['duplicates'] = args.duplicates
+                    if processes > 1:
+                        result['processes'] = processes
+                    results.append(result)
+                    print(f'{mode:5} {distribution:9} chunk {chunk_size:4} x{processes}: {result["records_per_sec"]:9.1f} records/s, '
+                          f'{result["tokens_per_sec"]:10.1f} tokens/s, padding {result["padding_ratio"]:.2f}, '
+                          f'peak rss {result["peak_rss_mb"]:.0f}MB', file=sys.stderr)
+
+    for pool in pools.values():
+        pool.close()
+
+    report = {'commit': git_commit(),
+              'python': platform.python_version(),
+              'torch': torch.__version__,
+              'machine': platform.machine(),
+              'cpus': os.cpu_count(),
+              'settings': {key: value for (key, value) in vars(args).items() if key != 'output'},
+              'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import os
+import gzip
+import json
+import argparse
+import tempfile
+import numpy
+
+# moto reads this when it is imported. Parts are made much smaller than
+# the 5MB S3 wants, so that outputs have several of them.
+os.environ.setdefault('S3_UPLOAD_PART_MIN_SIZE', '1')
+import boto3
+from moto import mock_aws
+
+from vectorize_cli import s3, vectorize_etcd
+from vectorize_cli.batching import AdaptiveBatcher
+from vectorize_cli.etcd_task import TaskInterrupted
+from vectorize_cli.input_index import InputIndex
+from vectorize_cli.vector_file import VectorFile
+from benchmarks.corpus import make_corpus
+from benchmarks.run import BenchTask
+from benchmarks.tiny_bloom import TinyBloomBackend
+
+# Checks of the worker's s3 inputs and outputs against moto's in-memory
+# S3, so they run offline without a bucket:
+#
+#   pip install 'moto[s3]'
+#   python -m benchmarks.s3_check
+#
+# Every check vectorizes an s3 input into an s3 output, and compares
+# the vectors with those of the records vectorized chunk by chunk:
+# - interrupt pauses the task partway and resumes it, carrying on with
+#   the upload of its checkpoint
+# - lost-upload aborts that upload before resuming, so the task has to
+#   start over
+# - shards splits the input over two shard tasks and merges them
+# - replaced overwrites the input with as many other bytes, which its
+#   index has to notice
+# Inputs are tried plain, and gzip compressed in two members.
+BUCKET = 'vectorize-check'
+# how far the vectors may be apart, relative to their largest element,
+# as they are batched differently
+TOLERANCE = 1e-4
+
+class CheckTask(BenchTask):
+    # a task that is paused after interrupt_after batches
+    def __init__(self, init, interrupt_after=None):
+        super().__init__(init)
+        self.interrupt_after = interrupt_after
+        self.alive_calls = 0
+
+    def alive(self):
+        self.alive_calls += 1
+        if self.interrupt_after is not None and self.alive_calls > self.interrupt_after:
+            self.state['status'] = 'paused'
+            raise TaskInterrupted(self.init()['output_file'], 'pause')
+
+    def status(self):
+        return self.state['status']
+
+    def resume(self):
+        self.state['status'] = 'running'
+
+    def finish_error(self, error):
+        self.state['status'] = 'error'
+        self.state['error'] = error
+
+def put_inputs(strings):
+    data = b''.join(f'{json.dumps(string)}\n'.encode() for string in strings)
+    half = data.index(b'\n', len(data) // 2) + 1
+    s3.client().put_object(Bucket=BUCKET, Key='input.jsonl', Body=data)
+    s3.client().put_object(Bucket=BUCKET, Key='input.jsonl.gz', Body=gzip.compress(data[:half]) + gzip.compress(data[half:]))
+    return [f's3://{BUCKET}/input.jsonl', f's3://{BUCKET}/input.jsonl.gz']
+
+def read_vectors(uri, directory):
+    (bucket, key) = s3.split_uri(uri)
+    path = os.path.join(directory, 'download.vec')
+    s3.client().download_file(bucket, key, path)
+    return VectorFile(path)[:]
+
+def check_vectors(name, vectors, expected):
+    if vectors.shape != expected.shape:
+        raise AssertionError(f'{name}: {vectors.shape[0]} vectors instead of {expected.shape[0]}')
+    difference = numpy.abs(vectors - expected).max() / max(numpy.abs(expected).max(), 1e-6)
+    if not difference <= TOLERANCE:
+        raise AssertionError(f'{name}: vectors differ by {difference:.2e}')
+
+def check_absent(name, uri):
+    if s3.exists(uri):
+        raise AssertionError(f'{name}: {uri} exists')
+
+def check_complete(name, task):
+    if task.status() != 'complete':
+        raise AssertionError(f'{name}: task is {task.status()}: {task.state.get("error")}')
+
+def interrupted(input_file, output_file, interrupt_after):
+    task = CheckTask({'input_file': input_file, 'output_file': output_file, 'format': {'dtype': 'f32'}},
+                     interrupt_after=interrupt_after)
+    try:
+        vectorize_etcd.start_(task)
+    except TaskInterrupted:
+        pass
+    if task.status() != 'paused':
+        raise AssertionError(f'{output_file}: task was not interrupted')
+    # an unfinished upload isn't an object yet
+    check_absent(output_file, output_file)
+    checkpoint = task.checkpoint()
+    if checkpoint is None or checkpoint['count'] == 0:
+        raise AssertionError(f'{output_file}: no part was uploaded before the interrupt, try a smaller --part-size')
+    task.state['status'] = 'resuming'
+    task.interrupt_after = None
+    return task
+
+def check_interrupt(input_file, expected, directory, interrupt_after):
+    output_file = f'{input_file}.interrupt.vec'
+    task = interrupted(input_file, output_file, interrupt_after)
+    vectorize_etcd.resume(task)
+    check_complete(output_file, task)
+    check_vectors(output_file, read_vectors(output_file, directory), expected)
+
+def check_lost_upload(input_file, expected, directory, interrupt_after):
+    output_file = f'{input_file}.lost.vec'
+    task = interrupted(input_file, output_file, interrupt_after)
+    # what a bucket lifecycle rule would do to an upload left alone
+    s3.abort_upload(output_file, task.checkpoint()['upload']['upload_id'])
+    vectorize_etcd.resume(task)
+    check_complete(output_file, task)
+    check_vectors(output_file, read_vectors(output_file, directory), expected)
+
+def check_shards(input_file, expected, directory):
+    output_file = f'{input_file}.sharded.vec'
+    index = InputIndex.load_or_build(input_file)
+    middle = len(index) // 3
+    segments = []
+    for (i, (first_line, end_line)) in enumerate([(0, middle), (middle, len(index))]):
+        segment = f'{output_file}.shard-{i}'
+        segments.append(segment)
+        task = CheckTask({'input_file': input_file, 'output_file': segment, 'format': {'dtype': 'f32'},
+                          'range': {'first_line': first_line, 'end_line': end_line,
+                                    'start': index.offset(first_line), 'end': index.offset(end_line)}})
+        task.set_progress({'count': 0, 'total': end_line - first_line})
+        vectorize_etcd.start_(task)
+        check_complete(segment, task)
+    task = CheckTask({'input_file': input_file, 'output_file': output_file, 'format': {'dtype': 'f32'}, 'segments': segments})
+    vectorize_etcd.merge_(task)
+    check_complete(output_file, task)
+    check_vectors(output_file, read_vectors(output_file, directory), expected)
+    for segment in segments:
+        check_absent(output_file, segment)
+
+def check_replaced(input_file):
+    InputIndex.load_or_build(input_file)
+    (bucket, key) = s3.split_uri(input_file)
+    data = s3.client().get_object(Bucket=bucket, Key=key)['Body'].read()
+    s3.client().put_object(Bucket=bucket, Key=key, Body=data[::-1])
+    if InputIndex.load(input_file) is not None:
+        raise AssertionError(f'{input_file}: the index of the replaced input is still used')
+
+def main():
+    parser = argparse.ArgumentParser(description="check the worker's s3 inputs and outputs against moto")
+    parser.add_argument('--records', type=int, default=300)
+    parser.add_argument('--mean-length', type=int, default=16, help='the mean record length in tokens')
+    parser.add_argument('--chunk-size', type=int, default=8)
+    parser.add_argument('--interrupt-after', type=int, default=10, help='batches before a task is paused')
+    parser.add_argument('--part-size', type=int, default=4096, help='bytes per uploaded part')
+    args = parser.parse_args()
+
+    backend = TinyBloomBackend(hidden_size=64, layers=2, heads=4)
+    strings = make_corpus('lognormal', args.records, mean=args.mean_length)
+    expected = numpy.concatenate([backend.process_chunk_to_array(strings[offset:offset+args.chunk_size])
+                                  for offset in range(0, len(strings), args.chunk_size)])
+
+    vectorize_etcd.backend = backend
+    vectorize_etcd.chunk_size = args.chunk_size
+    vectorize_etcd.sort_window = 2
+    vectorize_etcd.batcher = AdaptiveBatcher(args.chunk_size)
+    vectorize_etcd.s3_part_size = args.part_size
+    s3.MIN_PART_SIZE = 1
+
+    with tempfile.TemporaryDirectory() as directory, mock_aws():
+        os.environ['VECTORIZER_INDEX_CACHE'] = os.path.join(directory, 'index')
+        vectorize_etcd.directory = directory
+        s3._client = boto3.client('s3', region_name='us-east-1')
+        s3.client().create_bucket(Bucket=BUCKET)
+        failed = 0
+        input_files = put_inputs(strings)
+        for input_file in input_files:
+            checks = [('interrupt', lambda: check_interrupt(input_file, expected, directory, args.interrupt_after)),
+                      ('lost-upload', lambda: check_lost_upload(input_file, expected, directory, args.interrupt_after)),
+                      ('shards', lambda: check_shards(input_file, expected, directory))]
+            for (name, check) in checks:
+                try:
+                    check()
+                    print(f'{name} {input_file}: ok')
+                except AssertionError as e:
+                    print(f'{name} {input_file}: FAILED {e}')
+                    failed += 1
+        # last, as it changes the input
+        try:
+            check_replaced(input_files[0])
+            print(f'replaced {input_files[0]}: ok')
+        except AssertionError as e:
+            print(f'replaced {input_files[0]}: FAILED {e}')
+            failed += 1
+        uploads = s3.client().list_multipart_uploads(Bucket=BUCKET).get('Uploads', [])
+        if uploads:
+            print(f'FAILED: {len(uploads)} uploads left unfinished')
+            failed += 1
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import threading
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import BloomConfig, BloomModel, PreTrainedTokenizerFast
+
+from vectorize_cli.backends.bloom import BloomBackend, boq, eoq, bod, eod
+from benchmarks.corpus import VOCABULARY
+
+def tiny_tokenizer():
+    # one token per word of the synthetic corpus vocabulary
+    special = ['<pad>', '<unk>', boq, eoq, bod, eod]
+    vocab = {token: i for (i, token) in enumerate(special + VOCABULARY)}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token='<pad>', unk_token='<unk>',
+                                   additional_special_tokens=[boq, eoq, bod, eod], padding_side='left')
+
+class TinyBloomBackend(BloomBackend):
+    # The bloom backend with a small randomly initialized model of the
+    # same architecture, so benchmarks run anywhere without
+    # downloading anything. The vectors are meaningless, but the work
+    # done per token has the same shape as for the real model.
+    name = 'tiny-bloom'
+
+    def __init__(self, hidden_size=256, layers=4, heads=8, seed=0, device='cpu'):
+        torch.manual_seed(seed)
+        self.device = torch.device(device)
+        self.cpu_device = torch.device('cpu')
+        self.tokenizer = tiny_tokenizer()
+        config = BloomConfig(vocab_size=len(self.tokenizer), hidden_size=hidden_size, n_layer=layers, n_head=heads)
+        self.model = BloomModel(config).to(self.device)
+        self.model.eval()
+        self.revision = f'random-{hidden_size}x{layers}x{heads}-{seed}'
+        self.dimension = hidden_size
+        self.eoq_id, self.eod_id = self.tokenizer.convert_tokens_to_ids([eoq, eod])
+        self.local = threading.local()
+
+def init_tiny_bloom(name, device='cpu', **options):
+    # for CpuPool, which makes the backend in every process with this
+    return TinyBloomBackend(device=device, **options)
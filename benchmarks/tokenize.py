@@ -0,0 +1,84 @@
+import sys
+import time
+import argparse
+import torch
+from transformers import AutoTokenizer
+
+from vectorize_cli.backends.bloom import boq, eoq, bod, eod
+from benchmarks.corpus import DISTRIBUTIONS, make_corpus
+from benchmarks.tiny_bloom import TinyBloomBackend
+
+# Tokenization time per batch of the bloom backend, against the way it
+# used to tokenize, which is kept here for comparison:
+#
+#   python -m benchmarks.tokenize
+#   python -m benchmarks.tokenize --tokenizer izhx/udever-bloom-560m
+#
+# Both ways are checked to give exactly the same tensors, for
+# documents and queries, with and without truncation, and for an empty
+# batch. The real tokenizer is what matters, the synthetic one only
+# has whole words for tokens.
+
+def padded_twice(backend, texts, is_query=False, max_length=2048):
+    # pad to the longest row, append the end marker to every row in
+    # python, then pad again to get tensors
+    tokenizer = backend.tokenizer
+    bos = boq if is_query else bod
+    eos_id = backend.eoq_id if is_query else backend.eod_id
+    encoding = tokenizer([bos + t for t in texts], truncation=True, max_length=max_length - 1, padding=True)
+    for ids, mask in zip(encoding['input_ids'], encoding['attention_mask']):
+        ids.append(eos_id)
+        mask.append(1)
+    return tokenizer.pad(encoding, return_tensors='pt')
+
+def per_batch(tokenize, batches, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for batch in batches:
+            tokenize(batch)
+        times.append((time.perf_counter() - start) / len(batches))
+    return sorted(times)[len(times) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description='time tokenization per batch, before and after single pass padding')
+    parser.add_argument('--tokenizer', type=str, help='a pretrained bloom tokenizer to use instead of the synthetic one')
+    parser.add_argument('--distributions', nargs='+', choices=DISTRIBUTIONS, default=['fixed', 'lognormal', 'bimodal'])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--records', type=int, default=4096)
+    parser.add_argument('--mean-length', type=int, default=64)
+    parser.add_argument('--sort', action='store_true', help='sort records by length before batching them, as the worker does')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    backend = TinyBloomBackend(hidden_size=64, layers=1, heads=1)
+    if args.tokenizer is not None:
+        backend.tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        backend.tokenizer.padding_side = 'left'
+        backend.eoq_id, backend.eod_id = backend.tokenizer.convert_tokens_to_ids([eoq, eod])
+
+    for distribution in args.distributions:
+        strings = make_corpus(distribution, args.records, mean=args.mean_length)
+        if args.sort:
+            strings.sort(key=len)
+        for batch_size in args.batch_sizes:
+            batches = [strings[offset:offset+batch_size] for offset in range(0, len(strings), batch_size)]
+            for batch in batches + [[]]:
+                for (is_query, max_length) in [(False, 2048), (True, 2048), (False, args.mean_length // 2)]:
+                    if batch:
+                        before = padded_twice(backend, batch, is_query, max_length)
+                    else:
+                        # the tokenizer can't pad nothing
+                        before = {key: torch.zeros((0, 0), dtype=torch.int64) for key in ['input_ids', 'attention_mask']}
+                    after = backend.tokenize(batch, is_query, max_length)
+                    for key in ['input_ids', 'attention_mask']:
+                        if not torch.equal(before[key], after[key]):
+                            sys.exit(f'{key} differs for {distribution} batches of {batch_size}, query {is_query}, max length {max_length}')
+                    if not is_query and batch and not torch.equal(after['input_ids'], backend.prepare_tokens(backend.encode_tokens(batch, max_length))['input_ids']):
+                        sys.exit(f'encode_tokens differs from tokenize for {distribution} batches of {batch_size}, max length {max_length}')
+            before = per_batch(lambda batch: padded_twice(backend, batch), batches, args.repeat)
+            after = per_batch(backend.tokenize, batches, args.repeat)
+            print(f'{distribution:9} batch {batch_size:4}: {before * 1000:8.3f}ms -> {after * 1000:8.3f}ms per batch ({before / after:.2f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import os
+import json
+import numpy
+from numpy.lib.format import open_memmap
+
+from vectorize_cli.vector_file import VectorFile
+
+# An inverted file (IVF) index for approximate nearest neighbour
+# search. Vectors are clustered around coarse centroids with k-means,
+# and every cluster keeps a list of its vectors. A search only looks
+# at the lists of the nprobe centroids nearest to the query.
+#
+# Lists either hold the vectors themselves, or product quantized (PQ)
+# codes of how they differ from their centroid: the vector is split in
+# pq parts, and every part is stored as the index of the nearest of 256
+# centroids trained for that part. That is one byte per part instead
+# of four bytes per dimension, at the cost of approximate distances.
+#
+# An index is a directory of .npy files, so it can be memory mapped:
+# - meta.json: parameters and the vector file it was built from
+# - centroids.npy: (lists, dimension) coarse centroids
+# - offsets.npy: (lists + 1) where every list starts in ids
+# - ids.npy: (count) line numbers of the vectors, list after list
+# - vectors.npy: (count, dimension) the vectors in the same order, or
+# - codes.npy: (count, pq) their PQ codes, with
+# - codebooks.npy: (pq, 256, dimension / pq) the PQ centroids
+#
+# For cosine, vectors are normalized first, so that the euclidean
+# distances everything is computed with order them the same way.
+# Distances returned are as those of exact search.
+BLOCK_ROWS = 65536
+CODEBOOK_SIZE = 256
+
+def normalize(array):
+    norms = numpy.linalg.norm(array, axis=1, keepdims=True)
+    return array / numpy.where(norms == 0, 1, norms)
+
+def squared_distances(x, centroids):
+    return numpy.maximum((x * x).sum(axis=1)[:, None] - 2 * (x @ centroids.T) + (centroids * centroids).sum(axis=1)[None, :], 0)
+
+def assign(x, centroids):
+    labels = numpy.empty(len(x), dtype='int32')
+    for start in range(0, len(x), BLOCK_ROWS):
+        labels[start:start+BLOCK_ROWS] = squared_distances(x[start:start+BLOCK_ROWS], centroids).argmin(axis=1)
+    return labels
+
+def kmeans(x, k, iterations=20, seed=0, progress=None):
+    # plain Lloyd's, starting from random members of x. Centroids
+    # that lose all their members are moved to a random one.
+    rng = numpy.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].astype('float32')
+    for iteration in range(iterations):
+        labels = assign(x, centroids)
+        order = numpy.argsort(labels, kind='stable')
+        counts = numpy.bincount(labels, minlength=k)
+        present = numpy.flatnonzero(counts)
+        starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])[present]
+        centroids[present] = numpy.add.reduceat(x[order], starts, axis=0) / counts[present][:, None]
+        empty = numpy.flatnonzero(counts == 0)
+        if len(empty) != 0:
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+        if progress is not None:
+            progress(iteration + 1, iterations)
+    return centroids
+
+def read_vectors(vector_file, ids, metric):
+    vectors = vector_file[ids]
+    return normalize(vectors) if metric == 'cosine' else vectors
+
+def build(vectors_path, index_dir, lists, pq=None, metric='cosine', train_size=None, dimension=None, seed=0, progress=None):
+    # progress is called with a stage, and how far along that is
+    if progress is None:
+        progress = lambda stage, count, total: None
+    vector_file = VectorFile(vectors_path, dimension=dimension)
+    count = len(vector_file)
+    dimension = vector_file.dimension
+    if count < lists:
+        raise ValueError(f'cannot make {lists} lists out of {count} vectors')
+    if pq is not None and dimension % pq != 0:
+        raise ValueError(f'the dimension {dimension} cannot be split in {pq} parts')
+    if pq is not None and count < CODEBOOK_SIZE:
+        raise ValueError(f'product quantization needs at least {CODEBOOK_SIZE} vectors')
+
+    # k-means only needs a sample to find good centroids
+    rng = numpy.random.default_rng(seed)
+    if train_size is None:
+        train_size = max(100 * lists, 50 * CODEBOOK_SIZE)
+    sample_ids = numpy.sort(rng.choice(count, min(train_size, count), replace=False))
+    sample = read_vectors(vector_file, sample_ids, metric)
+    centroids = kmeans(sample, lists, seed=seed, progress=lambda i, n: progress('train', i, n))
+
+    codebooks = None
+    if pq is not None:
+        residuals = sample - centroids[assign(sample, centroids)]
+        part = dimension // pq
+        codebooks = numpy.stack([kmeans(residuals[:, m*part:(m+1)*part], CODEBOOK_SIZE, seed=seed + m + 1,
+                                        progress=lambda i, n, m=m: progress('train_pq', m * n + i, pq * n))
+                                 for m in range(pq)])
+
+    labels = numpy.empty(count, dtype='int32')
+    for start in range(0, count, BLOCK_ROWS):
+        ids = numpy.arange(start, min(start + BLOCK_ROWS, count))
+        labels[ids] = assign(read_vectors(vector_file, ids, metric), centroids)
+        progress('assign', ids[-1] + 1, count)
+
+    # write the lists, each sorted by line number
+    os.makedirs(index_dir, exist_ok=True)
+    order = numpy.argsort(labels, kind='stable')
+    offsets = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(labels, minlength=lists))]).astype('int64')
+    numpy.save(os.path.join(index_dir, 'centroids.npy'), centroids)
+    numpy.save(os.path.join(index_dir, 'offsets.npy'), offsets)
+    numpy.save(os.path.join(index_dir, 'ids.npy'), order.astype('int64'))
+    if pq is None:
+        stored = open_memmap(os.path.join(index_dir, 'vectors.npy'), mode='w+', dtype='float32', shape=(count, dimension))
+    else:
+        numpy.save(os.path.join(index_dir, 'codebooks.npy'), codebooks)
+        stored = open_memmap(os.path.join(index_dir, 'codes.npy'), mode='w+', dtype='uint8', shape=(count, pq))
+    for start in range(0, count, BLOCK_ROWS):
+        ids = order[start:start+BLOCK_ROWS]
+        vectors = read_vectors(vector_file, ids, metric)
+        if pq is None:
+            stored[start:start+len(ids)] = vectors
+        else:
+            residuals = vectors - centroids[labels[ids]]
+            for m in range(pq):
+                stored[start:start+len(ids), m] = assign(residuals[:, m*part:(m+1)*part], codebooks[m])
+        progress('write', start + len(ids), count)
+    stored.flush()
+    del stored
+
+    # written last, so an index without it is known to be incomplete
+    meta = {'vectors': vectors_path, 'count': count, 'dimension': dimension, 'lists': lists, 'pq': pq, 'metric': metric}
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as fp:
+        json.dump(meta, fp)
+    return meta
+
+class AnnIndex:
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, 'meta.json')) as fp:
+            self.meta = json.load(fp)
+        self.metric = self.meta['metric']
+        self.pq = self.meta['pq']
+        load = lambda name: numpy.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r')
+        self.centroids = numpy.asarray(load('centroids'))
+        self.offsets = numpy.asarray(load('offsets'))
+        self.ids = load('ids')
+        if self.pq is None:
+            self.vectors = load('vectors')
+        else:
+            self.codes = load('codes')
+            self.codebooks = numpy.asarray(load('codebooks'))
+
+    def _list_distances(self, query, lst):
+        # squared distances from the query to the vectors in a list
+        (start, end) = (self.offsets[lst], self.offsets[lst+1])
+        if self.pq is None:
+            return squared_distances(query[None, :], numpy.asarray(self.vectors[start:end]))[0]
+        # the distance to a vector is approximately the sum of the
+        # distances of the parts of the query's residual to the PQ
+        # centroids of the vector's parts, which are looked up in a
+        # table made per list.
+        residual = (query - self.centroids[lst]).reshape(self.pq, -1)
+        tables = ((residual[:, None, :] - self.codebooks) ** 2).sum(axis=2)
+        codes = numpy.asarray(self.codes[start:end])
+        return tables[numpy.arange(self.pq)[None, :], codes].sum(axis=1)
+
+    def search(self, queries, k=10, nprobe=8):
+        # returns (distances, lines), both (queries, k) and nearest
+        # first. Queries with fewer than k candidates in the probed
+        # lists are padded with infinite distances and line -1.
+        queries = numpy.asarray(queries, dtype='float32')
+        if self.metric == 'cosine':
+            queries = normalize(queries)
+        probes = numpy.argsort(squared_distances(queries, self.centroids), axis=1)[:, :nprobe]
+        distances = numpy.full((len(queries), k), numpy.inf, dtype='float32')
+        lines = numpy.full((len(queries), k), -1, dtype='int64')
+        for (q, query) in enumerate(queries):
+            candidates = numpy.concatenate([self._list_distances(query, lst) for lst in probes[q]])
+            candidate_ids = numpy.concatenate([self.ids[self.offsets[lst]:self.offsets[lst+1]] for lst in probes[q]])
+            if len(candidates) > k:
+                selection = numpy.argpartition(candidates, k - 1)[:k]
+                (candidates, candidate_ids) = (candidates[selection], candidate_ids[selection])
+            order = numpy.argsort(candidates)
+            distances[q, :len(order)] = candidates[order]
+            lines[q, :len(order)] = candidate_ids[order]
+        if self.metric == 'cosine':
+            # for unit vectors, squared distance is 2 - 2 cos
+            return (distances / 4, lines)
+        return (numpy.sqrt(distances), lines)
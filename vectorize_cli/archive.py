@@ -0,0 +1,65 @@
+import json
+import os
+import pathlib
+import sqlite3
+import time
+import zlib
+
+class TaskArchive:
+    # A local store for finished tasks, so they don't have to stay in
+    # etcd forever. The full task state is kept compressed, with the
+    # fields that are useful for listing next to it.
+    def __init__(self, path, read_only=False):
+        if read_only:
+            self.connection = sqlite3.connect(pathlib.Path(path).absolute().as_uri() + '?mode=ro', uri=True)
+            return
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS tasks (
+                                       name TEXT PRIMARY KEY,
+                                       status TEXT NOT NULL,
+                                       input_file TEXT,
+                                       output_file TEXT,
+                                       archived_at REAL NOT NULL,
+                                       state BLOB NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status)')
+
+    @staticmethod
+    def open_read_only(path):
+        # for lookups, which shouldn't create an archive as a side
+        # effect. None if there is no archive yet.
+        if not os.path.exists(path):
+            return None
+        return TaskArchive(path, read_only=True)
+
+    def add(self, name, state):
+        init = state.get('init', {})
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO tasks (name, status, input_file, output_file, archived_at, state) VALUES (?, ?, ?, ?, ?, ?)',
+                                    (name, state['status'], init.get('input_file'), init.get('output_file'), time.time(),
+                                     zlib.compress(json.dumps(state).encode('utf-8'))))
+
+    def remove(self, name):
+        with self.connection:
+            self.connection.execute('DELETE FROM tasks WHERE name = ?', (name,))
+
+    def get(self, name):
+        row = self.connection.execute('SELECT state FROM tasks WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def _where(self, statuses):
+        if not statuses:
+            return ('', [])
+        return (f'WHERE status IN ({",".join("?" * len(statuses))})', list(statuses))
+
+    def count(self, statuses=None):
+        (where, params) = self._where(statuses)
+        (count,) = self.connection.execute(f'SELECT COUNT(*) FROM tasks {where}', params).fetchone()
+        return count
+
+    def list(self, statuses=None, offset=0, limit=100):
+        # returns (name, state) pairs ordered by name
+        (where, params) = self._where(statuses)
+        rows = self.connection.execute(f'SELECT name, state FROM tasks {where} ORDER BY name LIMIT ? OFFSET ?', params + [limit, offset])
+        return [(name, json.loads(zlib.decompress(state))) for (name, state) in rows]
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+import argparse
+import etcd3
+import heapq
+import json
+import os
+import secrets
+import sys
+import time
+from libcloud.compute.types import NodeState, Provider
+from libcloud.compute.providers import get_driver
+
+# Keeps enough vectorize-server workers around to get through the
+# queue by a target time, and no more.
+#
+# Every interval, the remaining work is estimated from the tasks in
+# etcd: records left per task, and tokens left where the progress of
+# a task tells how many tokens its records have. How much a worker
+# gets through comes from the rates of the running tasks. A worker
+# works on one task at a time, so the time it takes some amount of
+# workers to finish is estimated by handing them the tasks largest
+# first. The fewest workers that would finish in time is what the
+# autoscaler aims for, kept between the minimum and maximum.
+#
+# Nodes are launched through libcloud, and start a worker with the
+# node's name as its identity, so the claims in etcd tell which nodes
+# are busy. Idle nodes that are not needed are destroyed. Busy ones
+# are drained first: they get a key under /services/drain/ that makes
+# the worker stop taking tasks, and are destroyed once their task is
+# done. A drained node can be taken back into use while its worker is
+# still at its task, but not once the worker has marked the drain as
+# acted on and stopped. The nodes the autoscaler launched are kept in
+# etcd, so it can be restarted, and leaves alone any other nodes in
+# the account.
+SERVICE = 'vectorizer'
+RUNNABLE = ['pending', 'running', 'resuming']
+# starts the worker on a node, see the run script
+USERDATA = '''#!/bin/bash
+sudo -iu ubuntu /home/ubuntu/vectorize-cli/run {identity} {etcd}
+'''
+
+class Workload:
+    def __init__(self, remaining, queued, record_rate, token_rate):
+        # (records, tokens) left of every runnable task, with tokens
+        # None if there is no telling, and how many tasks are queued
+        self.remaining = remaining
+        self.tasks = len(remaining)
+        self.queued = queued
+        self.records = sum(records for (records, _) in remaining)
+        self.tokens = None if any(tokens is None for (_, tokens) in remaining) else sum(tokens for (_, tokens) in remaining)
+        # what a worker gets through per second, None if no worker has
+        # said yet
+        self.record_rate = record_rate
+        self.token_rate = token_rate
+
+    def durations(self, worker_rate):
+        # seconds every task will take a worker
+        durations = []
+        for (records, tokens) in self.remaining:
+            if tokens is not None and self.token_rate is not None:
+                durations.append(tokens / self.token_rate)
+            else:
+                durations.append(records / (self.record_rate or worker_rate))
+        return durations
+
+    def __str__(self):
+        tokens = f', {self.tokens:.0f} tokens' if self.tokens is not None else ''
+        rate = f', {self.record_rate:.1f} records/s per worker' if self.record_rate is not None else ''
+        return f'{self.tasks} tasks ({self.queued} queued), {self.records:.0f} records{tokens} left{rate}'
+
+def tokens_per_record(progress):
+    if progress.get('avg_rate') and progress.get('avg_token_rate') is not None:
+        return progress['avg_token_rate'] / progress['avg_rate']
+    return None
+
+def estimate_workload(states, queued, default_records):
+    # states are the task states by task id. Tasks that haven't been
+    # indexed yet have no total, and are guessed to be as large as the
+    # ones that have, or default_records if none have. Merge, index and
+    # pretokenize tasks need a worker, but have no records to count.
+    runnable = {task_id: state for (task_id, state) in states.items() if state['status'] in RUNNABLE}
+    progresses = [state.get('progress') or {} for state in runnable.values()]
+    totals = [progress['total'] for progress in progresses if progress.get('total') is not None]
+    guess = sum(totals) / len(totals) if totals else default_records
+
+    ratios = [ratio for ratio in map(tokens_per_record, progresses) if ratio is not None]
+    average_ratio = sum(ratios) / len(ratios) if ratios else None
+
+    remaining = []
+    record_rates = []
+    token_rates = []
+    for state in runnable.values():
+        if state['init'].get('type', 'vectorize') != 'vectorize' or 'segments' in state['init']:
+            remaining.append((0, 0))
+            continue
+        progress = state.get('progress') or {}
+        left = progress['total'] - progress.get('count', 0) if progress.get('total') is not None else guess
+        ratio = tokens_per_record(progress)
+        if ratio is None:
+            ratio = average_ratio
+        remaining.append((left, left * ratio if ratio is not None else None))
+        if state['status'] == 'running' and progress.get('avg_rate'):
+            record_rates.append(progress['avg_rate'])
+            if progress.get('avg_token_rate'):
+                token_rates.append(progress['avg_token_rate'])
+
+    record_rate = sum(record_rates) / len(record_rates) if record_rates else None
+    token_rate = sum(token_rates) / len(token_rates) if token_rates else None
+    queued = sum(1 for task_id in runnable if task_id in queued)
+    return Workload(remaining, queued, record_rate, token_rate)
+
+def finish_seconds(durations, workers):
+    # how long the workers take if every next largest task goes to the
+    # worker that is done first
+    loads = [0.0] * workers
+    for duration in sorted(durations, reverse=True):
+        heapq.heappush(loads, heapq.heappop(loads) + duration)
+    return max(loads)
+
+class Policy:
+    def __init__(self, min_nodes=0, max_nodes=1, target_seconds=3600, deadline=None, boot_seconds=300,
+                 cooldown=300, worker_rate=100, default_records=100000):
+        self.min_nodes = min_nodes
+        self.max_nodes = max_nodes
+        # done within target_seconds from now, or by the deadline if
+        # there is one
+        self.target_seconds = target_seconds
+        self.deadline = deadline
+        # how long a new node takes to get to work
+        self.boot_seconds = boot_seconds
+        self.cooldown = cooldown
+        # records per second of a worker, until the workers tell
+        self.worker_rate = worker_rate
+        self.default_records = default_records
+
+    def desired(self, workload, now):
+        if workload.tasks == 0:
+            return self.min_nodes
+        seconds = (self.deadline - now if self.deadline is not None else self.target_seconds) - self.boot_seconds
+        # more workers than tasks would have nothing to do
+        most = min(self.max_nodes, workload.tasks)
+        durations = workload.durations(self.worker_rate)
+        # if no amount is in time, be as quick as we can
+        needed = next((workers for workers in range(1, most + 1) if finish_seconds(durations, workers) <= seconds), most)
+        return max(self.min_nodes, needed)
+
+class EtcdState:
+    # what the autoscaler reads from and writes to etcd
+    def __init__(self, etcd, service=SERVICE):
+        self.etcd = etcd
+        self.tasks_prefix = f'/services/tasks/{service}/'
+        self.queue_prefix = f'/services/queue/{service}/'
+        self.claims_prefix = f'/services/claims/{service}/'
+        self.drain_prefix = f'/services/drain/{service}/'
+        self.nodes_prefix = f'/services/autoscaler/{service}/'
+
+    def _prefix(self, prefix, keys_only=False):
+        for (value, kv) in self.etcd.get_prefix(prefix, keys_only=keys_only):
+            yield (kv.key.decode('utf-8')[len(prefix):], value)
+
+    def snapshot(self):
+        # (task states by id, queued task ids, identities by claimed task id)
+        states = {task_id: json.loads(value) for (task_id, value) in self._prefix(self.tasks_prefix)}
+        queued = {task_id for (task_id, _) in self._prefix(self.queue_prefix, keys_only=True)}
+        claims = {task_id: value.decode('utf-8') for (task_id, value) in self._prefix(self.claims_prefix)}
+        return (states, queued, claims)
+
+    def nodes(self):
+        return {name: json.loads(value) for (name, value) in self._prefix(self.nodes_prefix)}
+
+    def put_node(self, name, record):
+        self.etcd.put(f'{self.nodes_prefix}{name}', json.dumps(record))
+
+    def delete_node(self, name):
+        self.etcd.delete(f'{self.nodes_prefix}{name}')
+        self.etcd.delete(f'{self.drain_prefix}{name}')
+
+    def drain(self, name):
+        self.etcd.put(f'{self.drain_prefix}{name}', '')
+
+    def undrain(self, name):
+        # fails if the worker already stopped for the drain
+        drain_key = f'{self.drain_prefix}{name}'
+        (result,_) = self.etcd.transaction(
+            compare=[self.etcd.transactions.value(drain_key) == ''],
+            success=[self.etcd.transactions.delete(drain_key)],
+            failure=[])
+        return result
+
+class NodePool:
+    # The nodes the autoscaler launched, by name. The name is also the
+    # identity of the worker on the node. Records in the state have
+    # the node id, which is what the driver knows the node by.
+    def __init__(self, driver, size, image, state, name_prefix='vectorizer', create_args={}, userdata=None, etcd_host=''):
+        self.driver = driver
+        self.size = size
+        self.image = image
+        self.state = state
+        self.name_prefix = name_prefix
+        self.create_args = create_args
+        self.userdata = userdata
+        self.etcd_host = etcd_host
+        self.nodes = {}
+
+    def refresh(self):
+        # forgets nodes that are gone, like spot instances that got
+        # taken away, so they get replaced
+        existing = {str(node.id) for node in self.driver.list_nodes() if node.state != NodeState.TERMINATED}
+        self.nodes = {}
+        for (name, record) in self.state.nodes().items():
+            if record['id'] in existing:
+                self.nodes[name] = record
+            else:
+                print(f'node {name} is gone', file=sys.stderr)
+                self.state.delete_node(name)
+        return self.nodes
+
+    def _find(self, name):
+        node_id = self.nodes[name]['id']
+        return next((node for node in self.driver.list_nodes() if str(node.id) == node_id), None)
+
+    def launch(self, now):
+        name = f'{self.name_prefix}-{secrets.token_hex(4)}'
+        create_args = dict(self.create_args)
+        if self.userdata is not None:
+            create_args['ex_userdata'] = self.userdata.format(identity=name, etcd=self.etcd_host)
+        node = self.driver.create_node(name=name, size=self.size, image=self.image, **create_args)
+        record = {'id': str(node.id), 'launched': now, 'draining': False}
+        self.state.put_node(name, record)
+        self.nodes[name] = record
+        print(f'launched node {name} ({node.id})', file=sys.stderr)
+        return name
+
+    def destroy(self, name):
+        node = self._find(name)
+        if node is not None:
+            self.driver.destroy_node(node)
+        self.state.delete_node(name)
+        del self.nodes[name]
+        print(f'destroyed node {name}', file=sys.stderr)
+
+    def set_draining(self, name, draining):
+        # returns whether it could, as a node whose worker stopped for
+        # its drain can't be taken back
+        if draining:
+            self.state.drain(name)
+        elif not self.state.undrain(name):
+            return False
+        record = dict(self.nodes[name], draining=draining)
+        self.state.put_node(name, record)
+        self.nodes[name] = record
+        return True
+
+class Autoscaler:
+    def __init__(self, state, pool, policy):
+        self.state = state
+        self.pool = pool
+        self.policy = policy
+        self.last_change = None
+
+    def step(self, now):
+        # one round of looking at the queue and scaling to it. Returns
+        # the workload and the amount of nodes it aimed for.
+        (states, queued, claims) = self.state.snapshot()
+        workload = estimate_workload(states, queued, self.policy.default_records)
+        busy = set(claims.values())
+        nodes = self.pool.refresh()
+
+        # drained nodes can go once their task is done
+        for (name, record) in list(nodes.items()):
+            if record['draining'] and name not in busy:
+                self.pool.destroy(name)
+        active = [name for (name, record) in nodes.items() if not record['draining']]
+        draining = [name for (name, record) in nodes.items() if record['draining']]
+
+        desired = self.policy.desired(workload, now)
+        if desired != len(active) and (self.last_change is None or now - self.last_change >= self.policy.cooldown):
+            self.last_change = now
+            if desired > len(active):
+                # nodes on their way out are quicker to get back than
+                # new ones are to start, if their worker is still there
+                for name in draining:
+                    if len(active) < desired and self.pool.set_draining(name, False):
+                        active.append(name)
+                for _ in range(desired - len(active)):
+                    self.pool.launch(now)
+            else:
+                # idle nodes first, and then the ones busy for the
+                # shortest time
+                excess = sorted(active, key=lambda name: (name in busy, -nodes[name]['launched']))[:len(active) - desired]
+                for name in excess:
+                    if name in busy:
+                        self.pool.set_draining(name, True)
+                    else:
+                        self.pool.destroy(name)
+        return (workload, desired)
+
+def connect(args):
+    # the driver, size, image and extra create_node arguments
+    match args.provider:
+        case 'dummy':
+            # for trying out the scaling without launching anything
+            driver = get_driver(Provider.DUMMY)(0)
+            return (driver, driver.list_sizes()[0], driver.list_images()[0], {})
+        case 'ec2':
+            import boto3
+            credentials = boto3.Session().get_credentials()
+            region = {'region': args.region} if args.region is not None else {}
+            driver = get_driver(Provider.EC2)(credentials.access_key, credentials.secret_key, **region)
+            size = next(size for size in driver.list_sizes() if size.id == args.size)
+            image = driver.get_image(args.image)
+            create_args = {'ex_assign_public_ip': True, 'ex_terminate_on_shutdown': True}
+            if args.subnet is not None:
+                create_args['ex_subnet'] = next(subnet for subnet in driver.ex_list_subnets() if subnet.id == args.subnet)
+            if args.security_group:
+                create_args['ex_security_group_ids'] = args.security_group
+            if args.spot:
+                create_args['ex_spot'] = True
+            return (driver, size, image, create_args)
+
+def main():
+    parser = argparse.ArgumentParser(description='launch and drain workers to get through the queue by a target time')
+    parser.add_argument('--etcd', help='hostname of etcd server')
+    parser.add_argument('--provider', choices=['ec2', 'dummy'], default='ec2', help='where to launch nodes, dummy only pretends')
+    parser.add_argument('--region', type=str, help='the region to launch nodes in')
+    parser.add_argument('--size', type=str, default='g5.xlarge', help='the size of the nodes to launch')
+    parser.add_argument('--image', type=str, default='ami-06c87a711a9f2cf51', help='the image of the nodes to launch, with vectorize-cli in ~/vectorize-cli')
+    parser.add_argument('--subnet', type=str, default='subnet-0141736fba5a518b1', help='the subnet to launch nodes in')
+    parser.add_argument('--security-group', type=str, nargs='*', default=['sg-001bc2fe593af960e'], help='security groups of the nodes')
+    parser.add_argument('--spot', action='store_true', help='launch spot instances')
+    parser.add_argument('--name-prefix', type=str, default='vectorizer', help='what the names of launched nodes start with')
+    parser.add_argument('--min-nodes', type=int, default=0)
+    parser.add_argument('--max-nodes', type=int, default=4)
+    parser.add_argument('--target-seconds', type=float, default=3600, help='get through the queue within this many seconds from any moment')
+    parser.add_argument('--deadline', type=float, help='get through the queue by this unix time instead')
+    parser.add_argument('--boot-seconds', type=float, default=300, help='how long a new node takes to start working')
+    parser.add_argument('--cooldown', type=float, default=300, help='the minimum amount of seconds between scaling up or down')
+    parser.add_argument('--worker-rate', type=float, default=100, help='records per second a worker is assumed to do before any worker reports its rate')
+    parser.add_argument('--default-records', type=int, default=100000, help='records an unindexed task is assumed to have when no task is indexed')
+    parser.add_argument('--max-node-price', type=float, help='refuse to launch nodes that cost more than this per hour')
+    parser.add_argument('--max-hourly-cost', type=float, help='no more nodes than fit in this budget per hour')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between looks at the queue')
+    args = parser.parse_args()
+
+    host = args.etcd
+    if host is None:
+        host = os.getenv('ETCD_HOST')
+    etcd = etcd3.client(host=host) if host is not None else etcd3.client()
+
+    (driver, size, image, create_args) = connect(args)
+    max_nodes = args.max_nodes
+    if size.price is None:
+        if args.max_node_price is not None or args.max_hourly_cost is not None:
+            sys.exit(f'the price of {size.id} is unknown, so cost limits cannot be kept')
+    else:
+        if args.max_node_price is not None and size.price > args.max_node_price:
+            sys.exit(f'{size.id} costs {size.price} per hour, more than the limit of {args.max_node_price}')
+        if args.max_hourly_cost is not None and size.price > 0:
+            max_nodes = min(max_nodes, int(args.max_hourly_cost // size.price))
+    if args.min_nodes > max_nodes:
+        sys.exit(f'cannot keep {args.min_nodes} nodes with at most {max_nodes} of {size.id}')
+    print(f'scaling between {args.min_nodes} and {max_nodes} nodes of {size.id}', file=sys.stderr)
+
+    state = EtcdState(etcd)
+    userdata = USERDATA if args.provider != 'dummy' else None
+    pool = NodePool(driver, size, image, state, name_prefix=args.name_prefix, create_args=create_args, userdata=userdata, etcd_host=host or 'localhost')
+    policy = Policy(min_nodes=args.min_nodes, max_nodes=max_nodes, target_seconds=args.target_seconds, deadline=args.deadline,
+                    boot_seconds=args.boot_seconds, cooldown=args.cooldown, worker_rate=args.worker_rate, default_records=args.default_records)
+    autoscaler = Autoscaler(state, pool, policy)
+    while True:
+        try:
+            (workload, desired) = autoscaler.step(time.time())
+            print(f'{workload}, {len(pool.nodes)} nodes, aiming for {desired}', file=sys.stderr)
+        except Exception as e:
+            # the cloud or etcd having a bad moment shouldn't end us
+            print(f'scaling failed: {e}', file=sys.stderr)
+        time.sleep(args.interval)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,17 @@
 import os
+import sys
+import json
+import time
 import argparse
 import numpy
 from vectorize_cli import vectorize
+from vectorize_cli.backends.precision import PRECISIONS
+from vectorize_cli.vector_file import VectorFile
+from vectorize_cli import server
+from vectorize_cli import search
+from vectorize_cli import ann
+from vectorize_cli.tokens import TokenFile, pretokenize
+from vectorize_cli.input_file import read_records
 
 def distance(v1, v2, distance_type):
     match distance_type:
@@ -10,22 +20,210 @@ def distance(v1, v2, distance_type):
         case 'cosine':
             return (1-numpy.dot(v1, v2) / numpy.linalg.norm(v1) / numpy.linalg.norm(v2))/2
 
+def read_sample(path, count):
+    sample = []
+    for strings in read_records(path):
+        sample.extend(strings)
+        if count is not None and len(sample) >= count:
+            return sample[:count]
+    return sample
+
+def timed_vectors(backend, sample, batch_size):
+    # returns the vectors and the records per second it took to make
+    # them, after a warmup batch
+    backend.process_chunk_to_array(sample[:batch_size])
+    start = time.perf_counter()
+    arrays = [backend.process_chunk_to_array(sample[i:i+batch_size]) for i in range(0, len(sample), batch_size)]
+    return (numpy.concatenate(arrays), len(sample) / (time.perf_counter() - start))
+
+def report_agreement(description, vectors, reference_vectors, rate, reference_rate):
+    similarity = numpy.sum(vectors * reference_vectors, axis=1) / numpy.linalg.norm(vectors, axis=1) / numpy.linalg.norm(reference_vectors, axis=1)
+    print(f'{len(vectors)} records, {description}')
+    print(f'cosine similarity: mean {similarity.mean():.5f}, min {similarity.min():.5f}, 1st percentile {numpy.percentile(similarity, 1):.5f}')
+    print(f'records/s: {reference_rate:.2f} -> {rate:.2f} ({rate / reference_rate:.2f}x)')
+
+def check_precision(args):
+    # How much does running at reduced precision change the vectors,
+    # and what does it gain us?
+    sample = read_sample(args.input_file, args.sample)
+    reduced = vectorize.init_backend(args.backend, device=args.device, precision=args.precision)
+    (reduced_vectors, reduced_rate) = timed_vectors(reduced, sample, args.batch_size)
+    del reduced
+    full = vectorize.init_backend(args.backend, device=args.device, precision='fp32')
+    (full_vectors, full_rate) = timed_vectors(full, sample, args.batch_size)
+    report_agreement(f'{args.precision} against fp32', reduced_vectors, full_vectors, reduced_rate, full_rate)
+
+def check_compiled(args):
+    # The compiled backend should make the same vectors as the eager
+    # one, only faster. The compiled one lets go of the eager model,
+    # so that is loaded again.
+    sample = read_sample(args.input_file, args.sample)
+    name = args.backend.removesuffix('-compiled')
+    compiled = vectorize.init_backend(f'{name}-compiled', device=args.device, precision=args.precision, artifact_dir=args.artifact_dir)
+    (compiled_vectors, compiled_rate) = timed_vectors(compiled, sample, args.batch_size)
+    del compiled
+    eager = vectorize.init_backend(name, device=args.device, precision=args.precision)
+    (eager_vectors, eager_rate) = timed_vectors(eager, sample, args.batch_size)
+    report_agreement(f'{name}-compiled against {name}', compiled_vectors, eager_vectors, compiled_rate, eager_rate)
+    print(f'max absolute difference: {numpy.abs(compiled_vectors - eager_vectors).max():.6f}')
+
+def load_generator(args):
+    # How does latency grow as more clients send requests at the same
+    # time, and what throughput does that buy?
+    texts = read_sample(args.input_file, args.sample)
+    client_factory = lambda: server.EmbeddingClient(socket_path=args.socket, host=args.host, port=args.port)
+    print('concurrency\trecords/s\tp50 ms\tp99 ms')
+    for concurrency in args.concurrency:
+        (rate, latencies) = server.load_test(client_factory, texts, concurrency, args.requests, batch=args.batch, query=args.query)
+        print(f'{concurrency}\t{rate:.1f}\t{numpy.percentile(latencies, 50) * 1000:.1f}\t{numpy.percentile(latencies, 99) * 1000:.1f}')
+    print(f'server: {json.dumps(client_factory().stats())}')
+
+def search_vectors(args):
+    queries = list(args.query or [])
+    if args.queries_file is not None:
+        queries.extend(read_sample(args.queries_file, None))
+    if not queries:
+        sys.exit('search needs --query or --queries-file')
+    backend = vectorize.init_backend(args.backend, device=args.device, precision=args.precision, artifact_dir=args.artifact_dir)
+    query_vectors = numpy.concatenate([backend.process_queries_to_array(queries[i:i+100]) for i in range(0, len(queries), 100)])
+    if args.index is not None:
+        index = ann.AnnIndex(args.index)
+        (distances, lines) = index.search(query_vectors, k=args.k, nprobe=args.nprobe)
+        results = [[(index.meta['vectors'], int(line), float(d)) for (line, d) in zip(query_lines, query_distances) if line != -1]
+                   for (query_lines, query_distances) in zip(lines, distances)]
+    elif args.vectors:
+        results = search.search(args.vectors, query_vectors, k=args.k, distance=args.distance,
+                                dimension=args.dimension, threads=args.threads)
+    else:
+        sys.exit('search needs vector files or --index')
+    # one json line per query
+    for (query, result) in zip(queries, results):
+        print(json.dumps({'query': query, 'results': [{'file': path, 'line': line, 'distance': d} for (path, line, d) in result]}))
+
+def index_report(args):
+    # Recall@k and latency of an index at a range of nprobe, against
+    # exact search. Queries are vectors picked from the indexed file,
+    # so no model is needed.
+    index = ann.AnnIndex(args.index)
+    vector_file = VectorFile(index.meta['vectors'], dimension=args.dimension)
+    rng = numpy.random.default_rng(0)
+    queries = vector_file[numpy.sort(rng.choice(len(vector_file), min(args.queries, len(vector_file)), replace=False))]
+
+    start = time.perf_counter()
+    exact = search.search([index.meta['vectors']], queries, k=args.k, distance=index.metric, dimension=args.dimension)
+    exact_latency = (time.perf_counter() - start) / len(queries)
+    exact_lines = [set(line for (_, line, _) in result) for result in exact]
+
+    print(f'{len(queries)} queries, {index.meta["lists"]} lists, pq {index.pq}, k {args.k}')
+    print(f'exact: {exact_latency * 1000:.2f} ms/query')
+    print('nprobe\trecall\tms/query')
+    for nprobe in args.nprobe:
+        start = time.perf_counter()
+        (_, lines) = index.search(queries, k=args.k, nprobe=nprobe)
+        latency = (time.perf_counter() - start) / len(queries)
+        recall = numpy.mean([len(expected & set(found.tolist())) / len(expected) for (expected, found) in zip(exact_lines, lines)])
+        print(f'{nprobe}\t{recall:.4f}\t{latency * 1000:.2f}')
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--backend', type=str, default=os.getenv('VECTORIZER_BACKEND', 'bloom'), help='the backend to use for vectorization')
+    parser.add_argument('--device', type=str, default=os.getenv('VECTORIZER_DEVICE', 'auto'), help='the device to run the model on, like cuda, cpu or auto')
+    parser.add_argument('--precision', choices=PRECISIONS, default=os.getenv('VECTORIZER_PRECISION', 'fp32'), help='the numeric precision to run the model at')
+    parser.add_argument('--artifact-dir', type=str, default=os.getenv('VECTORIZER_ARTIFACT_DIR'), help='where compiled backends keep their compiled models')
     subparsers = parser.add_subparsers(dest='subcommand')
     compare = subparsers.add_parser('compare')
     compare.add_argument('--distance', type=str, default='cosine')
+    compare.add_argument('--vectors', type=str, help='compare the vectors at the given positions in this vector file, rather than vectorizing first and second')
+    compare.add_argument('--dimension', type=int, help='the dimension of the vectors in a raw --vectors file, which has no header to tell')
 
     compare.add_argument('first', type=str)
     compare.add_argument('second', type=str)
+
+    precision = subparsers.add_parser('check-precision', help='compare vectors and speed at --precision against fp32')
+    precision.add_argument('--sample', type=int, default=1000, help='the amount of records to compare')
+    precision.add_argument('--batch-size', type=int, default=100)
+    precision.add_argument('input_file', type=str, help='a json-lines file to take the sample from')
+
+    compiled = subparsers.add_parser('check-compiled', help='compare vectors and speed of the compiled backend against the eager one')
+    compiled.add_argument('--sample', type=int, default=1000, help='the amount of records to compare')
+    compiled.add_argument('--batch-size', type=int, default=100)
+    compiled.add_argument('input_file', type=str, help='a json-lines file to take the sample from')
+
+    search_parser = subparsers.add_parser('search', help='find the vectors nearest to queries in vector files')
+    search_parser.add_argument('--query', type=str, action='append', help='a query to search for (can be given more than once)')
+    search_parser.add_argument('--queries-file', type=str, help='a json-lines file of queries to search for')
+    search_parser.add_argument('-k', type=int, default=10, help='the amount of results per query')
+    search_parser.add_argument('--distance', choices=['cosine', 'euclidean'], default='cosine')
+    search_parser.add_argument('--dimension', type=int, help='the dimension of the vectors in raw vector files, which have no header to tell')
+    search_parser.add_argument('--threads', type=int, help='the amount of threads scoring blocks of vectors')
+    search_parser.add_argument('--index', type=str, help='search an index made with manage index instead of vector files')
+    search_parser.add_argument('--nprobe', type=int, default=8, help='the amount of index lists to search')
+    search_parser.add_argument('vectors', type=str, nargs='*', help='the vector files to search')
+
+    report = subparsers.add_parser('index-report', help='measure recall and latency of an index against exact search')
+    report.add_argument('--queries', type=int, default=200, help='the amount of vectors from the indexed file to search for')
+    report.add_argument('-k', type=int, default=10)
+    report.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    report.add_argument('--dimension', type=int, help='the dimension of the vectors in a raw vector file, which has no header to tell')
+    report.add_argument('index', type=str, help='the index directory')
+
+    serve = subparsers.add_parser('serve', help='keep the model loaded and serve embeddings over http')
+    serve.add_argument('--socket', type=str, help='listen on this unix socket instead of a tcp port')
+    serve.add_argument('--host', type=str, default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--max-batch', type=int, default=64, help='the most strings to vectorize in one batch')
+    serve.add_argument('--max-wait', type=float, default=5, help='the most milliseconds a request waits for others to batch with')
+
+    pretokenize_parser = subparsers.add_parser('pretokenize', help='tokenize a json-lines file into token files, without etcd')
+    pretokenize_parser.add_argument('input_file', type=str)
+    pretokenize_parser.add_argument('tokens', type=str, help='the token files directory')
+    pretokenize_parser.add_argument('--field', type=str, help='take the text from this dotted path in json object records')
+
+    token_stats = subparsers.add_parser('token-stats', help='show the distribution of record lengths in token files')
+    token_stats.add_argument('tokens', type=str, help='the token files directory')
+
+    loadgen = subparsers.add_parser('loadgen', help='measure throughput and latency of a running server')
+    loadgen.add_argument('--socket', type=str, help='the unix socket the server listens on')
+    loadgen.add_argument('--host', type=str, default='127.0.0.1')
+    loadgen.add_argument('--port', type=int, default=8000)
+    loadgen.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64], help='the amounts of concurrent clients to measure')
+    loadgen.add_argument('--requests', type=int, default=1000, help='the amount of requests at every concurrency')
+    loadgen.add_argument('--batch', type=int, default=1, help='the amount of texts in a request')
+    loadgen.add_argument('--sample', type=int, default=1000, help='the amount of records to take texts from')
+    loadgen.add_argument('--query', action='store_true', help='send texts as queries')
+    loadgen.add_argument('input_file', type=str, help='a json-lines file to take texts from')
     args = parser.parse_args()
 
     match args.subcommand:
+        case 'compare' if args.vectors is not None:
+            vectors = VectorFile(args.vectors, dimension=args.dimension)
+            print(distance(vectors[int(args.first)], vectors[int(args.second)], args.distance))
         case 'compare':
-            backend = vectorize.init_backend(args.backend)
+            backend = vectorize.init_backend(args.backend, device=args.device, precision=args.precision, artifact_dir=args.artifact_dir)
             chunk = [args.first, args.second]
             array = backend.process_chunk_to_array(chunk)
             print(distance(array[0],array[1], args.distance))
+        case 'check-precision':
+            if args.precision == 'fp32':
+                sys.exit('check-precision needs a --precision other than fp32')
+            check_precision(args)
+        case 'check-compiled':
+            check_compiled(args)
+        case 'search':
+            search_vectors(args)
+        case 'index-report':
+            index_report(args)
+        case 'serve':
+            backend = vectorize.init_backend(args.backend, device=args.device, precision=args.precision, artifact_dir=args.artifact_dir)
+            server.serve(backend, socket_path=args.socket, host=args.host, port=args.port,
+                         max_batch=args.max_batch, max_wait=args.max_wait / 1000)
+        case 'pretokenize':
+            backend = vectorize.init_backend(args.backend, device='cpu', precision=args.precision, artifact_dir=args.artifact_dir)
+            meta = pretokenize(backend, args.input_file, args.tokens, field=args.field)
+            print(json.dumps(meta))
+        case 'token-stats':
+            print(json.dumps(TokenFile(args.tokens).statistics()))
+        case 'loadgen':
+            load_generator(args)
         case _:
             parser.print_help()
@@ -1,14 +1,23 @@
 import sys
+import copy
+import threading
+import numpy
 import torch
 import json
-from transformers import AutoModel, AutoTokenizer, BloomModel
+from tokenizers.processors import TemplateProcessing
+from transformers import AutoModel, AutoTokenizer, BloomModel, BatchEncoding
 
 from .model import ModelBackend
+from .precision import apply_precision
 
 boq, eoq, bod, eod = '[BOQ]', '[EOQ]', '[BOD]', '[EOD]'
 class BloomBackend(ModelBackend):
-    def __init__(self):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    name = 'bloom'
+
+    def __init__(self, device='auto', precision='fp32'):
+        if device == 'auto':
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
         self.cpu_device = torch.device("cpu")
         print(f"Using device: {self.device}")
 
@@ -18,9 +27,14 @@ class BloomBackend(ModelBackend):
         print(self.tokenizer)
         print("loading model")
         #model = AutoModel.from_pretrained('izhx/udever-bloom-560m', device_map='auto').cuda()
-        self.model = BloomModel.from_pretrained('izhx/udever-bloom-560m', device_map='auto').cuda()
+        self.model = BloomModel.from_pretrained('izhx/udever-bloom-560m').to(self.device)
+        self.model.eval()
+        self.model = apply_precision(self.model, precision, self.device)
+        self.precision = precision
         print(self.model)
         print("loaded")
+        self.revision = getattr(self.model.config, '_commit_hash', None)
+        self.dimension = self.model.config.hidden_size
 
         self.eoq_id, self.eod_id = self.tokenizer.convert_tokens_to_ids([eoq, eod])
 
@@ -28,25 +42,128 @@ class BloomBackend(ModelBackend):
             print('!!!', self.tokenizer.padding_side)
             self.tokenizer.padding_side = 'left'
 
+        self.local = threading.local()
 
-    def encode(self, texts: list, is_query: bool = False, max_length=2048):
+    def thread_encoder(self, max_length, eos, padding=False):
+        # The rust tokenizer underneath the fast tokenizer, set up to
+        # truncate to max_length, append eos and optionally pad on the
+        # left, so it makes the model input all by itself. The end
+        # marker is added by a post-processor, so truncation leaves
+        # room for it. encode_batch tokenizes the strings of a batch
+        # in parallel without holding the GIL.
+        #
+        # Truncation and padding settings are mutable state, so
+        # sharing one between threads that tokenize differently
+        # fails. Every thread gets its own copy per setting.
+        encoders = getattr(self.local, 'encoders', None)
+        if encoders is None:
+            encoders = self.local.encoders = {}
+        key = (max_length, eos, padding)
+        encoder = encoders.get(key)
+        if encoder is None:
+            encoder = copy.deepcopy(self.tokenizer.backend_tokenizer)
+            encoder.enable_truncation(max_length, strategy='longest_first', direction=self.tokenizer.truncation_side)
+            encoder.post_processor = TemplateProcessing(single=f'$A {eos}', special_tokens=[(eos, self.tokenizer.convert_tokens_to_ids(eos))])
+            if padding:
+                encoder.enable_padding(direction='left', pad_id=self.tokenizer.pad_token_id, pad_token=self.tokenizer.pad_token)
+            else:
+                encoder.no_padding()
+            encoders[key] = encoder
+        return encoder
+
+    def token_lengths(self, strings, max_length=2048):
+        return [len(encoding) for encoding in self.thread_encoder(max_length, eod).encode_batch([bod + s for s in strings])]
+
+    def tokenize(self, texts: list, is_query: bool = False, max_length=2048):
+        # The same as tokenizing with padding=True and appending the
+        # end marker to every row, in a single pass of the rust
+        # tokenizer.
         bos = boq if is_query else bod
-        eos_id = self.eoq_id if is_query else self.eod_id
-        texts = [bos + t for t in texts]
-        encoding = self.tokenizer(
-            texts, truncation=True, max_length=max_length - 1, padding=True
-        )
-        for ids, mask in zip(encoding['input_ids'], encoding['attention_mask']):
-            ids.append(eos_id)
-            mask.append(1)
-        inputs = self.tokenizer.pad(encoding, return_tensors='pt')
+        eos = eoq if is_query else eod
+        encodings = self.thread_encoder(max_length, eos, padding=True).encode_batch([bos + t for t in texts])
+        return padded_tensors(encodings)
+
+    def tokens_id(self):
+        return f'{self.name}@{self.revision}'
+
+    def encode_tokens(self, strings, max_length=2048):
+        # documents as tokenize makes them, end marker included
+        return [encoding.ids for encoding in self.thread_encoder(max_length, eod).encode_batch([bod + s for s in strings])]
+
+    def prepare_tokens(self, rows):
+        return left_padded(rows, self.tokenizer.pad_token_id)
+
+    def embed(self, inputs):
         inputs = inputs.to(self.device)
         with torch.inference_mode():
             outputs = self.model(**inputs)
-            embeds = outputs.last_hidden_state[:, -1]
+            # clone so the full hidden state can be freed while the
+            # embeddings wait to be copied to the host
+            embeds = outputs.last_hidden_state[:, -1].clone()
         return embeds
 
+    def export_module(self):
+        # the model as a module from input ids and attention mask to
+        # embeddings, for CompiledBackend to export
+        return BloomEmbedding(self.model)
+
+    def export_inputs(self, inputs):
+        return (inputs['input_ids'], inputs['attention_mask'])
+
+    def encode(self, texts: list, is_query: bool = False, max_length=2048):
+        return self.embed(self.tokenize(texts, is_query, max_length))
+
+    def prepare_chunk(self, strings):
+        return self.tokenize(strings)
+
+    def prepare_queries(self, strings):
+        return self.tokenize(strings, is_query=True)
+
+    def infer_prepared(self, inputs):
+        return self.embed(inputs)
+
+    def output_to_array(self, tensor):
+        # numpy has no bfloat16
+        return tensor.to(self.cpu_device).float().numpy()
+
+    def is_out_of_memory(self, error):
+        return super().is_out_of_memory(error) or isinstance(error, torch.cuda.OutOfMemoryError)
+
+    def release_memory(self):
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def release_model(self):
+        self.model = None
+
     def process_chunk_to_array(self, strings):
-        tensor = self.encode(strings)
-        tensor = tensor.to(self.cpu_device)
-        return tensor.numpy().astype('float32')
+        return self.output_to_array(self.encode(strings))
+
+def padded_tensors(encodings):
+    # input ids and attention mask of encodings the tokenizer padded
+    # to the same length
+    width = len(encodings[0]) if encodings else 0
+    input_ids = numpy.array([encoding.ids for encoding in encodings], dtype=numpy.int64).reshape(len(encodings), width)
+    attention_mask = numpy.array([encoding.attention_mask for encoding in encodings], dtype=numpy.int64).reshape(len(encodings), width)
+    return BatchEncoding({'input_ids': torch.from_numpy(input_ids), 'attention_mask': torch.from_numpy(attention_mask)})
+
+def left_padded(rows, pad_id):
+    # input ids and attention mask for rows of token ids, padded on the
+    # left to the longest row
+    lengths = numpy.array([len(row) for row in rows], dtype=numpy.int64)
+    width = int(lengths.max()) if len(rows) else 0
+    attention_mask = (numpy.arange(width)[None, :] >= (width - lengths)[:, None]).astype(numpy.int64)
+    input_ids = numpy.full((len(rows), width), pad_id, dtype=numpy.int64)
+    if len(rows):
+        # the mask is set right where the tokens go, row by row
+        input_ids[attention_mask.astype(bool)] = numpy.concatenate(rows)
+    return BatchEncoding({'input_ids': torch.from_numpy(input_ids), 'attention_mask': torch.from_numpy(attention_mask)})
+
+class BloomEmbedding(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)
+        return outputs[0][:, -1]
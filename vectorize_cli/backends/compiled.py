@@ -0,0 +1,135 @@
+import os
+import sys
+import numpy
+import torch
+import transformers
+
+from .model import ModelBackend
+
+# batches the compiled model is compared against the eager one on,
+# as lengths in words, so that it is checked on varied shapes and
+# padding before it is used
+PARITY_BATCHES = [[5], [1, 30], [3, 3, 200, 17], [500, 2, 60, 60, 1, 9, 120, 8]]
+# how far the vectors may be apart, relative to their largest element
+TOLERANCES = {'fp32': 1e-4, 'bf16': 2e-2, 'int8': 1e-3}
+
+def default_artifact_dir():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'vectorize-cli', 'compiled')
+
+class CompiledBackend(ModelBackend):
+    # Runs another backend's model as an exported graph. The graph is
+    # exported the first time and kept on disk, keyed by model,
+    # revision, precision, device and the versions of torch and
+    # transformers, so later runs load it instead of exporting again.
+    # Without a revision, the model can't be told apart from other
+    # versions of it, so it is exported every time. Tokenization and
+    # turning output into arrays are left to the eager backend.
+    #
+    # The batch size and sequence length are dynamic in the graph, and
+    # export refuses models that branch on their input rather than
+    # baking one branch in. Whether exported or loaded, the graph is
+    # compared against the eager model on PARITY_BATCHES before it is
+    # used. Once it is, the eager backend lets go of its weights.
+    def __init__(self, eager, artifact_dir=None):
+        self.eager = eager
+        self.name = f'{eager.name}-compiled'
+        self.revision = eager.revision
+        self.precision = eager.precision
+        self.dimension = eager.dimension
+        self.device = eager.device
+        if artifact_dir is None:
+            artifact_dir = default_artifact_dir()
+        path = None
+        if eager.revision is not None:
+            path = os.path.join(artifact_dir, f'{eager.name}-{eager.revision}-{eager.precision}-{self.device.type}'
+                                              f'-torch{torch.__version__}-transformers{transformers.__version__}.pt2')
+        self.module = None
+        if path is not None and os.path.exists(path):
+            print(f'loading compiled model {path}', file=sys.stderr)
+            self.module = torch.export.load(path).module()
+            try:
+                self.check_parity()
+            except ValueError as e:
+                print(f'not using {path}: {e}', file=sys.stderr)
+                self.module = None
+        if self.module is None:
+            print('compiling model' + (f' to {path}' if path is not None else ', which has no revision to keep it by'), file=sys.stderr)
+            exported = self.compile()
+            self.module = exported.module()
+            self.check_parity()
+            if path is not None:
+                self.save(exported, path)
+        eager.release_model()
+
+    def compile(self):
+        example = self.eager.export_inputs(self.eager.prepare_chunk(['an example', 'a somewhat longer example, with punctuation']))
+        example = tuple(tensor.to(self.device) for tensor in example)
+        # export treats sizes of 0 and 1 as special, so dynamic sizes
+        # start at 2. infer_prepared doubles up batches of one.
+        batch = torch.export.Dim('batch')
+        length = torch.export.Dim('length')
+        dynamic_shapes = ({0: batch, 1: length}, {0: batch, 1: length})
+        with torch.no_grad():
+            return torch.export.export(self.eager.export_module().eval(), example, dynamic_shapes=dynamic_shapes)
+
+    def check_parity(self):
+        # raises ValueError if the compiled model makes different
+        # vectors than the eager one
+        tolerance = TOLERANCES.get(self.precision, TOLERANCES['fp32'])
+        for lengths in PARITY_BATCHES:
+            strings = [' '.join(['example'] * length) for length in lengths]
+            prepared = self.eager.prepare_chunk(strings)
+            expected = self.eager.output_to_array(self.eager.infer_prepared(prepared))
+            actual = self.output_to_array(self.infer_prepared(prepared))
+            difference = numpy.abs(actual - expected).max() / max(numpy.abs(expected).max(), 1e-6)
+            if not difference <= tolerance:
+                raise ValueError(f'compiled model differs from {self.eager.name} by {difference:.2e} on a batch of lengths {lengths}')
+
+    def save(self, exported, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # saved under a temporary name, as other processes may be
+        # compiling the same model at the same time. torch wants the
+        # .pt2 extension.
+        tmp_path = f'{path.removesuffix(".pt2")}.{os.getpid()}.tmp.pt2'
+        try:
+            torch.export.save(exported, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f'could not save compiled model {path}: {e}', file=sys.stderr)
+
+    def token_lengths(self, strings):
+        return self.eager.token_lengths(strings)
+
+    def prepare_chunk(self, strings):
+        return self.eager.prepare_chunk(strings)
+
+    def prepare_queries(self, strings):
+        return self.eager.prepare_queries(strings)
+
+    def tokens_id(self):
+        return self.eager.tokens_id()
+
+    def encode_tokens(self, strings):
+        return self.eager.encode_tokens(strings)
+
+    def prepare_tokens(self, rows):
+        return self.eager.prepare_tokens(rows)
+
+    def infer_prepared(self, prepared):
+        inputs = tuple(tensor.to(self.device) for tensor in self.eager.export_inputs(prepared))
+        with torch.inference_mode():
+            if inputs[0].shape[0] == 1:
+                return self.module(*(torch.cat([tensor, tensor]) for tensor in inputs))[:1]
+            return self.module(*inputs)
+
+    def output_to_array(self, output):
+        return self.eager.output_to_array(output)
+
+    def is_out_of_memory(self, error):
+        return self.eager.is_out_of_memory(error)
+
+    def release_memory(self):
+        self.eager.release_memory()
+
+    def process_chunk_to_array(self, strings):
+        return self.output_to_array(self.infer_prepared(self.prepare_chunk(strings)))
@@ -1,4 +1,104 @@
+from vectorize_cli.batching import current_rss
+
 class ModelBackend:
-    def process_chunk(self, strings, fp):
-        array = self.process_chunk_to_array(strings)
-        array.tofile(fp)
+    # Processing a chunk is split up in three steps so that the
+    # vectorizer can run them on different threads:
+    # - prepare_chunk turns strings into model input (tokenization)
+    # - infer_prepared runs the model on prepared input
+    # - output_to_array turns model output into a numpy array
+    # Backends that don't override these just do everything in
+    # infer_prepared.
+    name = None
+    revision = None
+    # one of fp32, bf16 or int8
+    precision = 'fp32'
+    # the amount of dimensions of the vectors this backend makes
+    dimension = None
+    # an EmbeddingCache, if vectors should be cached
+    cache = None
+
+    def cache_id(self):
+        # what vectors made by this backend are stored under in the
+        # embedding cache. Reduced precision vectors are close to, but
+        # not the same as, fp32 ones, so they are kept apart.
+        if self.precision == 'fp32':
+            return f'{self.name}@{self.revision}'
+        return f'{self.name}@{self.revision}/{self.precision}'
+
+    def describe(self):
+        # recorded in tasks, so it's known what produced their vectors
+        return {'backend': self.name, 'revision': self.revision, 'precision': self.precision}
+
+    def vector_bytes(self):
+        # vectors are written as float32
+        return self.dimension * 4
+
+    def tokens_id(self):
+        # what pretokenized input for this backend is made for, or None
+        # if it can't take any. Unlike for the cache, precision doesn't
+        # matter.
+        return None
+
+    def encode_tokens(self, strings):
+        # model input token ids for every string, to be pretokenized
+        raise NotImplementedError(f'{self.name} cannot take pretokenized input')
+
+    def prepare_tokens(self, rows):
+        # like prepare_chunk, for token ids made by encode_tokens
+        raise NotImplementedError(f'{self.name} cannot take pretokenized input')
+
+    def token_lengths(self, strings):
+        # used to group records of similar length into the same
+        # batch. Backends that know their tokenizer should override
+        # this, the string length is a reasonable fallback.
+        return [len(s) for s in strings]
+
+    def prepare_chunk(self, strings):
+        return strings
+
+    def prepare_queries(self, strings):
+        # like prepare_chunk, for search queries rather than documents,
+        # for models that embed those differently
+        return self.prepare_chunk(strings)
+
+    def infer_prepared(self, prepared):
+        return self.process_chunk_to_array(prepared)
+
+    def output_to_array(self, output):
+        return output
+
+    def is_out_of_memory(self, error):
+        return isinstance(error, MemoryError)
+
+    def release_memory(self):
+        # called after running out of memory, before retrying
+        pass
+
+    def late_out_of_memory(self):
+        # the sizes of batches that ran out of memory since the last
+        # call, for backends that only find out in output_to_array and
+        # retry them there
+        return []
+
+    def resident_memory(self):
+        # the memory held for running the model, for --max-rss
+        return current_rss()
+
+    def release_model(self):
+        # called by CompiledBackend once it has its own copy of the
+        # model, after which this backend only tokenizes and turns
+        # outputs into arrays
+        pass
+
+    def process_queries_to_array(self, strings):
+        return self.output_to_array(self.infer_prepared(self.prepare_queries(strings)))
+
+    def process_chunk(self, strings, fp, vector_format=None):
+        if self.cache is None:
+            array = self.process_chunk_to_array(strings)
+        else:
+            array = self.cache.process(self.cache_id(), strings, self.process_chunk_to_array)
+        if vector_format is None:
+            array.tofile(fp)
+        else:
+            vector_format.write(fp, array)
@@ -1,10 +1,95 @@
+import threading
+import numpy
+import torch
 from sentence_transformers import SentenceTransformer
 
 from .model import ModelBackend
+from .precision import apply_precision
+
+# what the model card says to put in front of queries for retrieval
+QUERY_PROMPT = 'Represent this sentence for searching relevant passages: '
 
 class MxbaiBackend(ModelBackend):
-    def __init__(self):
-        self.model = SentenceTransformer("mixedbread-ai/mxbai-embed-large-v1").cuda()
+    name = 'mxbai'
+
+    def __init__(self, device='auto', precision='fp32'):
+        if device == 'auto':
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.model = SentenceTransformer("mixedbread-ai/mxbai-embed-large-v1", device=device)
+        self.model.eval()
+        self.model = apply_precision(self.model, precision, self.device)
+        self.precision = precision
+        self.revision = getattr(self.model[0].auto_model.config, '_commit_hash', None)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        # the tokenizer is shared by everything using the model, so
+        # tokenizer threads take turns.
+        self.tokenizer_lock = threading.Lock()
+
+    def token_lengths(self, strings):
+        with self.tokenizer_lock:
+            encoding = self.model.tokenizer(strings, truncation=True, max_length=self.model.max_seq_length)
+        return [len(ids) for ids in encoding['input_ids']]
+
+    def tokens_id(self):
+        return f'{self.name}@{self.revision}'
+
+    def encode_tokens(self, strings):
+        # sentence transformers strips strings before tokenizing
+        with self.tokenizer_lock:
+            encoding = self.model.tokenizer([s.strip() for s in strings], truncation=True, max_length=self.model.max_seq_length)
+        return encoding['input_ids']
+
+    def prepare_tokens(self, rows):
+        tokenizer = self.model.tokenizer
+        with self.tokenizer_lock:
+            features = tokenizer.pad({'input_ids': [numpy.asarray(row).tolist() for row in rows]}, return_tensors='pt')
+        if 'token_type_ids' in tokenizer.model_input_names:
+            features['token_type_ids'] = torch.zeros_like(features['input_ids'])
+        return dict(features)
+
+    def prepare_chunk(self, strings):
+        with self.tokenizer_lock:
+            return self.model.tokenize(strings)
+
+    def prepare_queries(self, strings):
+        return self.prepare_chunk([QUERY_PROMPT + s for s in strings])
+
+    def infer_prepared(self, features):
+        features = {key: value.to(self.device) for (key, value) in features.items()}
+        with torch.inference_mode():
+            return self.model(features)['sentence_embedding']
+
+    def export_module(self):
+        # the model as a module from input ids and attention mask to
+        # embeddings, for CompiledBackend to export
+        return MxbaiEmbedding(self.model)
+
+    def export_inputs(self, features):
+        return (features['input_ids'], features['attention_mask'])
+
+    def output_to_array(self, tensor):
+        return tensor.cpu().float().numpy()
+
+    def is_out_of_memory(self, error):
+        return super().is_out_of_memory(error) or isinstance(error, torch.cuda.OutOfMemoryError)
+
+    def release_memory(self):
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def release_model(self):
+        # the tokenizer is part of the first module, so only the
+        # transformer goes
+        self.model[0].auto_model = None
 
     def process_chunk_to_array(self, strings):
-        return self.model.encode(strings)
+        return self.output_to_array(self.model.encode(strings, convert_to_tensor=True))
+
+class MxbaiEmbedding(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model({'input_ids': input_ids, 'attention_mask': attention_mask})['sentence_embedding']
@@ -0,0 +1,22 @@
+import torch
+
+# The numeric precisions a model can be run at. Anything other than
+# fp32 trades a little accuracy for speed and memory.
+# - bf16 converts the weights, and so everything computed with them,
+#   to bfloat16
+# - int8 dynamically quantizes the linear layers, which is only
+#   supported on cpu
+PRECISIONS = ['fp32', 'bf16', 'int8']
+
+def apply_precision(model, precision, device):
+    match precision:
+        case 'fp32':
+            return model
+        case 'bf16':
+            return model.to(torch.bfloat16)
+        case 'int8':
+            if device.type != 'cpu':
+                raise ValueError(f'int8 precision is not supported on {device.type}')
+            return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        case _:
+            raise ValueError(f'unknown precision {precision}')
@@ -0,0 +1,125 @@
+import os
+import numpy
+
+def length_sorted_batches(lengths, batch_size):
+    # Group the indices of a window of records into batches of
+    # similar length, so that padding each batch to its longest
+    # member wastes as little compute as possible. The sort is stable
+    # so equal lengths keep their input order.
+    order = numpy.argsort(numpy.asarray(lengths), kind='stable')
+    for offset in range(0, len(order), batch_size):
+        yield order[offset:offset+batch_size]
+
+def token_budget_batches(lengths, token_budget):
+    # Like length_sorted_batches, but rather than a fixed amount of
+    # records, every batch gets as many records as fit in the budget
+    # of padded tokens. A record that doesn't fit in the budget on its
+    # own still gets a batch to itself.
+    lengths = numpy.asarray(lengths)
+    order = numpy.argsort(lengths, kind='stable')
+    start = 0
+    for end in range(1, len(order) + 1):
+        # as the order is ascending, the last record is the longest
+        if end == len(order) or (end - start + 1) * lengths[order[end]] > token_budget:
+            yield order[start:end]
+            start = end
+
+def padded_tokens(lengths, indices):
+    return int(numpy.asarray(lengths)[indices].max()) * len(indices)
+
+# after backing off for max_rss, batches may grow again once the
+# resident memory is back below this fraction of it
+RSS_LOW = 0.9
+
+def current_rss(pid='self'):
+    with open(f'/proc/{pid}/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+class AdaptiveBatcher:
+    # Decides how to split a window into batches. With a fixed batch
+    # size, every batch gets that many records. With a token budget,
+    # batches are limited by their padded token count instead, and
+    # the budget moves between min_tokens and max_tokens, growing
+    # while forward passes are faster than target_latency seconds and
+    # shrinking when they're slower.
+    #
+    # Running out of memory halves the batch size or the budget. The
+    # budget won't grow back to the size that failed.
+    #
+    # Going over max_rss halves them too, once per crossing. They grow
+    # back once the resident memory is below RSS_LOW of it again, as
+    # that memory may well have been held by something else.
+    def __init__(self, batch_size, max_tokens=None, target_latency=1.0, min_tokens=2048, max_rss=None):
+        self.batch_size = batch_size
+        self.max_batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.target_latency = target_latency
+        self.max_rss = max_rss
+        self.over_rss = False
+        if max_tokens is not None:
+            self.token_budget = max(min_tokens, max_tokens // 4)
+        else:
+            self.token_budget = None
+
+    def batches(self, lengths):
+        if self.token_budget is None:
+            return length_sorted_batches(lengths, self.batch_size)
+        else:
+            return token_budget_batches(lengths, self.token_budget)
+
+    def observe(self, batch_count, duration):
+        # called with the amount of forward passes in a window and the
+        # time they took together
+        if self.token_budget is None or batch_count == 0:
+            return
+        latency = duration / batch_count
+        if latency < self.target_latency * 0.8 and not self.over_rss:
+            self.token_budget = min(self.max_tokens, int(self.token_budget * 1.25))
+        elif latency > self.target_latency * 1.2:
+            self.token_budget = max(self.min_tokens, int(self.token_budget * 0.8))
+
+    def check_memory(self, rss=current_rss):
+        # called after every forward pass, with what tells the resident
+        # memory. Returns whether it backed off.
+        if self.max_rss is None:
+            return False
+        rss = rss()
+        if not self.over_rss and rss > self.max_rss:
+            self.over_rss = True
+            self.batch_size = max(1, self.batch_size // 2)
+            if self.token_budget is not None:
+                self.token_budget = max(self.min_tokens, self.token_budget // 2)
+            return True
+        if self.over_rss and rss < self.max_rss * RSS_LOW:
+            # the token budget grows back through observe
+            self.over_rss = False
+            self.batch_size = self.max_batch_size
+        return False
+
+    def out_of_memory(self, failed_tokens, failed_size):
+        # failed_tokens may be None if they aren't known, in which case
+        # the budget is taken to be what failed
+        if self.token_budget is None:
+            self.batch_size = self.max_batch_size = max(1, min(self.batch_size, failed_size) // 2)
+        else:
+            if failed_tokens is None:
+                failed_tokens = self.token_budget
+            self.max_tokens = max(self.min_tokens, min(self.max_tokens, failed_tokens) * 9 // 10)
+            self.token_budget = max(self.min_tokens, min(self.token_budget, failed_tokens) // 2)
+
+class WindowResult:
+    # Collects the vectors for a window of records that was processed
+    # out of order, so that they can be written back in input order.
+    def __init__(self, size):
+        self.size = size
+        self.array = None
+
+    def scatter(self, indices, array):
+        if self.array is None:
+            self.array = numpy.empty((self.size,) + array.shape[1:], dtype=array.dtype)
+        self.array[indices] = array
+
+    def tofile(self, fp, vector_format):
+        if self.array is not None:
+            vector_format.write(fp, self.array)
@@ -0,0 +1,107 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy
+
+# sqlite has a limit on the amount of variables in a statement
+LOOKUP_BATCH = 500
+# last_used is only for eviction, so it isn't updated for vectors that
+# were used less than this many seconds ago
+LAST_USED_RESOLUTION = 60
+
+class EmbeddingCache:
+    # An on-disk cache of embeddings, shared between tasks (and
+    # between worker processes on the same machine). Vectors are keyed
+    # by the backend that made them and a hash of the text, so the
+    # same text from a different model or model revision never hits.
+    #
+    # When the cache grows beyond max_bytes, the least recently used
+    # vectors are evicted until it is back at 90% of that.
+    def __init__(self, path, max_bytes=10*1024*1024*1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS vectors (
+                                       model TEXT NOT NULL,
+                                       hash BLOB NOT NULL,
+                                       vector BLOB NOT NULL,
+                                       last_used REAL NOT NULL,
+                                       PRIMARY KEY (model, hash))''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS vectors_last_used ON vectors (last_used)')
+        self.size = self._stored_bytes()
+
+    def _stored_bytes(self):
+        (size,) = self.connection.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM vectors').fetchone()
+        return size
+
+    @staticmethod
+    def hash(text):
+        return hashlib.sha256(text.encode('utf-8')).digest()
+
+    def lookup(self, model, strings):
+        # returns a list with a vector or None for every string
+        hashes = [EmbeddingCache.hash(s) for s in strings]
+        found = {}
+        stale = []
+        now = time.time()
+        with self.lock:
+            for offset in range(0, len(hashes), LOOKUP_BATCH):
+                batch = list(set(hashes[offset:offset+LOOKUP_BATCH]))
+                placeholders = ','.join('?' * len(batch))
+                rows = self.connection.execute(f'SELECT hash, vector, last_used FROM vectors WHERE model = ? AND hash IN ({placeholders})',
+                                               [model] + batch).fetchall()
+                for (h, vector, last_used) in rows:
+                    found[h] = vector
+                    if last_used < now - LAST_USED_RESOLUTION:
+                        stale.append((now, model, h))
+            if stale:
+                # in one transaction, rather than committing every row
+                self.connection.execute('BEGIN')
+                self.connection.executemany('UPDATE vectors SET last_used = ? WHERE model = ? AND hash = ?', stale)
+                self.connection.execute('COMMIT')
+
+        return [numpy.frombuffer(found[h], dtype='float32') if h in found else None for h in hashes]
+
+    def store(self, model, strings, array):
+        array = numpy.ascontiguousarray(array, dtype='float32')
+        now = time.time()
+        rows = [(model, EmbeddingCache.hash(s), vector.tobytes(), now) for (s, vector) in zip(strings, array)]
+        with self.lock:
+            self.connection.execute('BEGIN')
+            self.connection.executemany('INSERT OR REPLACE INTO vectors (model, hash, vector, last_used) VALUES (?, ?, ?, ?)', rows)
+            self.connection.execute('COMMIT')
+            self.size += array.nbytes
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # other processes may be using this cache too, so the size we
+        # have been keeping track of is only an estimate.
+        self.size = self._stored_bytes()
+        if self.size <= self.max_bytes:
+            return
+        (count, size) = self.connection.execute('SELECT COUNT(*), SUM(LENGTH(vector)) FROM vectors').fetchone()
+        to_delete = count - int(count * self.max_bytes * 0.9 / size)
+        self.connection.execute('DELETE FROM vectors WHERE rowid IN (SELECT rowid FROM vectors ORDER BY last_used LIMIT ?)', (to_delete,))
+        self.size = self._stored_bytes()
+
+    def process(self, model, strings, process_chunk_to_array):
+        # Vectorize strings, only handing the ones that aren't cached
+        # to process_chunk_to_array, and each of those only once.
+        vectors = self.lookup(model, strings)
+        misses = {}
+        for (i, vector) in enumerate(vectors):
+            if vector is None:
+                misses.setdefault(strings[i], []).append(i)
+        if misses:
+            missing = list(misses.keys())
+            array = process_chunk_to_array(missing)
+            self.store(model, missing, array)
+            for (string, vector) in zip(missing, array):
+                for i in misses[string]:
+                    vectors[i] = vector
+        return numpy.stack(vectors).astype('float32', copy=False)
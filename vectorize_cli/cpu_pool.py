@@ -0,0 +1,283 @@
+import os
+import sys
+import threading
+import traceback
+import multiprocessing
+import numpy
+from concurrent.futures import Future
+from multiprocessing.shared_memory import SharedMemory
+from queue import Queue, Empty
+
+from vectorize_cli.backends.model import ModelBackend
+from vectorize_cli.batching import current_rss
+
+# Every inference process gets a shared memory buffer for the strings
+# going in and one for the vectors coming out. Batches that don't fit
+# go through the pipe instead, which is slower but always works.
+INPUT_BUFFER_SIZE = 16 * 1024 * 1024
+OUTPUT_BUFFER_SIZE = 64 * 1024 * 1024
+
+def split_cores(processes):
+    # divide the cores we are allowed to run on into equal sets
+    cores = sorted(os.sched_getaffinity(0))
+    if processes > len(cores):
+        print(f'warning: {processes} inference processes share {len(cores)} cores', file=sys.stderr)
+    per_process = max(1, len(cores) // processes)
+    return [cores[i*per_process:(i+1)*per_process] or cores[-per_process:] for i in range(processes)]
+
+def encode_strings(buffer, strings):
+    # Lays out strings as a count, the end offset of every string and
+    # then all of them as utf-8. Returns False if they don't fit.
+    encoded = [s.encode('utf-8') for s in strings]
+    ends = numpy.cumsum([len(e) for e in encoded], dtype='<i8')
+    header_size = 8 * (len(encoded) + 1)
+    size = header_size + (int(ends[-1]) if len(encoded) else 0)
+    if size > len(buffer):
+        return False
+    header = numpy.ndarray((len(encoded) + 1,), dtype='<i8', buffer=buffer)
+    header[0] = len(encoded)
+    header[1:] = ends
+    buffer[header_size:size] = b''.join(encoded)
+    return True
+
+def decode_strings(buffer):
+    count = int(numpy.ndarray((1,), dtype='<i8', buffer=buffer)[0])
+    ends = numpy.ndarray((count,), dtype='<i8', buffer=buffer, offset=8).tolist()
+    header_size = 8 * (count + 1)
+    data = bytes(buffer[header_size:header_size + (ends[-1] if count else 0)])
+    starts = [0] + ends[:-1]
+    return [data[start:end].decode('utf-8') for (start, end) in zip(starts, ends)]
+
+def is_out_of_memory(backend, error):
+    # torch reports running out of memory on cpu as a RuntimeError of
+    # its allocator
+    return backend.is_out_of_memory(error) or (isinstance(error, RuntimeError) and 'DefaultCPUAllocator' in str(error))
+
+def worker_main(init_backend, backend_name, options, cores, connection, input_name, output_name):
+    # This runs in the inference process. Pinning it and telling torch
+    # how many cores it has keeps the processes from fighting over
+    # the same ones.
+    import torch
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    if init_backend is None:
+        from vectorize_cli import vectorize
+        init_backend = vectorize.init_backend
+    backend = init_backend(backend_name, device='cpu', **options)
+    input_buffer = SharedMemory(name=input_name)
+    output_buffer = SharedMemory(name=output_name)
+    connection.send(('ready', backend.dimension, backend.revision))
+
+    # Messages are (kind, payload). Besides vectors, processes give
+    # token lengths, so batches are made the same way as without them.
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        (kind, payload) = message
+        try:
+            if kind == 'lengths':
+                connection.send(('lengths', backend.token_lengths(payload)))
+                continue
+            strings = decode_strings(input_buffer.buf) if kind == 'shared' else payload
+            array = numpy.ascontiguousarray(backend.process_chunk_to_array(strings), dtype='float32')
+            if array.nbytes <= output_buffer.size:
+                numpy.ndarray(array.shape, dtype='float32', buffer=output_buffer.buf)[:] = array
+                connection.send(('shared', array.shape))
+            else:
+                connection.send(('array', array))
+        except Exception as e:
+            out_of_memory = is_out_of_memory(backend, e)
+            if out_of_memory:
+                backend.release_memory()
+            connection.send(('error', (''.join(traceback.format_exception(e)), out_of_memory)))
+
+    input_buffer.close()
+    output_buffer.close()
+
+class InferenceError(Exception):
+    # out_of_memory is whether the process ran out of memory, or died,
+    # which mostly means the kernel killed it for using too much
+    def __init__(self, message, out_of_memory=False):
+        super().__init__(message)
+        self.out_of_memory = out_of_memory
+
+class InferenceProcess:
+    def __init__(self, context, init_backend, backend_name, options, cores):
+        self.cores = cores
+        self.input_buffer = SharedMemory(create=True, size=INPUT_BUFFER_SIZE)
+        self.output_buffer = SharedMemory(create=True, size=OUTPUT_BUFFER_SIZE)
+        (self.connection, child_connection) = context.Pipe()
+        self.process = context.Process(target=worker_main,
+                                       args=(init_backend, backend_name, options, cores, child_connection,
+                                             self.input_buffer.name, self.output_buffer.name),
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.closed = False
+
+    def submit(self, strings):
+        if encode_strings(self.input_buffer.buf, strings):
+            self.connection.send(('shared', None))
+        else:
+            self.connection.send(('strings', strings))
+
+    def receive(self):
+        try:
+            (kind, payload) = self.connection.recv()
+        except EOFError:
+            self.process.join(timeout=10)
+            raise InferenceError(f'inference process on cores {self.cores} exited with {self.process.exitcode}', out_of_memory=True)
+        match kind:
+            case 'shared':
+                return numpy.ndarray(payload, dtype='float32', buffer=self.output_buffer.buf).copy()
+            case 'array' | 'lengths':
+                return payload
+            case 'error':
+                (message, out_of_memory) = payload
+                raise InferenceError(message, out_of_memory=out_of_memory)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.kill()
+        for buffer in (self.input_buffer, self.output_buffer):
+            buffer.close()
+            buffer.unlink()
+
+class CpuPool(ModelBackend):
+    # Runs a backend on CPU in several processes, each pinned to its
+    # own set of cores. On big machines that goes faster than one
+    # process using all cores, as torch's threading stops scaling
+    # well before that.
+    #
+    # infer_prepared hands a batch to an idle process, waiting for one
+    # if they are all busy, and returns a future. output_to_array waits
+    # for that future, so the pipeline's writer collects the results in
+    # order while the processes are already working on later batches.
+    #
+    # A batch that runs out of memory in a process, or kills it, only
+    # shows in output_to_array, after infer_batch is done with it. So
+    # output_to_array retries it in halves itself, and tells the
+    # batcher through late_out_of_memory. A process that died is
+    # started again. The resident memory is that of all processes.
+    #
+    # Token lengths come from the processes too, as only they have the
+    # tokenizer. Tokenizing is quick next to a forward pass, so that
+    # takes little from inference.
+    #
+    # init_backend makes the backend in the processes, from the name
+    # and options. It defaults to vectorize.init_backend, and has to be
+    # a module level function, to get to the processes.
+    def __init__(self, backend_name, processes, init_backend=None, **options):
+        self.name = backend_name
+        self.precision = options.get('precision', 'fp32')
+        self.context = multiprocessing.get_context('spawn')
+        self.init_backend = init_backend
+        self.options = options
+        self.idle = Queue()
+        self.failed_sizes = Queue()
+        self.processes = []
+        for cores in split_cores(processes):
+            print(f'starting inference process on cores {cores}', file=sys.stderr)
+            self.processes.append(InferenceProcess(self.context, init_backend, backend_name, options, cores))
+        for process in self.processes:
+            (_, self.dimension, self.revision) = process.connection.recv()
+            self.idle.put(process)
+        print(f'{processes} inference processes ready', file=sys.stderr)
+
+    def _give_back(self, process):
+        self.idle.put(process if process.process.is_alive() else self._restart(process))
+
+    def _restart(self, process):
+        # a new process in place of one that died, or the dead one if
+        # that fails, so that using it fails rather than hangs
+        print(f'restarting inference process on cores {process.cores}', file=sys.stderr)
+        process.close()
+        replacement = None
+        try:
+            replacement = InferenceProcess(self.context, self.init_backend, self.name, self.options, process.cores)
+            replacement.connection.recv()
+        except Exception as e:
+            print(f'could not restart inference process on cores {process.cores}: {e!r}', file=sys.stderr)
+            if replacement is not None:
+                replacement.close()
+            return process
+        self.processes[self.processes.index(process)] = replacement
+        return replacement
+
+    def token_lengths(self, strings):
+        process = self.idle.get()
+        try:
+            process.connection.send(('lengths', strings))
+            return process.receive()
+        finally:
+            self._give_back(process)
+
+    def infer_prepared(self, strings):
+        process = self.idle.get()
+        future = Future()
+        # kept for retrying in halves
+        future.strings = strings
+        try:
+            process.submit(strings)
+        except Exception as e:
+            self.idle.put(process)
+            raise InferenceError(f'could not submit to inference process on cores {process.cores}') from e
+
+        def collect():
+            try:
+                future.set_result(process.receive())
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self._give_back(process)
+        threading.Thread(target=collect, daemon=True).start()
+        return future
+
+    def output_to_array(self, future):
+        try:
+            return future.result()
+        except Exception as e:
+            strings = future.strings
+            if len(strings) == 1 or not self.is_out_of_memory(e):
+                raise
+        print(f'out of memory on a batch of {len(strings)} in an inference process, retrying in halves', file=sys.stderr)
+        self.failed_sizes.put(len(strings))
+        half = len(strings) // 2
+        return numpy.concatenate([self.output_to_array(self.infer_prepared(part)) for part in (strings[:half], strings[half:])])
+
+    def is_out_of_memory(self, error):
+        return isinstance(error, InferenceError) and error.out_of_memory
+
+    def late_out_of_memory(self):
+        sizes = []
+        while True:
+            try:
+                sizes.append(self.failed_sizes.get_nowait())
+            except Empty:
+                return sizes
+
+    def resident_memory(self):
+        rss = current_rss()
+        for process in self.processes:
+            try:
+                rss += current_rss(process.process.pid)
+            except (FileNotFoundError, ProcessLookupError):
+                # it just died, and will be restarted
+                pass
+        return rss
+
+    def process_chunk_to_array(self, strings):
+        return self.output_to_array(self.infer_prepared(strings))
+
+    def close(self):
+        for process in self.processes:
+            process.close()
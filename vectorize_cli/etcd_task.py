@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 import etcd3
 import json
+import sys
+import threading
+import time
+
+from vectorize_cli.metrics import metrics
 
 class TaskStatusError(Exception):
     def __init__(self, task_id, expected_status, actual_status):
@@ -12,7 +17,7 @@ class TaskStatusError(Exception):
 class TaskTimeoutError(Exception):
     def __init__(self, task_id, message="Task timed out"):
         self.task_id = task_id
-        super().__init__(self.message)
+        super().__init__(message)
 
 class TaskInterrupted(Exception):
     def __init__(self, task_id, reason):
@@ -32,18 +37,108 @@ class Task:
         self.state = self._task_state()
         self.interrupting = False
 
+        # set up by start_background
+        self.background = None
+        self.lease_lost = False
+        self.interrupt_watch = None
+        self.interrupt_reason = None
+        self.watch_broken = False
+        self.released = False
+        self.last_flush = time.monotonic()
+
+    def start_background(self):
+        # Rather than refreshing the lease and asking etcd for
+        # interrupts every time alive() is called, a background
+        # thread keeps the lease alive and a watch tells us about
+        # interrupts. alive() then only has to check some flags.
+        self.background = threading.Event()
+        self.interrupt_watch = self.queue.etcd.add_watch_callback(self.interrupt_key, self._on_interrupt)
+        # an interrupt could have been set before the watch was
+        (reason,_) = self.queue.etcd.get(self.interrupt_key)
+        if reason:
+            self.interrupt_reason = reason
+        threading.Thread(target=self._keep_alive, name=f'keepalive {self.task_id}', daemon=True).start()
+
+    def _stop_background(self):
+        if self.background is not None:
+            self.background.set()
+            self.queue.etcd.cancel_watch(self.interrupt_watch)
+
+    def _keep_alive(self):
+        last_refresh = time.monotonic()
+        while not self.background.wait(self.lease.ttl / 3):
+            try:
+                metrics.count('etcd_round_trips')
+                if self.lease.refresh()[0].TTL == 0:
+                    self.lease_lost = True
+                    return
+                last_refresh = time.monotonic()
+            except Exception as e:
+                # etcd might just be briefly unreachable, but once
+                # the lease would have run out there's no point
+                print(f'refreshing the lease of task {self.task_id} failed: {e}', file=sys.stderr)
+                if time.monotonic() - last_refresh > self.lease.ttl:
+                    self.lease_lost = True
+                    return
+
+    def _on_interrupt(self, response):
+        if isinstance(response, Exception):
+            # the watch broke, so alive() has to ask etcd itself
+            self.watch_broken = True
+            return
+        for event in response.events:
+            if isinstance(event, etcd3.events.PutEvent):
+                self.interrupt_reason = event.value
+
+    def release(self):
+        # safe to call more than once, so whatever leaves a task can
+        # make sure its lease is gone
+        if self.released:
+            return
+        self.released = True
+        self._stop_background()
+        self.lease.revoke()
+
+    def unclaim(self):
+        # Give back a task we claimed but didn't start on. Dropping
+        # the claim alone would leave it out of the queue. Both happen
+        # at once, as a worker that finds the queue key while the
+        # claim is still there deletes the key again.
+        self.queue.etcd.transaction(
+            compare=[],
+            success=[
+                self.queue.etcd.transactions.delete(self.claim_key),
+                self.queue.etcd.transactions.put(f'{self.queue.queue_prefix}{self.task_id}', '')
+            ],
+            failure=[])
+        self.release()
+
     def alive(self):
         # this gets called in various places that do reads and updates
         # to notify etcd that we're still alive. It is also used to
-        # check if someone wants to interrupt us.
-        if self.lease.refresh()[0].TTL == 0:
+        # check if someone wants to interrupt us. With the background
+        # running, this doesn't talk to etcd unless we are actually
+        # interrupted.
+        if self.background is None:
+            metrics.count('etcd_round_trips')
+            with metrics.timed('etcd'):
+                ttl = self.lease.refresh()[0].TTL
+            if ttl == 0:
+                raise TaskTimeoutError(self.task_id)
+        elif self.lease_lost:
             raise TaskTimeoutError(self.task_id)
-        (reason,_) = self.queue.etcd.get(self.interrupt_key)
+
+        if self.background is None or self.watch_broken:
+            metrics.count('etcd_round_trips')
+            with metrics.timed('etcd'):
+                (reason,_) = self.queue.etcd.get(self.interrupt_key)
+        else:
+            reason = self.interrupt_reason
         if reason:
             # set our state to reflect the interruption
             self.interrupt(reason)
             # .. revoke our lease
-            self.lease.revoke()
+            self.release()
             # .. and raise an exception to leave whatever computation we're doing
             raise TaskInterrupted(self.task_id, reason)
 
@@ -75,10 +170,13 @@ class Task:
                 self.queue.etcd.transactions.put(self.task_key, state_string)
             ]
         success_ops.extend(extra_ops)
-        self.queue.etcd.transaction(
-            compare=[],
-            success=success_ops,
-            failure=[])
+        metrics.count('etcd_round_trips')
+        with metrics.timed('etcd'):
+            self.queue.etcd.transaction(
+                compare=[],
+                success=success_ops,
+                failure=[])
+        self.last_flush = time.monotonic()
 
     def status(self):
         return self.state['status']
@@ -100,13 +198,17 @@ class Task:
 
     def finish(self, final_result):
         self.state['result'] = final_result
-        self._transition_to_status('running', 'complete')
-        self.lease.revoke()
+        try:
+            self._transition_to_status('running', 'complete')
+        finally:
+            self.release()
 
     def finish_error(self, error):
         self.state['error'] = error
-        self._transition_to_status('running', 'error')
-        self.lease.revoke()
+        try:
+            self._transition_to_status('running', 'error')
+        finally:
+            self.release()
 
     def interrupt(self, reason):
         self.interrupting = True
@@ -136,9 +238,28 @@ class Task:
     def progress(self):
         return self.state.get('progress')
 
-    def set_progress(self, progress):
+    def checkpoint(self):
+        return self.state.get('checkpoint')
+
+    def set_progress(self, progress, checkpoint=None):
+        # Progress is only written to etcd every progress_interval
+        # seconds. In between, it is kept in the state, which gets
+        # written along with the next status change at the latest.
         self._verify_status('running')
         self.state['progress'] = progress
+        if checkpoint is not None:
+            self.state['checkpoint'] = checkpoint
+        if time.monotonic() - self.last_flush >= self.queue.progress_interval:
+            self._update_task_state()
+        else:
+            self.alive()
+
+    def vectors(self):
+        return self.state.get('vectors')
+
+    def set_vectors(self, description):
+        # what is producing the vectors of this task
+        self.state['vectors'] = description
         self._update_task_state()
 
     def complete(self):
@@ -148,17 +269,21 @@ class Task:
         return self.state.get('error')
 
 def runnable_status(status):
-    return status in ['pending', 'running', 'resuming']
+    # A running task can only be claimed if its worker went away. The
+    # task monitor has to make it resuming before it can be picked up.
+    return status in ['pending', 'resuming']
 
 class TaskQueue:
-    def __init__(self, service_name, identity, **kwargs):
+    def __init__(self, service_name, identity, progress_interval=0, **kwargs):
         self.service_name = service_name
         self.identity = identity
+        self.progress_interval = progress_interval
         self.etcd = etcd3.client(**kwargs)
         self.queue_prefix = f'/services/queue/{service_name}/'
         self.tasks_prefix = f'/services/tasks/{service_name}/'
         self.claims_prefix = f'/services/claims/{service_name}/'
         self.interrupt_prefix = f'/services/interrupt/{service_name}/'
+        self.drain_prefix = f'/services/drain/{service_name}/'
 
     def queue_key_to_task_id(self, queue_key):
         queue_key = queue_key.decode('utf-8')
@@ -191,11 +316,50 @@ class TaskQueue:
         if result:
             task = Task(self, task_id, lease)
             if runnable_status(task.status()):
-                return Task(self, task_id, lease)
+                task.start_background()
+                return task
+            # not for us, so let go of the claim right away
+            task.release()
 
         # explicit default
         return None
 
+    def draining(self):
+        # whether this worker should stop taking tasks, so the
+        # autoscaler can take its node away once the current one is done
+        (value,_) = self.etcd.get(f'{self.drain_prefix}{self.identity}')
+        return value is not None
+
+    def stop_draining(self):
+        # like draining, but when it is, marks the drain as acted on,
+        # so the autoscaler knows not to take it back anymore. The
+        # autoscaler only takes back drains that are still unmarked.
+        drain_key = f'{self.drain_prefix}{self.identity}'
+        (result,_) = self.etcd.transaction(
+            compare=[self.etcd.transactions.version(drain_key) > 0],
+            success=[self.etcd.transactions.put(drain_key, 'stopped')],
+            failure=[])
+        return result
+
+    def release_parent(self, parent_id):
+        # A sharded task waits until all its shards are complete, and
+        # then becomes pending so a worker can merge them. Shards that
+        # finish at the same time could both get here, but only one
+        # of them can replace the waiting state.
+        parent_key = f'{self.tasks_prefix}{parent_id}'
+        (parent_bytes,_) = self.etcd.get(parent_key)
+        parent = json.loads(parent_bytes)
+        if parent['status'] != 'waiting':
+            return
+
+        for shard_id in parent['init']['shards']:
+            (shard_bytes,_) = self.etcd.get(f'{self.tasks_prefix}{shard_id}')
+            if json.loads(shard_bytes)['status'] != 'complete':
+                return
+
+        parent['status'] = 'pending'
+        self.etcd.replace(parent_key, parent_bytes, json.dumps(parent))
+
     def next_task(self):
         # we start out be setting up a watch, cause if we wait until after our query we're potentially gonna have a race condition
         # this is really an issue with this particular library. the underlying protocol can restart watches from a known revision.
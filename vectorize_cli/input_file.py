@@ -0,0 +1,184 @@
+import io
+import os
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from vectorize_cli import s3
+
+# Reading json-lines inputs, which may be compressed with gzip (.gz)
+# or zstd (.zst). Compressed inputs are decompressed as they are read,
+# and offsets into them are offsets into the decompressed stream.
+#
+# To start reading somewhere in the middle, a compressed input has to
+# be decompressed from the start of the gzip member or zstd frame that
+# holds the offset. The input index keeps where every member starts
+# (see DecompressingReader.blocks). Most tools write a single member,
+# so resuming decompresses from the start, which is still quick next
+# to vectorizing, but rules out sharding them (see
+# InputIndex.seekable). Inputs written in independent members or
+# frames (bgzip, pzstd) can be resumed and sharded without that.
+#
+# Inputs can be s3://bucket/key objects too (see s3.py).
+COMPRESSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+READ_SIZE = 1024 * 1024
+
+def compression(path):
+    for (suffix, kind) in COMPRESSIONS.items():
+        if path.endswith(suffix):
+            return kind
+    return None
+
+def new_decompressor(kind):
+    match kind:
+        case 'gzip':
+            return zlib.decompressobj(wbits=31)
+        case 'zstd':
+            if zstandard is None:
+                raise RuntimeError('reading zstd compressed input needs the zstandard package')
+            return zstandard.ZstdDecompressor().decompressobj()
+        case _:
+            raise ValueError(f'unknown compression {kind}')
+
+class DecompressingReader(io.RawIOBase):
+    # A stream of the decompressed contents of a compressed file, from
+    # a member that starts at compressed_offset in the file, and at
+    # offset in the decompressed stream, where fp has to be positioned.
+    # blocks gets a (compressed offset, offset) pair for every member
+    # read.
+    def __init__(self, fp, kind, compressed_offset=0, offset=0):
+        self.fp = fp
+        self.kind = kind
+        # where the file has been read up to
+        self.position = compressed_offset
+        self.decompressor = new_decompressor(kind)
+        self.produced = offset
+        self.blocks = [(compressed_offset, offset)]
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        # decompresses some more, returns False at the end of the file
+        if self.decompressor.eof:
+            data = self.decompressor.unused_data
+            member_start = self.position - len(data)
+            if not data:
+                data = self.fp.read(READ_SIZE)
+                self.position += len(data)
+            if not data:
+                return False
+            self.decompressor = new_decompressor(self.kind)
+            self.blocks.append((member_start, self.produced))
+        else:
+            data = self.fp.read(READ_SIZE)
+            self.position += len(data)
+            if not data:
+                raise EOFError(f'compressed input {self.fp.name} ended in the middle of a member')
+        self.pending = memoryview(self.decompressor.decompress(data))
+        self.produced += len(self.pending)
+        return True
+
+    def readinto(self, buffer):
+        while len(self.pending) == 0:
+            if not self._fill():
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        self.fp.close()
+        super().close()
+
+def stat(path):
+    # (size, modification time in ns) of a file, or (size, version)
+    # of an s3 object (see s3.stat), to tell whether it changed
+    if s3.is_s3(path):
+        return s3.stat(path)
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def open_raw(path, offset=0, end=None):
+    # the file or s3 object as stored, from offset on. end is where
+    # reading will stop, if known, so s3 doesn't read ahead past it.
+    if s3.is_s3(path):
+        return s3.open_reader(path, offset, end)
+    fp = open(path, 'rb')
+    fp.seek(offset)
+    return fp
+
+def open_input(path, offset=0, blocks=None, end=None):
+    # a binary stream of the input from the given offset on. For
+    # compressed inputs, blocks are the member starts from the input
+    # index, if there is one.
+    kind = compression(path)
+    if kind is None:
+        return open_raw(path, offset, end)
+    (compressed_offset, start) = (0, 0)
+    if blocks is not None:
+        for (block_compressed_offset, block_start) in blocks:
+            if block_start > offset:
+                break
+            (compressed_offset, start) = (int(block_compressed_offset), int(block_start))
+    fp = open_raw(path, compressed_offset)
+    stream = io.BufferedReader(DecompressingReader(fp, kind, compressed_offset, start), buffer_size=READ_SIZE)
+    remaining = offset - start
+    while remaining > 0:
+        skipped = len(stream.read(min(remaining, READ_SIZE)))
+        if skipped == 0:
+            break
+        remaining -= skipped
+    return stream
+
+def loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def select(record, field):
+    # the string at a dotted path like text or meta.body in a record
+    if field is not None:
+        for key in field.split('.'):
+            if isinstance(record, list) and key.isdigit() and int(key) < len(record):
+                record = record[int(key)]
+            elif isinstance(record, dict) and key in record:
+                record = record[key]
+            else:
+                raise ValueError(f'record has no {field}')
+    if not isinstance(record, str):
+        raise ValueError('record is not a string' if field is None else f'{field} of record is not a string')
+    return record
+
+def parse_records(lines, field=None):
+    # Parsing many lines at once as one json array saves the overhead
+    # of a call per line. Should that fail, or give the wrong amount of
+    # records because lines weren't json on their own, the lines are
+    # parsed one by one to raise the error for the offending line.
+    try:
+        records = loads(b'[' + b','.join(lines) + b']')
+    except ValueError:
+        records = None
+    if records is None or len(records) != len(lines):
+        records = [loads(line) for line in lines]
+    return [select(record, field) for record in records]
+
+def read_records(path, field=None, batch_size=1024):
+    # the strings of an input, in lists of batch_size
+    with open_input(path) as fp:
+        lines = []
+        for line in fp:
+            lines.append(line)
+            if len(lines) == batch_size:
+                yield parse_records(lines, field)
+                lines = []
+        if len(lines) != 0:
+            yield parse_records(lines, field)
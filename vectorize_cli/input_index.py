@@ -0,0 +1,172 @@
+import os
+import sys
+import mmap
+import struct
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+
+from vectorize_cli import s3
+from vectorize_cli.input_file import DecompressingReader, compression, open_input, open_raw, stat
+
+# An index of where every line of a json-lines input starts, stored
+# next to the input as <input>.idx. The file is a header followed by
+# the line start offsets as little endian int64, with one extra offset
+# at the end for the size of the input. The header records the size
+# and mtime of the input the index was made for, so that a changed
+# input is noticed and reindexed.
+#
+# For compressed inputs, the offsets are in the decompressed input,
+# and after them come the blocks: (compressed offset, offset) int64
+# pairs of where every gzip member or zstd frame starts.
+#
+# Indexes of s3 inputs are kept in a local cache directory instead,
+# VECTORIZER_INDEX_CACHE or ~/.cache/vectorize-cli/index, and record
+# a version made of the ETag in place of the mtime (see s3.stat).
+MAGIC = b'VIDX'
+VERSION = 2
+HEADER = struct.Struct('<4sIqqqq')
+
+BLOCK_SIZE = 64 * 1024 * 1024
+# files smaller than this aren't worth the thread pool
+PARALLEL_THRESHOLD = 4 * BLOCK_SIZE
+
+def index_path(path):
+    if s3.is_s3(path):
+        cache = os.getenv('VECTORIZER_INDEX_CACHE', os.path.expanduser('~/.cache/vectorize-cli/index'))
+        (bucket, key) = s3.split_uri(path)
+        return os.path.join(cache, bucket, f'{key}.idx')
+    return f'{path}.idx'
+
+def _newlines(data, start, end):
+    return numpy.flatnonzero(numpy.frombuffer(data, dtype=numpy.uint8, count=end-start, offset=start) == 10) + start
+
+def line_starts(starts, size):
+    # every line starts after a newline, except for the first one. A
+    # newline at the very end of the file doesn't start a new line.
+    starts = numpy.concatenate([numpy.zeros(1, dtype='<i8')] + starts)
+    if starts[-1] == size:
+        starts = starts[:-1]
+    return numpy.append(starts, size).astype('<i8')
+
+def scan_stream(path):
+    # line offsets and blocks of an input that can only be read from
+    # start to end, like a compressed one or an s3 object
+    with open_raw(path) as fp:
+        kind = compression(path)
+        reader = DecompressingReader(fp, kind) if kind is not None else fp
+        newlines = []
+        size = 0
+        while True:
+            data = reader.read(BLOCK_SIZE)
+            if not data:
+                break
+            newlines.append(_newlines(data, 0, len(data)) + size + 1)
+            size += len(data)
+        blocks = numpy.array(reader.blocks if kind is not None else [], dtype='<i8').reshape(-1, 2)
+    if size == 0:
+        return (numpy.zeros(1, dtype='<i8'), blocks)
+    return (line_starts(newlines, size), blocks)
+
+def scan_line_offsets(path, workers=None):
+    size = os.path.getsize(path)
+    if size == 0:
+        return numpy.zeros(1, dtype='<i8')
+
+    with open(path, 'rb') as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            blocks = [(start, min(start + BLOCK_SIZE, size)) for start in range(0, size, BLOCK_SIZE)]
+            if size < PARALLEL_THRESHOLD:
+                newlines = [_newlines(data, start, end) for (start, end) in blocks]
+            else:
+                # numpy lets go of the GIL while comparing, so this
+                # scales over threads.
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    newlines = list(executor.map(lambda block: _newlines(data, *block), blocks))
+
+    return line_starts([n + 1 for n in newlines], size)
+
+class InputIndex:
+    def __init__(self, path, offsets, blocks=None):
+        self.path = path
+        self.offsets = offsets
+        self.blocks = blocks if blocks is not None else numpy.zeros((0, 2), dtype='<i8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def seekable(self):
+        # whether reading from the middle of the input doesn't mean
+        # decompressing it from the start, which it does for compressed
+        # inputs that are a single gzip member or zstd frame
+        return compression(self.path) is None or len(self.blocks) > 1
+
+    def offset(self, line):
+        # the offset at which the given line starts. For the line
+        # right after the last one, this is the size of the file.
+        return int(self.offsets[line])
+
+    def open(self, offset=0):
+        # the input from the given offset on, decompressed if need be
+        return open_input(self.path, offset, self.blocks)
+
+    def read_line(self, fp, line):
+        return self.read_range(fp, line, 1)[0]
+
+    def read_range(self, fp, start, count):
+        # read count lines starting at line start
+        end = min(start + count, len(self))
+        fp.seek(self.offset(start))
+        data = fp.read(self.offset(end) - self.offset(start))
+        base = self.offset(start)
+        return [data[self.offsets[i] - base:self.offsets[i+1] - base] for i in range(start, end)]
+
+    @staticmethod
+    def load(path):
+        # returns None if there's no valid index for the input
+        try:
+            with open(index_path(path), 'rb') as fp:
+                header = fp.read(HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(header) != HEADER.size:
+            return None
+        (magic, version, size, mtime_ns, count, block_count) = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or (size, mtime_ns) != stat(path):
+            return None
+        offsets = numpy.memmap(index_path(path), dtype='<i8', mode='r', offset=HEADER.size, shape=(count + 1,))
+        blocks = numpy.fromfile(index_path(path), dtype='<i8', offset=HEADER.size + (count + 1) * 8, count=block_count * 2).reshape(-1, 2)
+        return InputIndex(path, offsets, blocks)
+
+    @staticmethod
+    def build(path, workers=None, save=True):
+        (size, mtime_ns) = stat(path)
+        if compression(path) is not None or s3.is_s3(path):
+            (offsets, blocks) = scan_stream(path)
+        else:
+            (offsets, blocks) = (scan_line_offsets(path, workers=workers), None)
+        index = InputIndex(path, offsets, blocks)
+        if save:
+            try:
+                index.save(size, mtime_ns)
+            except OSError as e:
+                # a read-only input directory shouldn't stop us
+                print(f'could not save index for {path}: {e}', file=sys.stderr)
+        return index
+
+    def save(self, size, mtime_ns):
+        # written under a temporary name so a concurrent reader never
+        # sees half an index.
+        os.makedirs(os.path.dirname(index_path(self.path)) or '.', exist_ok=True)
+        tmp_path = f'{index_path(self.path)}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, VERSION, size, mtime_ns, len(self), len(self.blocks)))
+            self.offsets.tofile(fp)
+            self.blocks.astype('<i8').tofile(fp)
+        os.replace(tmp_path, index_path(self.path))
+
+    @staticmethod
+    def load_or_build(path, workers=None):
+        index = InputIndex.load(path)
+        if index is None:
+            index = InputIndex.build(path, workers=workers)
+        return index
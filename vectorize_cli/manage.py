@@ -4,8 +4,21 @@ import os
 import sys
 import etcd3
 import json
+import math
+import threading
+import time
+from queue import Queue, Empty
+from vectorize_cli.input_index import InputIndex
+from vectorize_cli.archive import TaskArchive
+from vectorize_cli.task_monitor import task_status
+from vectorize_cli.vector_file import VectorFormat, FORMATS
+from vectorize_cli.tokens import TokenFile
+from vectorize_cli.s3 import is_s3
 
 etcd = None
+archive_path = None
+# how many tasks to fetch at once when scanning through all of them
+SCAN_BATCH = 500
 
 def process(args):
     input_file = args.input
@@ -13,16 +26,141 @@ def process(args):
     task_name = args.task_name if args.task_name is not None else f'{input_file}->{output_file}'
 
     task_key = f'/services/tasks/vectorizer/{task_name}'
-    task_data = {'status': 'pending', 'init': {'input_file': input_file, 'output_file': output_file}}
+    vector_format = VectorFormat(args.format, args.normalize).to_init()
+    task_data = {'status': 'pending', 'init': {'input_file': input_file, 'output_file': output_file, 'format': vector_format}}
+    directory = args.directory if args.directory is not None else os.getenv('VECTORIZER_DIRECTORY', '.')
+    if args.field is not None:
+        task_data['init']['field'] = args.field
+    if args.tokens is not None:
+        task_data['init']['tokens'] = args.tokens
+        print_token_statistics(os.path.join(directory, args.tokens))
+    sharded = args.shards is not None or args.shard_lines is not None
+    if args.build_index or sharded:
+        # index the input now, so the worker can start right away
+        # s3 inputs are indexed into the local index cache, so a
+        # worker on another machine will index them again
+        index = InputIndex.load_or_build(input_file if is_s3(input_file) else os.path.join(directory, input_file))
+        print(f'indexed {len(index)} lines')
+        task_data['progress'] = {'count': 0, 'total': len(index)}
+
+    if sharded:
+        shard_lines = args.shard_lines
+        if shard_lines is None:
+            shard_lines = -(-len(index) // args.shards)
+        if shard_lines < len(index) and not index.seekable():
+            # every shard would decompress everything before its lines
+            # again, so the shards would be no faster than one task
+            print(f'{input_file} is compressed as a single gzip member or zstd frame, so it cannot be sharded. '
+                  'Compress it in independent blocks (bgzip, pzstd) or process it without shards.')
+            sys.exit(1)
+        process_sharded(task_name, input_file, output_file, vector_format, index, max(shard_lines, 1), tokens=args.tokens, field=args.field)
+        return
 
     etcd.put(task_key, json.dumps(task_data))
 
     print(f'created task: `{task_name}`')
 
-def status_line(key, state):
+def print_token_statistics(tokens_dir):
+    # what the task is in for, if the tokens are already there
+    try:
+        statistics = TokenFile(tokens_dir).statistics()
+    except FileNotFoundError:
+        print(f'no complete tokens in {tokens_dir} yet')
+        return
+    if statistics['count'] == 0:
+        return
+    print(f'{statistics["tokens"]} tokens in {statistics["count"]} records, '
+          f'length mean {statistics["mean"]:.1f}, p50 {statistics["p50"]:.0f}, p90 {statistics["p90"]:.0f}, '
+          f'p99 {statistics["p99"]:.0f}, max {statistics["max"]}')
+
+def process_sharded(task_name, input_file, output_file, vector_format, index, shard_lines, tokens=None, field=None):
+    # A sharded task is a parent task waiting for a shard task per
+    # range of lines. Every shard writes its own segment of the
+    # output, and once all are complete, the parent becomes pending
+    # and gets picked up to merge the segments into the output.
+    shards = []
+    segments = []
+    shard_tasks = []
+    for (i, first_line) in enumerate(range(0, max(len(index), 1), shard_lines)):
+        end_line = min(first_line + shard_lines, len(index))
+        shard_name = f'{task_name}-shard-{i}'
+        segment = f'{output_file}.shard-{i}'
+        shards.append(shard_name)
+        segments.append(segment)
+        shard_init = {
+            'input_file': input_file,
+            'output_file': segment,
+            'format': vector_format,
+            'parent': task_name,
+            'range': {'first_line': first_line, 'end_line': end_line, 'start': index.offset(first_line), 'end': index.offset(end_line)}
+        }
+        if tokens is not None:
+            shard_init['tokens'] = tokens
+        if field is not None:
+            shard_init['field'] = field
+        shard_tasks.append((shard_name, {
+            'status': 'pending',
+            'init': shard_init,
+            'progress': {'count': 0, 'total': end_line - first_line}
+        }))
+
+    # the parent has to exist before any shard can finish
+    task_data = {'status': 'waiting', 'init': {'input_file': input_file, 'output_file': output_file, 'format': vector_format, 'shards': shards, 'segments': segments}}
+    etcd.put(f'/services/tasks/vectorizer/{task_name}', json.dumps(task_data))
+    # etcd limits the amount of operations in a transaction
+    for offset in range(0, len(shard_tasks), 64):
+        etcd.transaction(compare=[],
+                         success=[etcd.transactions.put(f'/services/tasks/vectorizer/{name}', json.dumps(data)) for (name, data) in shard_tasks[offset:offset+64]],
+                         failure=[])
+
+    print(f'created task: `{task_name}` with {len(shards)} shards')
+
+def index(args):
+    # An index task builds an approximate nearest neighbour index of a
+    # vector file, on whichever worker claims it.
+    task_name = args.task_name if args.task_name is not None else f'{args.vectors}->{args.index}'
+    parameters = {'lists': args.lists, 'pq': args.pq, 'metric': args.metric}
+    if args.train_size is not None:
+        parameters['train_size'] = args.train_size
+    task_data = {'status': 'pending', 'init': {'type': 'index', 'input_file': args.vectors, 'output_file': args.index, 'index': parameters}}
+    etcd.put(f'/services/tasks/vectorizer/{task_name}', json.dumps(task_data))
+    print(f'created task: `{task_name}`')
+
+def pretokenize(args):
+    # A pretokenize task tokenizes an input ahead of time, into token
+    # files that vectorize tasks created with --tokens feed straight
+    # into the model.
+    task_name = args.task_name if args.task_name is not None else f'{args.input}->{args.tokens}'
+    task_data = {'status': 'pending', 'init': {'type': 'pretokenize', 'input_file': args.input, 'output_file': args.tokens}}
+    if args.field is not None:
+        task_data['init']['field'] = args.field
+    etcd.put(f'/services/tasks/vectorizer/{task_name}', json.dumps(task_data))
+    print(f'created task: `{task_name}`')
+
+def aggregate_progress(shard_states):
+    progress = {'count': 0, 'total': 0}
+    for state in shard_states:
+        shard_progress = state.get('progress') or {}
+        progress['count'] += shard_progress.get('count', 0)
+        progress['total'] += shard_progress.get('total', 0)
+        if state['status'] == 'running':
+            for key in ['rate', 'avg_rate', 'token_rate', 'avg_token_rate']:
+                if key in shard_progress:
+                    progress[key] = progress.get(key, 0) + shard_progress[key]
+    return progress
+
+def status_line(key, state, shard_states=None):
     task_id = key[len('/services/tasks/vectorizer/'):]
     status_line = f'{task_id} ({state["init"]["input_file"]}->{state["init"]["output_file"]}): {state["status"]}'
     progress = state.get('progress')
+    vectors = state.get('vectors')
+    if vectors is not None and vectors.get('precision', 'fp32') != 'fp32':
+        status_line += f' ({vectors["precision"]})'
+    if shard_states is not None:
+        complete = sum(1 for shard_state in shard_states if shard_state['status'] == 'complete')
+        status_line += f', shards complete: {complete}/{len(shard_states)}'
+        if state['status'] == 'waiting':
+            progress = aggregate_progress(shard_states)
     if progress:
         rate = 'unknown'
         avg_rate = 'unknown'
@@ -30,34 +168,231 @@ def status_line(key, state):
             rate = f'{progress["rate"]:.2f}'
         if 'avg_rate' in progress:
             avg_rate = f'{progress["avg_rate"]:.2f}'
+        if 'stage' in progress:
+            status_line += f', stage: {progress["stage"]}'
         status_line += f', progress: {progress["count"]}/{progress["total"]}, rate: {rate} (avg {avg_rate})'
+        if 'avg_token_rate' in progress:
+            status_line += f', tokens/s: {progress["token_rate"]:.0f} (avg {progress["avg_token_rate"]:.0f})'
+        if 'batch_size' in progress:
+            status_line += f', batch size: {progress["batch_size"]}'
+        if progress.get('token_budget') is not None:
+            status_line += f', token budget: {progress["token_budget"]}'
+        if 'cache_hits' in progress:
+            status_line += f', cache hits: {progress["cache_hits"]}/{progress["cache_hits"] + progress["cache_misses"]}'
+        seconds = progress.get('metrics', {}).get('seconds')
+        if seconds:
+            # stages overlap on different threads, so these are shares
+            # of the time spent in stages rather than of wall time
+            total = sum(seconds.values()) or 1
+            shares = sorted(seconds.items(), key=lambda item: item[1], reverse=True)[:3]
+            status_line += ', time: ' + ', '.join(f'{stage} {100 * s / total:.0f}%' for (stage, s) in shares)
 
     return status_line
 
+def get_state(task_name):
+    (v,_) = etcd.get(f'/services/tasks/vectorizer/{task_name}')
+    return json.loads(v)
+
+def archived_state(task_name):
+    archive = TaskArchive.open_read_only(archive_path)
+    return archive.get(task_name) if archive is not None else None
+
+def get_states(task_names):
+    # states of tasks that might have been archived in the meantime
+    states = []
+    for task_name in task_names:
+        (v,_) = etcd.get(f'/services/tasks/vectorizer/{task_name}')
+        states.append(json.loads(v) if v is not None else archived_state(task_name))
+    return states
+
 def status(args):
     task_name = args.task_name
     task_key = f'/services/tasks/vectorizer/{task_name}'
     (v,_) = etcd.get(task_key)
 
-    task_data = json.loads(v)
+    if v is not None:
+        task_data = json.loads(v)
+    else:
+        task_data = archived_state(task_name)
+        if task_data is None:
+            print(f'no such task: {task_name}')
+            sys.exit(1)
+        print('(archived)')
+    shards = task_data['init'].get('shards')
+    shard_states = get_states(shards) if shards is not None else None
     if args.raw:
         print(json.dumps(task_data, indent=4))
     elif task_data['status'] == 'error':
-        print(status_line(task_key, task_data))
+        print(status_line(task_key, task_data, shard_states))
         RED = '\033[91m'
         RESET = '\033[0m'
         print(RED+task_data['error']+RESET)
     else:
-        print(status_line(task_key, task_data))
+        print(status_line(task_key, task_data, shard_states))
+
+    if shards is not None and not args.raw:
+        for (shard, shard_state) in zip(shards, shard_states):
+            print('  ' + status_line(f'/services/tasks/vectorizer/{shard}', shard_state))
+
+def scan_tasks():
+    # go over all tasks in batches, yielding (value, metadata) like
+    # get_prefix does, without having them all in memory at once.
+    prefix = '/services/tasks/vectorizer/'
+    start = prefix.encode('utf-8')
+    end = etcd3.utils.prefix_range_end(start)
+    while True:
+        batch = list(etcd.get_range(start, end, limit=SCAN_BATCH))
+        yield from batch
+        if len(batch) < SCAN_BATCH:
+            return
+        start = batch[-1][1].key + b'\0'
+
+def list_page(statuses, offset, limit):
+    # Returns the states on the requested page and the total amount of
+    # tasks. Without a status filter, only the keys of all tasks are
+    # fetched, and then the values of just the page. Filtering by
+    # status does need all values, but only decodes the ones shown.
+    if not statuses:
+        keys = [kv.key for (_,kv) in etcd.get_prefix('/services/tasks/vectorizer/', keys_only=True)]
+        page_keys = keys[offset:offset+limit]
+        states = []
+        if page_keys:
+            for (v,kv) in etcd.get_range(page_keys[0], page_keys[-1] + b'\0'):
+                states.append((kv.key.decode('utf-8'), json.loads(v)))
+        return (states, len(keys))
+
+    states = []
+    matched = 0
+    for (v,kv) in scan_tasks():
+        if task_status(v) in statuses:
+            if offset <= matched < offset + limit:
+                states.append((kv.key.decode('utf-8'), json.loads(v)))
+            matched += 1
+    return (states, matched)
 
 def list_tasks(args):
-    for (v,kv) in etcd.get_prefix('/services/tasks/vectorizer/'):
+    offset = (args.page - 1) * args.page_size
+    if args.archived:
+        archive = TaskArchive.open_read_only(archive_path)
+        if archive is None:
+            (states, total) = ([], 0)
+        else:
+            states = [(f'/services/tasks/vectorizer/{name}', state) for (name, state) in archive.list(args.status, offset, args.page_size)]
+            total = archive.count(args.status)
+    else:
+        (states, total) = list_page(args.status, offset, args.page_size)
+
+    for (key, task_data) in states:
+        shards = task_data['init'].get('shards')
+        shard_states = get_states(shards) if shards is not None else None
+        print(status_line(key, task_data, shard_states))
+    print(f'page {args.page} of {max(1, math.ceil(total / args.page_size))} ({total} tasks)')
+
+def archive(args):
+    # Move finished tasks out of etcd into the local archive. Shards
+    # are only archived along with their parent, as a parent that is
+    # still waiting needs to see them.
+    statuses = args.status if args.status else ['complete', 'error']
+    store = TaskArchive(archive_path)
+    archived = 0
+    for (v,kv) in scan_tasks():
+        if task_status(v) not in statuses:
+            continue
         key = kv.key.decode('utf-8')
-        task_data = json.loads(v)
-        print(status_line(key, task_data))
+        task_name = key[len('/services/tasks/vectorizer/'):]
+        state = json.loads(v)
+        parent = state['init'].get('parent')
+        if parent is not None:
+            (parent_value,_) = etcd.get(f'/services/tasks/vectorizer/{parent}')
+            if parent_value is not None and task_status(parent_value) not in statuses:
+                continue
+
+        store.add(task_name, state)
+        # only delete the task if nothing changed since we read it
+        (success,_) = etcd.transaction(
+            compare=[etcd.transactions.mod(key) == kv.mod_revision],
+            success=[etcd.transactions.delete(key)],
+            failure=[])
+        if success:
+            archived += 1
+        else:
+            store.remove(task_name)
+
+    print(f'archived {archived} tasks')
+
+def top(args):
+    # A live view of all running tasks. Running tasks are the claimed
+    # ones, so we only fetch those, and from then on follow updates
+    # through a watch.
+    tasks_prefix = '/services/tasks/vectorizer/'
+    claims_prefix = '/services/claims/vectorizer/'
+    events = Queue()
+    # start watching before we look, so we don't miss anything in between
+    (watch, cancel) = etcd.watch_prefix(tasks_prefix)
+    threading.Thread(target=lambda: [events.put(event) for event in watch], daemon=True).start()
+
+    states = {}
+    for (_,kv) in etcd.get_prefix(claims_prefix, keys_only=True):
+        task_key = tasks_prefix + kv.key.decode('utf-8')[len(claims_prefix):]
+        (v,_) = etcd.get(task_key)
+        if v is not None and task_status(v) == 'running':
+            states[task_key] = json.loads(v)
+
+    try:
+        while True:
+            deadline = time.monotonic() + args.interval
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    event = events.get(timeout=remaining)
+                except Empty:
+                    break
+                key = event.key.decode('utf-8')
+                if isinstance(event, etcd3.events.PutEvent) and task_status(event.value) == 'running':
+                    states[key] = json.loads(event.value)
+                else:
+                    states.pop(key, None)
+            draw_top(states)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cancel()
+
+def draw_top(states):
+    progresses = [state.get('progress') or {} for state in states.values()]
+    rate = sum(progress.get('rate', 0) for progress in progresses)
+    avg_rate = sum(progress.get('avg_rate', 0) for progress in progresses)
+    token_rate = sum(progress.get('token_rate', 0) for progress in progresses)
+    remaining = sum(progress.get('total', 0) - progress.get('count', 0) for progress in progresses)
+    eta = f'{remaining / avg_rate / 60:.1f} minutes' if avg_rate > 0 else 'unknown'
+
+    CLEAR = '\033[2J\033[H'
+    print(CLEAR, end='')
+    print(f'{len(states)} running, rate: {rate:.2f} (avg {avg_rate:.2f}), tokens/s: {token_rate:.0f}, remaining: {remaining}, eta: {eta}')
+    print()
+    for (key, state) in sorted(states.items()):
+        print(status_line(key, state))
+
+def for_task_or_shards(task_name, action, statuses):
+    # Pausing, resuming or retrying a sharded task applies to those of
+    # its shards that are in the right status for it, unless the
+    # parent itself is (which happens while merging).
+    state = get_state(task_name)
+    shards = state['init'].get('shards')
+    if shards is None or state['status'] in statuses:
+        action(task_name)
+        return
+
+    affected = 0
+    for shard in shards:
+        if get_state(shard)['status'] in statuses:
+            action(shard)
+            affected += 1
+    print(f'{affected} of {len(shards)} shards affected')
 
 def pause(args):
-    task_name = args.task_name
+    for_task_or_shards(args.task_name, pause_task, ['running', 'resuming'])
+
+def pause_task(task_name):
     task_key = f'/services/tasks/vectorizer/{task_name}'
     queue = f'/services/queue/vectorizer/{task_name}'
     claim = f'/services/claims/vectorizer/{task_name}'
@@ -91,7 +426,9 @@ def pause(args):
         sys.exit(1)
 
 def resume(args):
-    task_name = args.task_name
+    for_task_or_shards(args.task_name, resume_task, ['paused'])
+
+def resume_task(task_name):
     task_key = f'/services/tasks/vectorizer/{task_name}'
     (state_bytes, _) = etcd.get(task_key)
     state = json.loads(state_bytes)
@@ -106,7 +443,9 @@ def resume(args):
 
 
 def retry(args):
-    task_name = args.task_name
+    for_task_or_shards(args.task_name, retry_task, ['error'])
+
+def retry_task(task_name):
     task_key = f'/services/tasks/vectorizer/{task_name}'
     (state_bytes, _) = etcd.get(task_key)
     state = json.loads(state_bytes)
@@ -123,20 +462,55 @@ def retry(args):
 
 def main():
     global etcd
+    global archive_path
     parser = argparse.ArgumentParser()
     parser.add_argument('--etcd', help='hostname of etcd server')
+    parser.add_argument('--archive', help='path of the archive of finished tasks')
     subparsers = parser.add_subparsers(dest='subcommand')
 
     process_parser = subparsers.add_parser('process', help='process a json-lines file into a vectors file')
     process_parser.add_argument('input', type=str, help='Input file')
     process_parser.add_argument('output', type=str, help='Output file')
     process_parser.add_argument('--task-name', type=str, help='Task name')
+    process_parser.add_argument('--build-index', action='store_true', help='build the line index of the input ahead of time')
+    process_parser.add_argument('--directory', type=str, help='the directory where files are to be found, for --build-index and sharding')
+    process_parser.add_argument('--shards', type=int, help='split the input into this many shards that can be processed in parallel')
+    process_parser.add_argument('--shard-lines', type=int, help='split the input into shards of this many lines')
+    process_parser.add_argument('--format', choices=FORMATS, default='f32', help='how to store the vectors. raw is headerless float32, as used before there were formats')
+    process_parser.add_argument('--normalize', action='store_true', help='L2-normalize the vectors before storing them')
+    process_parser.add_argument('--field', type=str, help='take the text from this dotted path in json object records, like text or meta.body')
+    process_parser.add_argument('--tokens', type=str, help='token files of the input made by a pretokenize task, to use instead of tokenizing')
+
+    index_parser = subparsers.add_parser('index', help='build an approximate nearest neighbour index of a vectors file')
+    index_parser.add_argument('vectors', type=str, help='Vectors file')
+    index_parser.add_argument('index', type=str, help='Index directory')
+    index_parser.add_argument('--task-name', type=str, help='Task name')
+    index_parser.add_argument('--lists', type=int, required=True, help='the amount of k-means clusters to divide the vectors over, often around the square root of their count')
+    index_parser.add_argument('--pq', type=int, help='store vectors as this many product quantized bytes instead of in full')
+    index_parser.add_argument('--metric', choices=['cosine', 'euclidean'], default='cosine')
+    index_parser.add_argument('--train-size', type=int, help='the amount of vectors to train k-means on')
+
+    pretokenize_parser = subparsers.add_parser('pretokenize', help='tokenize a json-lines file ahead of processing it')
+    pretokenize_parser.add_argument('input', type=str, help='Input file')
+    pretokenize_parser.add_argument('tokens', type=str, help='Token files directory')
+    pretokenize_parser.add_argument('--task-name', type=str, help='Task name')
+    pretokenize_parser.add_argument('--field', type=str, help='take the text from this dotted path in json object records')
 
     status_parser = subparsers.add_parser('status', help='retrieve the status of a task')
     status_parser.add_argument('task_name', type=str, help='task name to query')
     status_parser.add_argument('--raw', action='store_true', help='raw output')
 
     list_parser = subparsers.add_parser('list', help='list all tasks')
+    list_parser.add_argument('--status', type=str, action='append', help='only list tasks with this status (can be given more than once)')
+    list_parser.add_argument('--page', type=int, default=1, help='page to show')
+    list_parser.add_argument('--page-size', type=int, default=100, help='tasks per page')
+    list_parser.add_argument('--archived', action='store_true', help='list archived tasks instead')
+
+    top_parser = subparsers.add_parser('top', help='live view of running tasks')
+    top_parser.add_argument('--interval', type=float, default=2.0, help='seconds between refreshes')
+
+    archive_parser = subparsers.add_parser('archive', help='move finished tasks out of etcd into the local archive')
+    archive_parser.add_argument('--status', type=str, action='append', help='archive tasks with this status (default complete and error)')
 
     pause_parser = subparsers.add_parser('pause', help='pause task')
     pause_parser.add_argument('task_name', type=str, help='task name to pause')
@@ -149,6 +523,10 @@ def main():
 
     args = parser.parse_args()
 
+    archive_path = args.archive
+    if archive_path is None:
+        archive_path = os.getenv('VECTORIZER_ARCHIVE', os.path.expanduser('~/.vectorizer-archive.sqlite'))
+
     host = args.etcd
     if host is None:
         host = os.getenv('ETCD_HOST')
@@ -160,10 +538,18 @@ def main():
     match args.subcommand:
         case 'process':
             process(args)
+        case 'index':
+            index(args)
+        case 'pretokenize':
+            pretokenize(args)
         case 'status':
             status(args)
         case 'list':
             list_tasks(args)
+        case 'top':
+            top(args)
+        case 'archive':
+            archive(args)
         case 'pause':
             pause(args)
         case 'resume':
@@ -0,0 +1,125 @@
+import sys
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from vectorize_cli.batching import current_rss
+
+# Timings of the stages of the vectorizer, and counts of what went
+# through them, for when it isn't clear where the time goes. Stages
+# are timed where they are called, so every backend gets the same:
+# - read: reading and parsing input records, per window
+# - tokenize: token lengths and model input, per window
+# - forward: infer_prepared, per batch
+# - copy: output_to_array, per batch
+# - write: writing vectors to the output, per window
+# - etcd: round trips to etcd the inference loop waits for
+#
+# The forward pass on cuda, and in the cpu pool, runs asynchronously,
+# so for those forward only covers starting it and copy includes
+# waiting for it to finish.
+#
+# Updates take a lock and a bisect, which is cheap next to what is
+# being timed, so this is always on.
+COUNTERS = ['records', 'tokens', 'padded_tokens', 'etcd_round_trips']
+# histogram bucket bounds in seconds, from 100µs to about a minute
+BUCKETS = [0.0001 * 2 ** i for i in range(20)]
+
+class Histogram:
+    def __init__(self):
+        # counts per bucket, with one more for what's beyond the last
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def observe(self, stage, seconds):
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.counts[bucket] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def snapshot(self):
+        # totals so far, to summarize what happened since
+        with self.lock:
+            return ({stage: histogram.sum for (stage, histogram) in self.stages.items()}, dict(self.counters))
+
+    def summary(self, since=None):
+        # seconds per stage and counters, since an earlier snapshot.
+        # This goes into task progress, so it's kept small.
+        (stages, counters) = self.snapshot()
+        (stages_before, counters_before) = since if since is not None else ({}, {})
+        summary = {'seconds': {stage: round(total - stages_before.get(stage, 0), 3) for (stage, total) in stages.items()}}
+        for (counter, value) in counters.items():
+            summary[counter] = value - counters_before.get(counter, 0)
+        return summary
+
+    def render(self):
+        # the Prometheus text exposition format
+        lines = []
+        with self.lock:
+            lines.append('# TYPE vectorizer_stage_seconds histogram')
+            for (stage, histogram) in sorted(self.stages.items()):
+                cumulative = 0
+                for (bound, count) in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'vectorizer_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'vectorizer_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'vectorizer_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'vectorizer_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            for (counter, value) in self.counters.items():
+                lines.append(f'# TYPE vectorizer_{counter}_total counter')
+                lines.append(f'vectorizer_{counter}_total {value}')
+        lines.append('# TYPE vectorizer_resident_memory_bytes gauge')
+        lines.append(f'vectorizer_resident_memory_bytes {current_rss()}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        # serves /metrics from a background thread
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        server.metrics = self
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        print(f'serving metrics on http://{host}:{port}/metrics', file=sys.stderr)
+        return server
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# the metrics of this process
+metrics = Metrics()
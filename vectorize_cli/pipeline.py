@@ -0,0 +1,140 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue, Empty, Full
+
+_END = object()
+
+class Pipeline:
+    # A staged pipeline around the inference loop, which runs on the
+    # calling thread:
+    #
+    # source -> prepare -> (caller) -> sink
+    #
+    # The source iterator (reading and parsing input) runs on a
+    # reader thread, which hands every item to a pool of prepare
+    # workers (tokenization). The caller iterates over the pipeline
+    # to get prepared items in source order, and passes its results
+    # to write(), after which a writer thread runs the sink on them,
+    # again in order. All queues are bounded, so a slow stage holds
+    # up the stages before it rather than piling up memory.
+    #
+    # Everything that talks to etcd stays on the calling thread. When
+    # the caller bails out (for example because the task was
+    # interrupted), close() stops reading ahead but still lets the
+    # writer finish whatever it was already handed.
+    def __init__(self, source, prepare, sink, workers=1, depth=2):
+        self.source = source
+        self.prepare = prepare
+        self.sink = sink
+        self.stopping = threading.Event()
+        self.prepared = Queue(maxsize=depth)
+        self.finished = Queue(maxsize=depth)
+        self.error = None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prepare')
+        self.reader = threading.Thread(target=self._read, name='reader', daemon=True)
+        self.writer = threading.Thread(target=self._write, name='writer', daemon=True)
+
+    def __enter__(self):
+        self.reader.start()
+        self.writer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        # don't mask whatever made the caller leave
+        if exc_type is None:
+            self._check()
+        return False
+
+    def _put(self, queue, item):
+        # put on a bounded queue, unless the pipeline is shutting down
+        while not self.stopping.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _end(self, item):
+        # The caller may be waiting for the last item, so unlike _put
+        # this always gets it on the queue. When shutting down, items
+        # the caller won't get to anymore make room for it.
+        while True:
+            try:
+                self.prepared.put(item, timeout=0.1)
+                return
+            except Full:
+                if not self.stopping.is_set():
+                    continue
+            try:
+                dropped = self.prepared.get_nowait()
+            except Empty:
+                continue
+            if isinstance(dropped, Future):
+                dropped.cancel()
+
+    def _read(self):
+        try:
+            for item in self.source:
+                future = self.executor.submit(self.prepare, item)
+                if not self._put(self.prepared, future):
+                    future.cancel()
+                    break
+        except BaseException as e:
+            # hand the error to the caller through the same queue so
+            # that it surfaces in order.
+            future = Future()
+            future.set_exception(e)
+            self._end(future)
+            return
+
+        self._end(_END)
+
+    def _write(self):
+        while True:
+            item = self.finished.get()
+            if item is _END:
+                return
+            try:
+                self.sink(item)
+            except BaseException as e:
+                self.error = e
+                self.stopping.set()
+                return
+
+    def __iter__(self):
+        # polls rather than blocking, so that a failing writer is
+        # noticed while waiting for the reader
+        while True:
+            self._check()
+            try:
+                future = self.prepared.get(timeout=0.1)
+            except Empty:
+                continue
+            if future is _END:
+                return
+            self._check()
+            yield future.result()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, item):
+        self._put(self.finished, item)
+        self._check()
+
+    def close(self):
+        # first let the writer drain, then stop everything else. A
+        # writer that failed has already stopped taking items.
+        while self.writer.is_alive():
+            try:
+                self.finished.put(_END, timeout=0.1)
+                break
+            except Full:
+                pass
+        self.writer.join()
+        self.stopping.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.reader.join()
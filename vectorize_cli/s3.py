@@ -0,0 +1,249 @@
+import io
+import hashlib
+import os
+import sys
+import time
+import boto3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Inputs and outputs in S3, or anything that speaks its API, like
+# MinIO. Paths of the form s3://bucket/key are objects. Set
+# VECTORIZER_S3_ENDPOINT (or AWS_ENDPOINT_URL) to use something other
+# than AWS.
+#
+# Inputs are read with ranged GETs, a few ranges ahead of the reader,
+# all of the same version of the object.
+#
+# Outputs are written as multipart uploads. A part is only uploaded
+# at the end of a window, once enough has been written, so every
+# uploaded part ends where a checkpoint can resume. The upload and its
+# amount of parts go into the checkpoint. The object only appears
+# when the upload is completed, so an unfinished output is never seen.
+# Uploads that are given up on are aborted where they are known, but a
+# bucket lifecycle rule that aborts incomplete multipart uploads is
+# what cleans up after workers that disappeared.
+CHUNK_SIZE = 8 * 1024 * 1024
+READ_AHEAD = 4
+# S3 wants parts of at least 5MB, apart from the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_SIZE = 32 * 1024 * 1024
+ATTEMPTS = 3
+
+_client = None
+
+def client():
+    global _client
+    if _client is None:
+        _client = boto3.client('s3', endpoint_url=os.getenv('VECTORIZER_S3_ENDPOINT'))
+    return _client
+
+def is_s3(path):
+    return path.startswith('s3://')
+
+def split_uri(uri):
+    (bucket, _, key) = uri[len('s3://'):].partition('/')
+    if not bucket or not key:
+        raise ValueError(f'{uri} is not an s3://bucket/key uri')
+    return (bucket, key)
+
+def head(uri):
+    (bucket, key) = split_uri(uri)
+    return client().head_object(Bucket=bucket, Key=key)
+
+def stat(uri):
+    # (size, version), to stand in for the size and modification time
+    # os.stat gives for files. LastModified only has whole seconds, so
+    # the version is made of the ETag, which changes with the content.
+    response = head(uri)
+    version = hashlib.blake2b(response['ETag'].encode(), digest_size=8).digest()
+    return (response['ContentLength'], int.from_bytes(version, 'little', signed=True))
+
+def exists(uri):
+    try:
+        head(uri)
+        return True
+    except client().exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def delete(uri):
+    (bucket, key) = split_uri(uri)
+    client().delete_object(Bucket=bucket, Key=key)
+
+def abort_upload(uri, upload_id):
+    (bucket, key) = split_uri(uri)
+    client().abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+def retried(action, description):
+    # the client retries requests, but not reading the body of one
+    for attempt in range(ATTEMPTS):
+        try:
+            return action()
+        except Exception as e:
+            if attempt == ATTEMPTS - 1:
+                raise
+            print(f'{description} failed, retrying: {e}', file=sys.stderr)
+            time.sleep(2 ** attempt)
+
+class S3Reader(io.RawIOBase):
+    # An object from offset up to end, read in ranges of chunk_size,
+    # with up to read_ahead of them on their way. Seeking drops what
+    # was read ahead.
+    def __init__(self, uri, size, etag, offset=0, end=None, chunk_size=CHUNK_SIZE, read_ahead=READ_AHEAD):
+        self.name = uri
+        (self.bucket, self.key) = split_uri(uri)
+        self.size = size
+        self.etag = etag
+        self.end = self.size if end is None else min(end, self.size)
+        self.position = offset
+        self.next_offset = offset
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+        self.executor = ThreadPoolExecutor(max_workers=read_ahead, thread_name_prefix='s3-read')
+        self.chunks = deque()
+        self.pending = memoryview(b'')
+        self._schedule()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        match whence:
+            case io.SEEK_SET:
+                position = offset
+            case io.SEEK_CUR:
+                position = self.position + offset
+            case io.SEEK_END:
+                position = self.size + offset
+        if position != self.position:
+            for chunk in self.chunks:
+                chunk.cancel()
+            self.chunks.clear()
+            self.pending = memoryview(b'')
+            self.position = self.next_offset = position
+            self._schedule()
+        return position
+
+    def _get(self, start, end):
+        def get():
+            response = client().get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={start}-{end-1}', IfMatch=self.etag)
+            return response['Body'].read()
+        return retried(get, f'reading {self.name} bytes {start}-{end-1}')
+
+    def _schedule(self):
+        while len(self.chunks) < self.read_ahead and self.next_offset < self.end:
+            end = min(self.next_offset + self.chunk_size, self.end)
+            self.chunks.append(self.executor.submit(self._get, self.next_offset, end))
+            self.next_offset = end
+
+    def readinto(self, buffer):
+        if len(self.pending) == 0:
+            if not self.chunks:
+                return 0
+            self.pending = memoryview(self.chunks.popleft().result())
+            self._schedule()
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        self.position += size
+        return size
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        super().close()
+
+def open_reader(uri, offset=0, end=None, chunk_size=CHUNK_SIZE, read_ahead=READ_AHEAD):
+    response = head(uri)
+    # ranges are requested of this version only, so a replaced object
+    # fails rather than mixing versions
+    reader = S3Reader(uri, response['ContentLength'], response['ETag'], offset, end, chunk_size=chunk_size, read_ahead=read_ahead)
+    return io.BufferedReader(reader, buffer_size=CHUNK_SIZE)
+
+class MultipartOutput:
+    # A file-like output that becomes an object once complete() is
+    # called. Written data is kept until upload_part() is called with
+    # at least part_size of it. state() is what resume() needs to carry
+    # on with the same upload.
+    def __init__(self, uri, part_size=PART_SIZE, state=None):
+        self.name = uri
+        (self.bucket, self.key) = split_uri(uri)
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.buffer = bytearray()
+        self.parts = []
+        self.size = 0
+        if state is None:
+            self.upload_id = client().create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        else:
+            self.upload_id = state['upload_id']
+            self._recover(state['parts'], state['size'])
+
+    @staticmethod
+    def resume(uri, state, part_size=PART_SIZE):
+        # the upload of a checkpoint, or None if it is gone, in which
+        # case the output has to be started over
+        try:
+            return MultipartOutput(uri, part_size=part_size, state=state)
+        except Exception as e:
+            print(f'cannot continue the upload of {uri}: {e}', file=sys.stderr)
+            return None
+
+    def _recover(self, count, size):
+        # parts after the checkpointed ones were uploaded after the
+        # last checkpoint, and will be uploaded again
+        parts = []
+        paginator = client().get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id):
+            parts.extend(page.get('Parts', []))
+        parts = sorted((part for part in parts if part['PartNumber'] <= count), key=lambda part: part['PartNumber'])
+        if [part['PartNumber'] for part in parts] != list(range(1, count + 1)) or sum(part['Size'] for part in parts) != size:
+            raise ValueError(f'upload {self.upload_id} does not have the {count} parts of the checkpoint')
+        self.parts = [{'PartNumber': part['PartNumber'], 'ETag': part['ETag']} for part in parts]
+        self.size = size
+
+    def state(self):
+        return {'upload_id': self.upload_id, 'parts': len(self.parts), 'size': self.size}
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def _upload(self):
+        number = len(self.parts) + 1
+        data = bytes(self.buffer)
+        response = retried(lambda: client().upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                        PartNumber=number, Body=data),
+                           f'uploading part {number} of {self.name}')
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+        self.size += len(data)
+        self.buffer = bytearray()
+
+    def upload_part(self):
+        # uploads what was written as a part, if there is enough of it.
+        # Returns whether it did.
+        if len(self.buffer) < self.part_size:
+            return False
+        self._upload()
+        return True
+
+    def complete(self):
+        if self.buffer or not self.parts:
+            self._upload()
+        client().complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           MultipartUpload={'Parts': self.parts})
+
+    def flush(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
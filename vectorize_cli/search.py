@@ -0,0 +1,88 @@
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+
+from vectorize_cli.vector_file import VectorFile
+
+# Exact nearest neighbour search over vector files. Files are scanned
+# in blocks of rows, so memory use depends on the block size and the
+# amount of queries, not on the size of the files. Blocks are scored
+# on a thread pool, as numpy lets go of the GIL for the matrix
+# products that do most of the work.
+#
+# Distances are the same as those of backend compare: cosine distance
+# is (1 - cosine similarity) / 2, euclidean is the L2 distance.
+BLOCK_ROWS = 16384
+
+def prepare_queries(queries, distance):
+    queries = numpy.asarray(queries, dtype='float32')
+    if distance == 'cosine':
+        norms = numpy.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / numpy.where(norms == 0, 1, norms)
+    return queries
+
+def block_distances(rows, queries, distance, normalized=False):
+    # a (rows, queries) matrix of distances
+    products = rows @ queries.T
+    match distance:
+        case 'cosine':
+            if not normalized:
+                norms = numpy.linalg.norm(rows, axis=1)
+                products /= numpy.where(norms == 0, 1, norms)[:, None]
+            return (1 - products) / 2
+        case 'euclidean':
+            squared = numpy.einsum('ij,ij->i', rows, rows)[:, None] - 2 * products + numpy.einsum('ij,ij->i', queries, queries)[None, :]
+            return numpy.sqrt(numpy.maximum(squared, 0))
+        case _:
+            raise ValueError(f'unknown distance {distance}')
+
+def top_k(distances, ids, k):
+    # the k smallest distances in every column, and their ids, sorted
+    if len(distances) > k:
+        selection = numpy.argpartition(distances, k - 1, axis=0)[:k]
+        distances = numpy.take_along_axis(distances, selection, axis=0)
+        ids = ids[selection] if ids.ndim == 1 else numpy.take_along_axis(ids, selection, axis=0)
+    elif ids.ndim == 1:
+        ids = numpy.broadcast_to(ids[:, None], distances.shape)
+    order = numpy.argsort(distances, axis=0, kind='stable')
+    return (numpy.take_along_axis(distances, order, axis=0), numpy.take_along_axis(ids, order, axis=0))
+
+def search(paths, queries, k=10, distance='cosine', dimension=None, block_rows=BLOCK_ROWS, threads=None):
+    # Returns a list for every query with up to k (path, line,
+    # distance) tuples, nearest first. Line is the position of the
+    # vector in its file, which is the line of the record it was made
+    # from in the input.
+    queries = prepare_queries(queries, distance)
+    files = [VectorFile(path, dimension=dimension) for path in paths]
+    for vector_file in files:
+        if vector_file.dimension != queries.shape[1]:
+            raise ValueError(f'{vector_file.path} has {vector_file.dimension} dimensional vectors, but the queries have {queries.shape[1]}')
+
+    # ids combine the file and the line, so candidates from all files
+    # can be merged in one array
+    offsets = numpy.cumsum([0] + [len(vector_file) for vector_file in files])
+    blocks = [(i, start, min(start + block_rows, len(vector_file)))
+              for (i, vector_file) in enumerate(files)
+              for start in range(0, len(vector_file), block_rows)]
+
+    def score(block):
+        (i, start, end) = block
+        vector_file = files[i]
+        rows = vector_file[start:end]
+        distances = block_distances(rows, queries, distance, normalized=vector_file.format.normalized)
+        return top_k(distances, numpy.arange(offsets[i] + start, offsets[i] + end), k)
+
+    best_distances = numpy.empty((0, len(queries)), dtype='float32')
+    best_ids = numpy.empty((0, len(queries)), dtype='int64')
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for (distances, ids) in executor.map(score, blocks):
+            (best_distances, best_ids) = top_k(numpy.concatenate([best_distances, distances]),
+                                               numpy.concatenate([best_ids, ids]), k)
+
+    results = []
+    for q in range(len(queries)):
+        result = []
+        for (id, d) in zip(best_ids[:, q], best_distances[:, q]):
+            i = numpy.searchsorted(offsets, id, side='right') - 1
+            result.append((files[i].path, int(id - offsets[i]), float(d)))
+        results.append(result)
+    return results
@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import http.client
+import numpy
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty
+from socketserver import ThreadingUnixStreamServer
+
+class MicroBatcher:
+    # Requests arriving at about the same time are vectorized together,
+    # as one forward pass over many strings costs little more than one
+    # over a few. A batch goes to the model once it has max_batch
+    # strings, or once its first request has waited max_wait seconds.
+    # Queries and documents are embedded differently, so they never
+    # share a batch.
+    def __init__(self, backend, max_batch=64, max_wait=0.005):
+        self.backend = backend
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        # strings waiting for the model
+        self.queued = 0
+        # requests that haven't been answered yet
+        self.in_flight = 0
+        self.latencies = deque(maxlen=10000)
+        self.batch_sizes = deque(maxlen=1000)
+        self.thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, strings, is_query=False):
+        future = Future()
+        with self.lock:
+            self.queued += len(strings)
+            self.in_flight += 1
+        self.queue.put((strings, is_query, future, time.monotonic()))
+        return future
+
+    def embed(self, strings, is_query=False):
+        return self.submit(strings, is_query).result()
+
+    def _collect(self, first=None):
+        # Blocks for a first request, and then takes whatever else
+        # arrives in time. A request of the other kind ends the batch
+        # and gets to start the next one.
+        if first is None:
+            first = self.queue.get()
+        batch = [first]
+        size = len(first[0])
+        deadline = first[3] + self.max_wait
+        while size < self.max_batch:
+            try:
+                request = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except Empty:
+                break
+            if request[1] != first[1]:
+                return (batch, request)
+            batch.append(request)
+            size += len(request[0])
+        return (batch, None)
+
+    def _run(self):
+        leftover = None
+        while True:
+            (batch, leftover) = self._collect(leftover)
+            strings = [s for (request_strings, _, _, _) in batch for s in request_strings]
+            try:
+                if batch[0][1]:
+                    array = self.backend.process_queries_to_array(strings)
+                else:
+                    array = self.backend.process_chunk_to_array(strings)
+                error = None
+            except Exception as e:
+                error = e
+
+            now = time.monotonic()
+            offset = 0
+            with self.lock:
+                self.queued -= len(strings)
+                self.in_flight -= len(batch)
+                self.batch_sizes.append(len(strings))
+                for (_, _, _, submitted) in batch:
+                    self.latencies.append(now - submitted)
+            for (request_strings, _, future, _) in batch:
+                if error is None:
+                    future.set_result(array[offset:offset+len(request_strings)])
+                else:
+                    future.set_exception(error)
+                offset += len(request_strings)
+
+    def stats(self):
+        with self.lock:
+            latencies = numpy.array(self.latencies)
+            stats = {'in_flight': self.in_flight,
+                     'queue_depth': self.queued,
+                     'requests': len(latencies)}
+            if len(self.batch_sizes) != 0:
+                stats['avg_batch_size'] = sum(self.batch_sizes) / len(self.batch_sizes)
+        if len(latencies) != 0:
+            stats['p50_ms'] = numpy.percentile(latencies, 50) * 1000
+            stats['p99_ms'] = numpy.percentile(latencies, 99) * 1000
+        return stats
+
+class EmbeddingHandler(BaseHTTPRequestHandler):
+    # POST /embed with {"texts": [...], "query": false} returns
+    # {"vectors": [[...], ...]}. GET /stats returns the batcher's stats.
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, value):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        match self.path:
+            case '/stats':
+                self.send_json(200, self.server.batcher.stats())
+            case _:
+                self.send_json(404, {'error': f'no such path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/embed':
+            self.send_json(404, {'error': f'no such path {self.path}'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            texts = request['texts']
+            if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                raise ValueError('texts should be a list of strings')
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        if not texts:
+            self.send_json(200, {'vectors': []})
+            return
+        try:
+            array = self.server.batcher.embed(texts, bool(request.get('query', False)))
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_json(200, {'vectors': array.tolist()})
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        pass
+
+# the default of 5 refuses connections well before the batcher is busy
+REQUEST_QUEUE_SIZE = 1024
+
+class UnixHTTPServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+class TCPHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+def serve(backend, socket_path=None, host='127.0.0.1', port=8000, max_batch=64, max_wait=0.005):
+    if socket_path is not None:
+        server = UnixHTTPServer(socket_path, EmbeddingHandler)
+        print(f'listening on {socket_path}', file=sys.stderr)
+    else:
+        server = TCPHTTPServer((host, port), EmbeddingHandler)
+        print(f'listening on http://{host}:{port}', file=sys.stderr)
+    server.batcher = MicroBatcher(backend, max_batch=max_batch, max_wait=max_wait)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class EmbeddingClient:
+    # A client for a server started with backend serve. Keeps its
+    # connection open between requests, so use one per thread.
+    def __init__(self, socket_path=None, host='127.0.0.1', port=8000):
+        if socket_path is not None:
+            self.connection = UnixHTTPConnection(socket_path)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=60)
+
+    def request(self, method, path, value=None):
+        body = json.dumps(value).encode('utf-8') if value is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f'server returned {response.status}: {result.get("error")}')
+        return result
+
+    def embed(self, texts, query=False):
+        return numpy.array(self.request('POST', '/embed', {'texts': texts, 'query': query})['vectors'], dtype='float32')
+
+    def stats(self):
+        return self.request('GET', '/stats')
+
+def load_test(client_factory, texts, concurrency, requests, batch=1, query=False):
+    # Sends requests of batch texts each from concurrency threads, and
+    # returns the records per second and the client side latencies
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+    def run():
+        client = client_factory()
+        for i in counter:
+            chunk = [texts[(i * batch + j) % len(texts)] for j in range(batch)]
+            start = time.perf_counter()
+            client.embed(chunk, query)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    return (len(latencies) * batch / duration, numpy.array(latencies))
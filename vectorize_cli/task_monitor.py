@@ -2,15 +2,21 @@
 import argparse
 import etcd3
 import json
-import threading
 import os
-from queue import Queue
+import re
+import sys
+import time
 
 etcd = None
+SERVICES = '/services/'
 CLAIMS = '/services/claims/'
 TASKS = '/services/tasks/'
 QUEUE = '/services/queue/'
 INTERRUPT = '/services/interrupt/'
+# how long to wait before watching again after etcd failed us, doubled
+# on every failure in a row
+RETRY_SECONDS = 1
+MAX_RETRY_SECONDS = 30
 
 def task_to_claim(task):
     task_id = task[len(TASKS):]
@@ -31,39 +37,154 @@ def claim_to_task(claim):
 def runnable_status(status):
     return status in ['pending', 'resuming']
 
-def iterator_to_queue(it, q):
-    for v in it:
-        q.put(v)
+# Task states are always written with the status first, so for the
+# common case we don't need to decode a potentially large state just
+# to find out what it is.
+STATUS_PREFIX = re.compile(rb'^\{"status": "([a-z]+)"')
+
+def task_status(value):
+    match = STATUS_PREFIX.match(value)
+    if match:
+        return match.group(1).decode('utf-8')
+    return json.loads(value)['status']
+
+def task_parent(task_key, value):
+    # the key of the parent of a shard, or None for other tasks
+    parent = json.loads(value)['init'].get('parent')
+    if parent is None:
+        return None
+    return task_key[:task_key.rindex('/') + 1] + parent
+
+class MonitorState:
+    # What the monitor knows about tasks, claims and the queue, as of
+    # revision. It starts out as a snapshot of everything under
+    # /services/, and is kept up to date by a watch continuing from
+    # the revision of that snapshot, so decisions never need an
+    # extra round trip to etcd.
+    def __init__(self):
+        # task key -> (status, value, mod revision)
+        self.tasks = {}
+        self.claims = set()
+        self.queued = set()
+        self.revision = 0
+
+    def load(self):
+        response = etcd.get_prefix_response(SERVICES)
+        self.tasks = {}
+        self.claims = set()
+        self.queued = set()
+        for kv in response.kvs:
+            self.put(kv.key.decode('utf-8'), kv.value, kv.mod_revision)
+        self.revision = response.header.revision
+
+    def put(self, key, value, mod_revision):
+        if key.startswith(TASKS):
+            self.tasks[key] = (task_status(value), value, mod_revision)
+        elif key.startswith(CLAIMS):
+            self.claims.add(key)
+        elif key.startswith(QUEUE):
+            self.queued.add(key)
+
+    def delete(self, key):
+        if key.startswith(TASKS):
+            self.tasks.pop(key, None)
+        elif key.startswith(CLAIMS):
+            self.claims.discard(key)
+        elif key.startswith(QUEUE):
+            self.queued.discard(key)
+
+    def claimed(self, task_key):
+        return task_to_claim(task_key) in self.claims
+
+    def check(self, task_key):
+        # decide what, if anything, needs to happen to a task
+        if task_key not in self.tasks or self.claimed(task_key):
+            return
+        (status, value, mod_revision) = self.tasks[task_key]
+        if status == 'running':
+            pause_orphan(task_key, value, mod_revision)
+        elif status == 'waiting' and self.shards_complete(task_key, value):
+            # the worker of the last shard normally does this, but it
+            # could have gone away right after completing the shard
+            release_waiting(task_key, value, mod_revision)
+        elif runnable_status(status) and task_to_queue(task_key) not in self.queued:
+            # this also catches tasks whose worker claimed them but
+            # went away before starting on them
+            enqueue(task_key, mod_revision)
+
+    def shards_complete(self, task_key, value):
+        prefix = task_key[:task_key.rindex('/') + 1]
+        for shard in json.loads(value)['init']['shards']:
+            shard_state = self.tasks.get(prefix + shard)
+            if shard_state is None or shard_state[0] != 'complete':
+                return False
+        return True
+
+    def check_all(self):
+        for task_key in list(self.tasks.keys()):
+            self.check(task_key)
+
+    def handle(self, event):
+        key = event.key.decode('utf-8')
+        if isinstance(event, etcd3.events.PutEvent):
+            self.put(key, event.value, event.mod_revision)
+        elif isinstance(event, etcd3.events.DeleteEvent):
+            self.delete(key)
+        self.revision = max(self.revision, event.mod_revision)
+
+        if key.startswith(TASKS):
+            self.check(key)
+            if isinstance(event, etcd3.events.PutEvent) and self.tasks[key][0] == 'complete':
+                # a completed shard may have been the last one
+                parent = task_parent(key, event.value)
+                if parent is not None:
+                    self.check(parent)
+        elif key.startswith(CLAIMS) and isinstance(event, etcd3.events.DeleteEvent):
+            # is it a disappearing claim?
+            self.check(claim_to_task(key))
 
-def pause_if_orphan(task_key):
+def pause_orphan(task_key, value, mod_revision):
     claim = task_to_claim(task_key)
-    queue = task_to_queue(task_key)
     interrupt = task_to_interrupt(task_key)
-    (v,_) = etcd.get(task_key)
-    state = json.loads(v)
-
-    if state['status'] == 'running':
-        # set to resuming instead of paused for quick repickup
-        state['status'] = 'resuming'
-        etcd.transaction(
-            compare=[
-                etcd.transactions.value(task_key) == v,
-                etcd.transactions.version(claim) == 0, # this should always be true if the above is true, but let's check anyway
-            ],
-            success=[
-                etcd.transactions.put(task_key, json.dumps(state)),
-                etcd.transactions.delete(interrupt) # these can't be any good
-            ],
-            failure=[]
-        )
-
-def enqueue(task_key):
+    state = json.loads(value)
+
+    # set to resuming instead of paused for quick repickup
+    print(f'resuming orphan {task_key}')
+    state['status'] = 'resuming'
+    etcd.transaction(
+        compare=[
+            etcd.transactions.mod(task_key) == mod_revision,
+            etcd.transactions.version(claim) == 0, # this should always be true if the above is true, but let's check anyway
+        ],
+        success=[
+            etcd.transactions.put(task_key, json.dumps(state)),
+            etcd.transactions.delete(interrupt) # these can't be any good
+        ],
+        failure=[]
+    )
+
+def release_waiting(task_key, value, mod_revision):
+    state = json.loads(value)
+    print(f'all shards of {task_key} are complete')
+    state['status'] = 'pending'
+    etcd.transaction(
+        compare=[
+            etcd.transactions.mod(task_key) == mod_revision,
+        ],
+        success=[
+            etcd.transactions.put(task_key, json.dumps(state))
+        ],
+        failure=[]
+    )
+
+def enqueue(task_key, mod_revision):
     claim = task_to_claim(task_key)
     queue = task_to_queue(task_key)
-    # requeue stuff
+    # requeue stuff, unless the task changed since we saw it runnable
     print(f'enqueue {queue}')
     etcd.transaction(
         compare=[
+            etcd.transactions.mod(task_key) == mod_revision,
             etcd.transactions.version(claim) == 0,
             etcd.transactions.version(queue) == 0,
         ],
@@ -86,45 +207,37 @@ def main():
     else:
         etcd = etcd3.client(host=host)
 
-    (tasks_watch, tasks_watch_cancel) = etcd.watch_prefix(TASKS)
-    (claims_watch, claims_watch_cancel) = etcd.watch_prefix(CLAIMS)
-    q = Queue()
-    tasks_watch_thread = threading.Thread(target=iterator_to_queue, args=(tasks_watch, q))
-    claims_watch_thread = threading.Thread(target=iterator_to_queue, args=(claims_watch, q))
-    tasks_watch_thread.start()
-    claims_watch_thread.start()
-    try:
-        result = etcd.get_prefix(TASKS, sort_order='ascend', sort_target='create')
-        for (v, kv) in result:
-            state = json.loads(v)
-            if state['status'] == 'running':
-                pause_if_orphan(kv.key.decode('utf-8'))
-            elif runnable_status(state['status']):
-                print(kv)
-                task_key = kv.key.decode('utf-8')
-                enqueue(task_key)
-
-        # Now that any stragglers are cleared up, it is time to start relying on the watch
-        while True:
-            event = q.get()
-            # is it a disappearing claim?
-            if isinstance(event, etcd3.events.DeleteEvent):
-                key = event.key.decode('utf-8')
-                if key.startswith(CLAIMS):
-                    task_key = claim_to_task(key)
-                    pause_if_orphan(task_key)
-
-            # is it a new task?
-            elif isinstance(event, etcd3.events.PutEvent):
-                key = event.key.decode('utf-8')
-                if key.startswith(TASKS):
-                    state = json.loads(event.value)
-                    if runnable_status(state['status']):
-                        enqueue(key)
-
-    finally:
-        # todo proper cleanup here
-        pass
+    state = MonitorState()
+    # Everything after loading relies on the watch. If it drops, we
+    # continue from the last revision we saw, so nothing in between
+    # is missed. Only if etcd compacted that revision away, we have to
+    # start over from a fresh snapshot, and clear up any stragglers
+    # again. While etcd can't be reached, loading and watching are
+    # retried, waiting longer every time.
+    reload = True
+    retry_seconds = RETRY_SECONDS
+    while True:
+        cancel = None
+        try:
+            if reload:
+                state.load()
+                print(f'loaded {len(state.tasks)} tasks at revision {state.revision}')
+                state.check_all()
+                reload = False
+            (events, cancel) = etcd.watch_prefix(SERVICES, start_revision=state.revision + 1)
+            for event in events:
+                state.handle(event)
+                retry_seconds = RETRY_SECONDS
+        except etcd3.exceptions.RevisionCompactedError:
+            print(f'revision {state.revision} was compacted, reloading', file=sys.stderr)
+            reload = True
+        except Exception as e:
+            print(f'etcd failed at revision {state.revision}, retrying in {retry_seconds}s: {e}', file=sys.stderr)
+            time.sleep(retry_seconds)
+            retry_seconds = min(retry_seconds * 2, MAX_RETRY_SECONDS)
+        finally:
+            if cancel is not None:
+                cancel()
 
 if __name__ == '__main__':
     main()
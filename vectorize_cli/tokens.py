@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import numpy
+
+from vectorize_cli.input_file import read_records, stat
+
+# Pretokenized input, so the vectorizer can feed the model without
+# tokenizing on the worker, and without tokenizing again on a retry,
+# resume or rerun. Tokens are what a backend's encode_tokens made of
+# every record of a json-lines input, so they only work for backends
+# with the same tokens_id.
+#
+# Token files are a directory of flat little endian arrays, which can
+# be memory mapped:
+# - meta.json: the input, the tokenizer and the counts
+# - tokens.bin: (tokens) int32 token ids of all records, one after the other
+# - offsets.bin: (records + 1) int64 where every record starts in tokens
+# - lengths.bin: (records) int32 the amount of tokens of every record
+#
+# meta.json is written last, so token files without it are incomplete.
+BATCH_SIZE = 1024
+
+def input_stat(path):
+    (size, mtime_ns) = stat(path)
+    return {'size': size, 'mtime_ns': mtime_ns}
+
+class TokenWriter:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        self.tokens_fp = open(os.path.join(directory, 'tokens.bin'), 'wb')
+        self.offsets_fp = open(os.path.join(directory, 'offsets.bin'), 'wb')
+        self.lengths_fp = open(os.path.join(directory, 'lengths.bin'), 'wb')
+        numpy.zeros(1, dtype='<i8').tofile(self.offsets_fp)
+        self.count = 0
+        self.tokens = 0
+
+    def write(self, rows):
+        lengths = numpy.fromiter((len(row) for row in rows), dtype='<i4', count=len(rows))
+        numpy.concatenate(rows).astype('<i4').tofile(self.tokens_fp)
+        (self.tokens + numpy.cumsum(lengths, dtype='<i8')).tofile(self.offsets_fp)
+        lengths.tofile(self.lengths_fp)
+        self.count += len(rows)
+        self.tokens += int(lengths.sum())
+
+    def finish(self, meta):
+        for fp in (self.tokens_fp, self.offsets_fp, self.lengths_fp):
+            fp.flush()
+            os.fsync(fp.fileno())
+            fp.close()
+        meta = dict(meta, count=self.count, tokens=self.tokens)
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as fp:
+            json.dump(meta, fp)
+        return meta
+
+class TokenFile:
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'meta.json')) as fp:
+            self.meta = json.load(fp)
+        count = self.meta['count']
+        load = lambda name, dtype, shape: numpy.memmap(os.path.join(directory, name), dtype=dtype, mode='r', shape=shape) if shape[0] != 0 else numpy.zeros(shape, dtype=dtype)
+        self.tokens = load('tokens.bin', '<i4', (self.meta['tokens'],))
+        self.offsets = load('offsets.bin', '<i8', (count + 1,))
+        self.lengths = load('lengths.bin', '<i4', (count,))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def row(self, line):
+        return self.tokens[self.offsets[line]:self.offsets[line+1]]
+
+    def matches(self, input_path, tokens_id, field=None):
+        # whether these tokens were made from this input, as it is now,
+        # and the same field, for a backend that takes the same tokens
+        return (self.meta.get('tokens_id') == tokens_id and self.meta.get('input') == input_stat(input_path)
+                and self.meta.get('field') == field)
+
+    def statistics(self):
+        lengths = numpy.asarray(self.lengths)
+        if len(lengths) == 0:
+            return {'count': 0, 'tokens': 0}
+        (p50, p90, p99) = numpy.percentile(lengths, [50, 90, 99])
+        return {'count': len(lengths), 'tokens': int(lengths.sum()), 'mean': float(lengths.mean()),
+                'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': int(lengths.max())}
+
+def pretokenize(backend, input_path, directory, field=None, batch_size=BATCH_SIZE, progress=None):
+    # progress is called with the amount of records done so far
+    tokens_id = backend.tokens_id()
+    if tokens_id is None:
+        raise ValueError(f'backend {backend.name} cannot take pretokenized input')
+    input = input_stat(input_path)
+    writer = TokenWriter(directory)
+    for strings in read_records(input_path, field=field, batch_size=batch_size):
+        writer.write(backend.encode_tokens(strings))
+        if progress is not None:
+            progress(writer.count)
+    print(f'pretokenized {writer.count} records into {writer.tokens} tokens', file=sys.stderr)
+    return writer.finish({'input': input, 'tokens_id': tokens_id, 'field': field})
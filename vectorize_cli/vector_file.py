@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import struct
+import numpy
+from collections import namedtuple
+
+# A vector file is a header followed by a row for every input record,
+# in input order. The header is
+# - magic, version
+# - dtype of the rows: f32, f16 or int8
+# - whether the vectors were L2-normalized before storing them
+# - dimension of the vectors
+# - size of the header, which is where the rows start
+# - count of rows, or -1 while the file is still being written
+# followed by a json object describing the model that made the
+# vectors, zero padded to the header size.
+#
+# int8 rows start with a float32 scale, followed by the values that
+# multiplied by that scale approximate the vector.
+#
+# The raw format has no header and stores float32 rows. It is what
+# all outputs used to be, and still is for tasks that don't say
+# otherwise.
+MAGIC = b'VVEC'
+VERSION = 1
+HEADER = struct.Struct('<4sHBBIIq')
+COUNT = struct.Struct('<q')
+COUNT_OFFSET = HEADER.size - COUNT.size
+ALIGNMENT = 64
+
+DTYPES = ['f32', 'f16', 'int8']
+FORMATS = ['raw'] + DTYPES
+
+VectorHeader = namedtuple('VectorHeader', ['format', 'dimension', 'size', 'count', 'metadata'])
+
+class VectorFormat:
+    def __init__(self, dtype='f32', normalized=False):
+        if dtype not in FORMATS:
+            raise ValueError(f'unknown vector format {dtype}')
+        self.dtype = dtype
+        self.normalized = normalized
+
+    @staticmethod
+    def from_init(init):
+        # tasks from before there was a format are raw
+        vector_format = init.get('format')
+        if vector_format is None:
+            return VectorFormat('raw')
+        return VectorFormat(vector_format['dtype'], vector_format.get('normalized', False))
+
+    def to_init(self):
+        return {'dtype': self.dtype, 'normalized': self.normalized}
+
+    def __eq__(self, other):
+        return isinstance(other, VectorFormat) and (self.dtype, self.normalized) == (other.dtype, other.normalized)
+
+    def __str__(self):
+        return f'{self.dtype}, normalized' if self.normalized else self.dtype
+
+    def has_header(self):
+        return self.dtype != 'raw'
+
+    def row_dtype(self, dimension):
+        match self.dtype:
+            case 'raw' | 'f32':
+                return numpy.dtype(('<f4', (dimension,)))
+            case 'f16':
+                return numpy.dtype(('<f2', (dimension,)))
+            case 'int8':
+                return numpy.dtype([('scale', '<f4'), ('values', 'i1', (dimension,))])
+
+    def row_bytes(self, dimension):
+        return self.row_dtype(dimension).itemsize
+
+    def header(self, dimension, metadata, count=-1):
+        if not self.has_header():
+            return b''
+        encoded = json.dumps(metadata).encode('utf-8')
+        size = -(-(HEADER.size + len(encoded)) // ALIGNMENT) * ALIGNMENT
+        header = HEADER.pack(MAGIC, VERSION, DTYPES.index(self.dtype), int(self.normalized), dimension, size, count) + encoded
+        return header.ljust(size, b'\0')
+
+    def encode(self, array):
+        # float32 vectors to rows
+        array = numpy.asarray(array, dtype='float32')
+        if self.normalized:
+            norms = numpy.linalg.norm(array, axis=1, keepdims=True)
+            array = array / numpy.where(norms == 0, 1, norms)
+        match self.dtype:
+            case 'raw' | 'f32':
+                return array.astype('<f4', copy=False)
+            case 'f16':
+                return array.astype('<f2')
+            case 'int8':
+                rows = numpy.empty(len(array), dtype=self.row_dtype(array.shape[1]))
+                scale = numpy.abs(array).max(axis=1) / 127
+                scale[scale == 0] = 1
+                rows['scale'] = scale
+                rows['values'] = numpy.rint(array / scale[:, None])
+                return rows
+
+    def decode(self, rows):
+        # rows to float32 vectors
+        if self.dtype == 'int8':
+            return rows['values'].astype('float32') * rows['scale'][:, None]
+        return numpy.asarray(rows, dtype='float32')
+
+    def write(self, fp, array):
+        # write() rather than tofile(), so fp can be an s3 upload too
+        fp.write(memoryview(numpy.ascontiguousarray(self.encode(array))))
+
+def read_header(fp):
+    # the header of an open vector file, or None if it doesn't have one
+    fp.seek(0)
+    data = fp.read(HEADER.size)
+    if len(data) < HEADER.size:
+        return None
+    (magic, version, dtype, normalized, dimension, size, count) = HEADER.unpack(data)
+    if magic != MAGIC:
+        return None
+    if version != VERSION:
+        raise ValueError(f'unsupported vector file version {version}')
+    metadata = json.loads(fp.read(size - HEADER.size).rstrip(b'\0'))
+    return VectorHeader(VectorFormat(DTYPES[dtype], bool(normalized)), dimension, size, count, metadata)
+
+def set_count(path, count):
+    # called once the file is complete
+    with open(path, 'r+b') as fp:
+        fp.seek(COUNT_OFFSET)
+        fp.write(COUNT.pack(count))
+        fp.flush()
+        os.fsync(fp.fileno())
+
+def existing_rows(path, vector_format, dimension):
+    # How many complete rows an output that is being resumed has. Only
+    # rows written in the format and dimension we are going to write
+    # in count, anything else has to be redone.
+    try:
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            header_size = 0
+            if vector_format.has_header():
+                header = read_header(fp)
+                if header is None:
+                    return 0
+                if header.format != vector_format or header.dimension != dimension:
+                    print(f'{path} has {header.dimension} dimensional {header.format} vectors, expected {dimension} dimensional {vector_format}', file=sys.stderr)
+                    return 0
+                header_size = header.size
+    except FileNotFoundError:
+        return 0
+    return (size - header_size) // vector_format.row_bytes(dimension)
+
+class VectorFile:
+    # Reads a vector file without copying it into memory. rows is a
+    # memmap of the rows as stored, indexing the file decodes the
+    # selected rows to float32 vectors.
+    #
+    # Raw files don't know their dimension, so it has to be given.
+    def __init__(self, path, dimension=None):
+        self.path = path
+        with open(path, 'rb') as fp:
+            header = read_header(fp)
+            size = os.fstat(fp.fileno()).st_size
+        if header is None:
+            if dimension is None:
+                raise ValueError(f'{path} has no header, so its dimension has to be given')
+            header = VectorHeader(VectorFormat('raw'), dimension, 0, -1, {})
+        self.format = header.format
+        self.dimension = header.dimension
+        self.metadata = header.metadata
+        row_dtype = self.format.row_dtype(self.dimension)
+        # an unfinished file has no count yet, and a file that got cut
+        # short has fewer rows than its count.
+        count = (size - header.size) // row_dtype.itemsize
+        if header.count >= 0:
+            count = min(count, header.count)
+        if count == 0:
+            self.rows = numpy.empty(0, dtype=row_dtype)
+        else:
+            self.rows = numpy.memmap(path, dtype=row_dtype, mode='r', offset=header.size, shape=(count,))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, numpy.integer)):
+            return self.format.decode(self.rows[key:key+1] if key != -1 else self.rows[-1:])[0]
+        return self.format.decode(self.rows[key])
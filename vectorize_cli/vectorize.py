@@ -1,40 +1,51 @@
 import argparse
 import sys
-import json
 
 from vectorize_cli.backends.bloom import BloomBackend
 from vectorize_cli.backends.mxbai import MxbaiBackend
+from vectorize_cli.backends.compiled import CompiledBackend
+from vectorize_cli.cache import EmbeddingCache
+from vectorize_cli.vector_file import VectorFormat, FORMATS, set_count
+from vectorize_cli.input_file import read_records
 
-def init_backend(name):
+def init_backend(name, artifact_dir=None, **options):
     match name:
         case "bloom":
-            return BloomBackend()
+            return BloomBackend(**options)
         case "mxbai":
-            return MxbaiBackend()
+            return MxbaiBackend(**options)
+        case "bloom-compiled":
+            return CompiledBackend(BloomBackend(**options), artifact_dir)
+        case "mxbai-compiled":
+            return CompiledBackend(MxbaiBackend(**options), artifact_dir)
         case _:
-            raise Exception(f'unknown backend {args.backend}')
+            raise Exception(f'unknown backend {name}')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('input_file', help='input file to vectorize')
     parser.add_argument('output_file', help='output file to write vectors in')
     parser.add_argument('--backend', help='backend to use')
+    parser.add_argument('--cache', help='path of an embedding cache')
+    parser.add_argument('--format', choices=FORMATS, default='f32', help='how to store the vectors')
+    parser.add_argument('--normalize', action='store_true', help='L2-normalize the vectors before storing them')
+    parser.add_argument('--field', help='take the text from this dotted path in json object records')
     args = parser.parse_args()
 
     input_file = args.input_file
     output_file = args.output_file
     backend = init_backend(args.backend)
+    if args.cache is not None:
+        backend.cache = EmbeddingCache(args.cache)
 
     print(f"Input file: {input_file}")
     print(f"Output file: {output_file}")
-    chunk = []
-    with open(output_file, 'w') as output_fp:
-        with open(input_file, 'r') as input_fp:
-            for line in input_fp:
-                json_str = json.loads(line)
-                chunk.append(json_str)
-                if len(chunk) == 100:
-                  backend.process_chunk(chunk, output_fp)
-                  chunk = []
-        if len(chunk) != 0:
-              backend.process_chunk(chunk, output_fp)
+    vector_format = VectorFormat(args.format, args.normalize)
+    count = 0
+    with open(output_file, 'wb') as output_fp:
+        output_fp.write(vector_format.header(backend.dimension, backend.describe()))
+        for chunk in read_records(input_file, field=args.field, batch_size=100):
+            backend.process_chunk(chunk, output_fp, vector_format)
+            count += len(chunk)
+    if vector_format.has_header():
+        set_count(output_file, count)
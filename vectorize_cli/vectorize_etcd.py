@@ -1,23 +1,49 @@
 from vectorize_cli.etcd_task import TaskQueue, TaskInterrupted
 from vectorize_cli import vectorize
+from vectorize_cli.batching import AdaptiveBatcher, WindowResult, padded_tokens
+from vectorize_cli.pipeline import Pipeline
+from vectorize_cli.cache import EmbeddingCache
+from vectorize_cli.input_index import InputIndex
+from vectorize_cli.input_file import compression, open_input, parse_records
+from vectorize_cli.vector_file import VectorFormat, read_header, set_count, existing_rows
+from vectorize_cli import ann
+from vectorize_cli.cpu_pool import CpuPool
+from vectorize_cli.backends.precision import PRECISIONS
+from vectorize_cli.metrics import metrics
+from vectorize_cli.tokens import TokenFile, pretokenize
+from vectorize_cli import s3
 import sys
-import json
 import socket
 import argparse
 import os
 import traceback
+import shutil
+import signal
+import threading
+import time
+import numpy
 from collections import deque
 from datetime import datetime
 
 identity = None
 directory = None
 chunk_size = 100
+sort_window = 8
+tokenizer_threads = 1
+pipeline_depth = 2
+batcher = None
+prefetcher = None
+prefetch_windows = 0
+s3_part_size = s3.PART_SIZE
 
 def retrieve_identity():
     from_env = os.getenv('VECTORIZER_IDENTITY')
     return from_env if from_env is not None else socket.getfqdn()
 
 def resolve_path(path):
+    # s3 objects are not in the directory
+    if s3.is_s3(path):
+        return path
     rootdir = os.path.abspath(directory)
     normalized = os.path.normpath(f'{rootdir}/{path}')
     if not normalized.startswith(rootdir):
@@ -25,9 +51,63 @@ def resolve_path(path):
 
     return normalized
 
-def start_(task, truncate=0, skip=0):
-    global backend
-    global chunk_size
+def option(value, env_var, default, convert=int):
+    if value is not None:
+        return value
+    from_env = os.getenv(env_var)
+    return convert(from_env) if from_env else default
+
+class Window:
+    # A window of input records on its way through the pipeline. The
+    # records are strings, or for pretokenized input, rows of token
+    # ids instead.
+    def __init__(self, strings, end_offset, rows=None):
+        self.strings = strings
+        self.rows = rows
+        # the input offset right after the last record
+        self.end_offset = end_offset
+        self.lengths = None
+        # (indices, prepared) to be sent to the model
+        self.batches = []
+        # (indices, output) that came out of the model
+        self.outputs = []
+        # (indices, vectors) from the embedding cache
+        self.cached = None
+        # (index, original index) of records repeated in the window
+        self.copies = []
+        # index to token ids of the strings that go to the model, for
+        # backends that tokenize them once for both length and input
+        self.encoded = None
+
+    def __len__(self):
+        return len(self.rows) if self.rows is not None else len(self.strings)
+
+    def prepare(self, indices):
+        # model input for some of the records
+        if self.rows is not None:
+            return backend.prepare_tokens([self.rows[i] for i in indices])
+        if self.encoded is not None:
+            return backend.prepare_tokens([self.encoded[i] for i in indices])
+        return backend.prepare_chunk([self.strings[i] for i in indices])
+
+def open_tokens(init, input_file):
+    # the pretokenized input of a task, if it has any this backend can
+    # use. Otherwise the input gets tokenized as usual.
+    if 'tokens' not in init:
+        return None
+    tokens_dir = resolve_path(init['tokens'])
+    try:
+        token_file = TokenFile(tokens_dir)
+    except FileNotFoundError:
+        print(f'warning: {tokens_dir} has no complete tokens, tokenizing instead', file=sys.stderr)
+        return None
+    if not token_file.matches(input_file, backend.tokens_id(), init.get('field')):
+        print(f'warning: the tokens in {tokens_dir} are not for this input, field and backend, tokenizing instead', file=sys.stderr)
+        return None
+    print(f'using tokens from {tokens_dir}', file=sys.stderr)
+    return token_file
+
+def start_(task, count=0, offset=None):
     init = task.init()
     input_file = resolve_path(init['input_file'])
     output_file = resolve_path(init['output_file'])
@@ -35,73 +115,478 @@ def start_(task, truncate=0, skip=0):
     print(f"Input file: {input_file}", file=sys.stderr)
     print(f"Output file: {output_file}", file=sys.stderr)
 
+    # shards of a larger task only cover part of the input
+    input_range = init.get('range')
+    if offset is None:
+        offset = input_range['start'] if input_range is not None else 0
+    end_offset = input_range['end'] if input_range is not None else None
+
     progress = task.progress()
     if progress is None:
         # this is the first run. lets determine how large this file is
-        with open(input_file, 'r') as input_fp:
-            total = sum(1 for line in input_fp)
-            task.set_progress({'count': 0, 'total': total})
+        total = len(InputIndex.load_or_build(input_file))
     else:
         total = progress['total']
-
-    chunk = []
-    count = skip
-
-    with open(output_file, 'a+') as output_fp:
-        # truncate to a safe known size
-        output_fp.truncate(truncate)
-        output_fp.seek(0, os.SEEK_END)
-
+    vectors = backend.describe()
+    vector_format = VectorFormat.from_init(init)
+    if s3.is_s3(output_file):
+        output_fp = open_upload(task, output_file, vector_format, vectors, count, total)
+    else:
+        output_fp = open_output(output_file, vector_format, vectors, count)
+    writer = OutputWriter(output_fp, vector_format, count, offset)
+    if task.checkpoint() is None or s3.is_s3(output_file):
+        # an s3 output checkpoints its upload from the start
+        task.set_progress({'count': count, 'total': total}, checkpoint=writer.checkpoint)
+
+    if count != 0 and task.vectors() not in (None, vectors):
+        print(f'warning: continuing vectors made by {task.vectors()} with {vectors}', file=sys.stderr)
+    task.set_vectors(vectors)
+    cache_hits = 0
+    cache_misses = 0
+    # what this task adds to the metrics of the process
+    metrics_start = metrics.snapshot()
+
+    token_file = open_tokens(init, input_file)
+    # compressed inputs are decompressed from the block before the
+    # offset, which the input index knows
+    blocks = None
+    if compression(input_file) is not None:
+        input_index = InputIndex.load_or_build(input_file)
+        blocks = input_index.blocks
+        if offset != 0 and not input_index.seekable():
+            print(f'{input_file} is a single gzip member or zstd frame, decompressing {offset} bytes to resume', file=sys.stderr)
+    with output_fp:
         duration_queue = deque(maxlen=10)
-        with open(input_file, 'r') as input_fp:
-            start_time = datetime.now()
-            for line in input_fp:
-                # skip already processed lines
-                if skip != 0:
-                    skip -= 1
-                    if skip == 0:
-                        # this was our last skip.
-                        start_time = datetime.now()
-                    continue
-
-                json_str = json.loads(line)
-                chunk.append(json_str)
-                if len(chunk) == chunk_size:
-                    task.alive()
-                    backend.process_chunk(chunk, output_fp)
+        with open_input(input_file, offset, blocks, end=end_offset) as input_fp:
+            if token_file is None:
+                source = read_windows(input_fp, offset, chunk_size * sort_window, end_offset, field=init.get('field'))
+            else:
+                # count is how far this task got from its first line
+                first_line = input_range['first_line'] if input_range is not None else 0
+                end_line = input_range['end_line'] if input_range is not None else len(token_file)
+                index = InputIndex.load_or_build(input_file)
+                source = token_windows(token_file, index, first_line + count, end_line, chunk_size * sort_window)
+            with Pipeline(source, prepare_window, writer, workers=tokenizer_threads, depth=pipeline_depth) as pipeline:
+                start_time = datetime.now()
+                last_model_seconds = sum(metrics.snapshot()[0].get(stage, 0) for stage in ('forward', 'copy'))
+                for window in pipeline:
+                    size = len(window)
+                    tokens = int(window.lengths.sum())
+                    for (indices, prepared) in window.batches:
+                        window.outputs.extend(infer_batch(task, window, indices, prepared))
+                    window.batches = None
+                    pipeline.write(window)
+
                     end_time = datetime.now()
                     duration = (end_time - start_time).total_seconds()
                     start_time = end_time
 
-                    rate = chunk_size / duration
-
-                    duration_queue.append(duration)
-                    avg_rate = (len(duration_queue) * chunk_size) / sum(duration_queue)
-
-                    count += len(chunk)
-                    task.set_progress({'count': count, 'total': total, 'rate': rate, 'avg_rate': avg_rate})
-                    chunk = []
-        if len(chunk) != 0:
-              backend.process_chunk(chunk, output_fp)
-              end_time = datetime.now()
-              duration = (end_time - start_time).total_seconds()
-              start_time = end_time
-
-              rate = len(chunk) / duration
-
-              duration_queue.append(duration)
-              avg_rate = ((len(duration_queue) - 1) * chunk_size + len(chunk)) / sum(duration_queue)
-              count += len(chunk)
-              task.set_progress({'count': count, 'total': total, 'rate': rate, 'avg_rate': avg_rate})
-
+                    rate = size / duration
+                    token_rate = tokens / duration
+
+                    duration_queue.append((duration, size, tokens))
+                    queue_duration = sum(d for (d,_,_) in duration_queue)
+                    avg_rate = sum(n for (_,n,_) in duration_queue) / queue_duration
+                    avg_token_rate = sum(t for (_,_,t) in duration_queue) / queue_duration
+
+                    # The forward passes of the window, rather than all of
+                    # its time. Asynchronous forward passes are waited for
+                    # in the copy, which the writer may not have gotten to
+                    # yet, but that evens out over the windows.
+                    model_seconds = sum(metrics.snapshot()[0].get(stage, 0) for stage in ('forward', 'copy'))
+                    batcher.observe(len(window.outputs), model_seconds - last_model_seconds)
+                    last_model_seconds = model_seconds
+
+                    count += size
+                    metrics.count('records', size)
+                    if prefetcher is not None and total - count <= prefetch_windows * chunk_size * sort_window:
+                        # we're almost done, so let's line up the next task
+                        prefetcher.start()
+                    progress = {'count': count, 'total': total, 'rate': rate, 'avg_rate': avg_rate, 'token_rate': token_rate, 'avg_token_rate': avg_token_rate, 'token_budget': batcher.token_budget}
+                    computed = sum(len(indices) for (indices, _) in window.outputs)
+                    if window.outputs:
+                        progress['batch_size'] = round(computed / len(window.outputs))
+                    if backend.cache is not None:
+                        # repeats within a window count as hits too
+                        cache_hits += size - computed
+                        cache_misses += computed
+                        progress['cache_hits'] = cache_hits
+                        progress['cache_misses'] = cache_misses
+                    progress['metrics'] = metrics.summary(metrics_start)
+                    # the checkpoint is what the writer has actually
+                    # written, which may lag behind count.
+                    task.set_progress(progress, checkpoint=writer.checkpoint)
+
+        if s3.is_s3(output_file):
+            if count != total:
+                raise ValueError(f'vectorized {count} records, but the header of {output_file} says {total}')
+            output_fp.complete()
+        else:
+            output_fp.flush()
+            os.fsync(output_fp.fileno())
+    if vector_format.has_header() and not s3.is_s3(output_file):
+        set_count(output_file, count)
+    task.finish(count)
+
+    if 'parent' in init:
+        # if we go away before this, the task monitor releases the
+        # parent once it sees all shards are complete
+        task.queue.release_parent(init['parent'])
+
+def open_output(output_file, vector_format, vectors, count):
+    output_fp = open(output_file, 'a+b')
+    if count == 0:
+        header = vector_format.header(backend.dimension, vectors)
+        output_fp.truncate(0)
+        output_fp.write(header)
+        output_fp.flush()
+        header_size = len(header)
+    else:
+        # resume made sure the header is what we would write
+        header = read_header(output_fp)
+        header_size = header.size if header is not None else 0
+    # we continue after whatever is left in the output, truncated
+    # to a safe known size
+    output_fp.truncate(header_size + count * vector_format.row_bytes(backend.dimension))
+    output_fp.seek(0, os.SEEK_END)
+    return output_fp
+
+def open_upload(task, output_file, vector_format, vectors, count, total):
+    # An s3 output can't be changed once it is there, so its header
+    # gets the count it will have right away. Until the upload is
+    # completed, there is no output at all.
+    checkpoint = task.checkpoint()
+    previous = checkpoint.get('upload') if checkpoint is not None else None
+    if count != 0:
+        # resume made sure the upload has everything up to count
+        return s3.MultipartOutput(output_file, part_size=s3_part_size, state=previous)
+    if previous is not None:
+        # starting over, so whatever was uploaded before is no use
+        try:
+            s3.abort_upload(output_file, previous['upload_id'])
+        except Exception as e:
+            print(f'could not abort the previous upload of {output_file}: {e}', file=sys.stderr)
+    output_fp = s3.MultipartOutput(output_file, part_size=s3_part_size)
+    output_fp.write(vector_format.header(backend.dimension, vectors, count=total))
+    return output_fp
+
+def infer_batch(task, window, indices, prepared):
+    task.alive()
+    # batches that ran out of memory where it only showed once their
+    # output was collected, like in cpu inference processes. Those are
+    # retried already, but later batches should be smaller too.
+    for failed_size in backend.late_out_of_memory():
+        batcher.out_of_memory(None, failed_size)
+    try:
+        with metrics.timed('forward'):
+            output = backend.infer_prepared(prepared)
+        metrics.count('tokens', int(window.lengths[indices].sum()))
+        metrics.count('padded_tokens', padded_tokens(window.lengths, indices))
+        if batcher.check_memory(backend.resident_memory):
+            # we got away with it this time, but the next batches
+            # should be smaller
+            print(f'over the resident memory limit after a batch of {len(indices)}, making batches smaller', file=sys.stderr)
+        return [(indices, output)]
+    except Exception as e:
+        if len(indices) == 1 or not backend.is_out_of_memory(e):
+            raise
+
+    # Retry in two halves. This happens outside of the except block
+    # so that whatever the failed attempt allocated can be freed.
+    backend.release_memory()
+    batcher.out_of_memory(padded_tokens(window.lengths, indices), len(indices))
+    print(f'out of memory on a batch of {len(indices)}, retrying in halves', file=sys.stderr)
+    half = len(indices) // 2
+    outputs = []
+    for part in (indices[:half], indices[half:]):
+        outputs.extend(infer_batch(task, window, part, window.prepare(part)))
+    return outputs
+
+# The stages below run on the pipeline threads. They should not touch
+# the task, as that is not thread safe.
+
+def read_windows(input_fp, offset, window_size, end_offset=None, field=None):
+    # the input is read from offset on, in windows of records. The
+    # lines of a window are parsed all at once, and with a field, the
+    # records are json objects the string is taken from.
+    lines = []
+    # timed per window rather than per record, to keep it cheap
+    start = time.perf_counter()
+    for line in input_fp:
+        if end_offset is not None and offset >= end_offset:
+            break
+        offset += len(line)
+        lines.append(line)
+        if len(lines) == window_size:
+            window = Window(parse_records(lines, field), offset)
+            metrics.observe('read', time.perf_counter() - start)
+            yield window
+            lines = []
+            start = time.perf_counter()
+
+    if len(lines) != 0:
+        window = Window(parse_records(lines, field), offset)
+        metrics.observe('read', time.perf_counter() - start)
+        yield window
+
+def token_windows(token_file, index, start_line, end_line, window_size):
+    # windows of pretokenized records. The input index gives the input
+    # offsets to checkpoint, as if the input had been read.
+    for first_line in range(start_line, end_line, window_size):
+        start = time.perf_counter()
+        last_line = min(first_line + window_size, end_line)
+        window = Window(None, index.offset(last_line), rows=[token_file.row(line) for line in range(first_line, last_line)])
+        window.lengths = numpy.array(token_file.lengths[first_line:last_line], dtype=int)
+        metrics.observe('read', time.perf_counter() - start)
+        yield window
+
+def prepare_window(window):
+    # Records are sent to the model grouped by length rather than in
+    # file order, as every batch gets padded to its longest
+    # member. The writer puts the vectors back in input order, so
+    # the output file (and the resume logic which relies on its size)
+    # is unaffected.
+    #
+    # Records that are in the embedding cache, or that are repeated
+    # within the window, are not sent to the model at all. They get
+    # a length of 0 so they don't count towards the token rate.
+    #
+    # Pretokenized records already have their lengths, and skip the
+    # cache, as there are no strings to look up.
+    if window.rows is not None:
+        todo = numpy.arange(len(window))
+        with metrics.timed('tokenize'):
+            window.batches = [(todo[batch], window.prepare(todo[batch])) for batch in batcher.batches(window.lengths)]
+        return window
+
+    strings = window.strings
+    todo = []
+    first_seen = {}
+    vectors = backend.cache.lookup(backend.cache_id(), strings) if backend.cache is not None else [None] * len(strings)
+    for (i, (string, vector)) in enumerate(zip(strings, vectors)):
+        if vector is not None:
+            continue
+        if string in first_seen:
+            window.copies.append((i, first_seen[string]))
+        else:
+            first_seen[string] = i
+            todo.append(i)
+    hits = [i for (i, vector) in enumerate(vectors) if vector is not None]
+    if hits:
+        window.cached = (numpy.array(hits), numpy.stack([vectors[i] for i in hits]))
+
+    todo = numpy.array(todo, dtype=int)
+    window.lengths = numpy.zeros(len(strings), dtype=int)
+    with metrics.timed('tokenize'):
+        if len(todo) != 0 and backend.tokens_id() is not None:
+            # the token ids give the lengths, and become the batches
+            # without tokenizing again
+            encoded = backend.encode_tokens([strings[i] for i in todo])
+            window.encoded = dict(zip(todo.tolist(), encoded))
+            window.lengths[todo] = [len(row) for row in encoded]
+        elif len(todo) != 0:
+            window.lengths[todo] = backend.token_lengths([strings[i] for i in todo])
+        window.batches = [(todo[batch], window.prepare(todo[batch]))
+                          for batch in batcher.batches(window.lengths[todo])]
+    return window
+
+class OutputWriter:
+    # The last stage of the pipeline. It keeps track of how far the
+    # output has gotten, so the inference loop can checkpoint that.
+    # For s3 outputs, that is only as far as the uploaded parts go.
+    def __init__(self, output_fp, vector_format, count, offset):
+        self.output_fp = output_fp
+        self.vector_format = vector_format
+        self.upload = isinstance(output_fp, s3.MultipartOutput)
+        self.count = count
+        self.checkpoint = self._checkpoint(offset)
+
+    def _checkpoint(self, offset):
+        checkpoint = {'count': self.count, 'offset': offset}
+        if self.upload:
+            checkpoint['upload'] = self.output_fp.state()
+        return checkpoint
+
+    def __call__(self, window):
+        strings = window.strings
+        result = WindowResult(len(window))
+        for (indices, output) in window.outputs:
+            with metrics.timed('copy'):
+                array = backend.output_to_array(output)
+            result.scatter(indices, array)
+            if backend.cache is not None and strings is not None:
+                backend.cache.store(backend.cache_id(), [strings[i] for i in indices], array)
+        if window.cached is not None:
+            result.scatter(*window.cached)
+        for (i, original) in window.copies:
+            result.array[i] = result.array[original]
+        with metrics.timed('write'):
+            result.tofile(self.output_fp, self.vector_format)
+            uploaded = self.upload and self.output_fp.upload_part()
+
+        self.count += len(window)
+        if uploaded or not self.upload:
+            # replaced rather than updated, as it is read from another thread
+            self.checkpoint = self._checkpoint(window.end_offset)
+
+def merge_(task):
+    # A sharded task is done once all its shards are, and then merged
+    # by concatenating their outputs. copy_file_range lets the kernel
+    # do that without copying through userspace, or without copying
+    # at all on filesystems that can share extents.
+    init = task.init()
+    output_file = resolve_path(init['output_file'])
+    segments = [resolve_path(segment) for segment in init['segments']]
+    print(f"Merging {len(segments)} shards into {output_file}", file=sys.stderr)
+    vector_format = VectorFormat.from_init(init)
+    if s3.is_s3(output_file):
+        merge_upload(task, output_file, segments, vector_format)
+        return
+
+    # The segments all have the same header, apart from the count. The
+    # output gets the first one's, followed by the rows of all of them.
+    row_bytes = backend.vector_bytes()
+    header_size = 0
+    with open(output_file, 'wb') as output_fp:
+        for (i, segment) in enumerate(segments):
+            with open(segment, 'rb') as segment_fp:
+                segment_header = read_header(segment_fp) if vector_format.has_header() else None
+                segment_start = segment_header.size if segment_header is not None else 0
+                if i == 0 and segment_header is not None:
+                    header = vector_format.header(segment_header.dimension, segment_header.metadata)
+                    output_fp.write(header)
+                    output_fp.flush()
+                    header_size = len(header)
+                    row_bytes = vector_format.row_bytes(segment_header.dimension)
+                copy_file(task, segment_fp, output_fp, start=segment_start)
+            task.set_progress({'count': i + 1, 'total': len(segments)})
         output_fp.flush()
         os.fsync(output_fp.fileno())
-        task.finish(count)
+        count = (os.fstat(output_fp.fileno()).st_size - header_size) // row_bytes
+
+    if header_size != 0:
+        set_count(output_file, count)
+    # Only once the task is complete are the segments of no use. If we
+    # go away before deleting them all, they are left behind, but
+    # never lost before the merge is done.
+    task.finish(count)
+    for segment in segments:
+        try:
+            os.remove(segment)
+        except FileNotFoundError:
+            pass
+
+def merge_upload(task, output_file, segments, vector_format):
+    # The segments of an s3 output are in s3 too, and get streamed
+    # into a new upload. They all have a header of the same size, so
+    # their sizes tell the count the output's header needs up front.
+    # (Copying the segments on the server with UploadPartCopy would
+    # save the transfer, but they would have to be split into parts
+    # of at least 5MB.)
+    sizes = [s3.stat(segment)[0] for segment in segments]
+    row_bytes = backend.vector_bytes()
+    header_size = 0
+    segment_header = None
+    if vector_format.has_header():
+        with s3.open_reader(segments[0], chunk_size=64 * 1024, read_ahead=1) as segment_fp:
+            segment_header = read_header(segment_fp)
+    if segment_header is not None:
+        header_size = segment_header.size
+        row_bytes = vector_format.row_bytes(segment_header.dimension)
+    count = sum((size - header_size) // row_bytes for size in sizes)
+
+    output_fp = s3.MultipartOutput(output_file, part_size=s3_part_size)
+    if segment_header is not None:
+        output_fp.write(vector_format.header(segment_header.dimension, segment_header.metadata, count=count))
+    for (i, segment) in enumerate(segments):
+        with s3.open_reader(segment, header_size) as segment_fp:
+            while data := segment_fp.read(s3.CHUNK_SIZE):
+                task.alive()
+                output_fp.write(data)
+                output_fp.upload_part()
+        task.set_progress({'count': i + 1, 'total': len(segments)})
+    output_fp.complete()
+
+    # as for files, after the task is complete. Deleting an object
+    # that is already gone succeeds.
+    task.finish(count)
+    for segment in segments:
+        s3.delete(segment)
+
+def copy_file(task, source_fp, destination_fp, start=0, step=256*1024*1024):
+    # appends the source from start onwards to the destination
+    size = os.fstat(source_fp.fileno()).st_size
+    offset = start
+    try:
+        while offset < size:
+            # copy in steps so we can tell etcd we're still alive
+            task.alive()
+            copied = os.copy_file_range(source_fp.fileno(), destination_fp.fileno(), min(step, size - offset), offset_src=offset)
+            if copied == 0:
+                break
+            offset += copied
+    except OSError:
+        # not supported between these files. copy the rest the
+        # old-fashioned way.
+        source_fp.seek(offset)
+        destination_fp.seek(0, os.SEEK_END)
+        shutil.copyfileobj(source_fp, destination_fp)
+        destination_fp.flush()
+
+def index_(task):
+    # Builds an approximate nearest neighbour index of a finished
+    # output. The vectors to index are the task's input, the index
+    # directory its output.
+    init = task.init()
+    parameters = init['index']
+    vectors_file = resolve_path(init['input_file'])
+    index_dir = resolve_path(init['output_file'])
+    if s3.is_s3(vectors_file) or s3.is_s3(index_dir):
+        raise ValueError('indexes can only be built of and into local files')
+    print(f"Indexing {vectors_file} into {index_dir}", file=sys.stderr)
+
+    def progress(stage, count, total):
+        task.set_progress({'stage': stage, 'count': count, 'total': total})
+    # raw vector files have no header, we assume they were made with
+    # the backend we have
+    meta = ann.build(vectors_file, index_dir, parameters['lists'], pq=parameters.get('pq'),
+                     metric=parameters.get('metric', 'cosine'), train_size=parameters.get('train_size'),
+                     dimension=backend.dimension, progress=progress)
+    task.finish(meta['count'])
+
+def pretokenize_(task):
+    # Tokenizes the input for the backend we have, into token files at
+    # the output, for vectorize tasks to use as their tokens.
+    init = task.init()
+    input_file = resolve_path(init['input_file'])
+    tokens_dir = resolve_path(init['output_file'])
+    if s3.is_s3(tokens_dir):
+        raise ValueError('token files have to be local, to be memory mapped')
+    print(f"Pretokenizing {input_file} into {tokens_dir}", file=sys.stderr)
+    total = len(InputIndex.load_or_build(input_file))
+    def progress(count):
+        task.set_progress({'count': count, 'total': total})
+    progress(0)
+    meta = pretokenize(backend, input_file, tokens_dir, field=init.get('field'), progress=progress)
+    task.finish(meta['count'])
+
+def task_type(init):
+    if 'segments' in init:
+        return 'merge'
+    return init.get('type', 'vectorize')
 
 def start(task):
     task.start()
     try:
-        start_(task)
+        match task_type(task.init()):
+            case 'merge':
+                merge_(task)
+            case 'index':
+                index_(task)
+            case 'pretokenize':
+                pretokenize_(task)
+            case _:
+                start_(task)
     except TaskInterrupted as e:
         pass
     except Exception as e:
@@ -109,16 +594,58 @@ def start(task):
         task.finish_error(stack_trace)
 
 def resume(task):
-    # We have to figure out where we left off
-    # This is determined by the current file size. rounding that down
-    # to the nearest multiple of the vector size gets us a reliable
-    # count. This might be lower than the number in progress!
+    # We have to figure out where we left off. If there's a
+    # checkpoint, it tells us how many vectors were written and where
+    # in the input to continue. It can only be trusted if the output
+    # actually has that many vectors though, which might not be the
+    # case if the machine went down before they reached the disk.
+    #
+    # Otherwise, this is determined by the current file size. rounding
+    # that down to the nearest multiple of the vector size gets us a
+    # reliable count, and the input index tells us where that line
+    # starts. This might be lower than the number in progress!
+    #
+    # An s3 output has what the checkpoint says if its upload is still
+    # there, and nothing otherwise.
     if task.status() == 'resuming':
         task.resume()
     init = task.init()
-    size = os.path.getsize(resolve_path(init['output_file']))
-    count = size // 4096
-    truncate_to = count * 4096
+    if task_type(init) in ('merge', 'index', 'pretokenize'):
+        # merging and tokenizing are cheap enough to just redo, and an
+        # index has to be built in one go
+        try:
+            match task_type(init):
+                case 'merge':
+                    merge_(task)
+                case 'index':
+                    index_(task)
+                case 'pretokenize':
+                    pretokenize_(task)
+        except TaskInterrupted as e:
+            pass
+        except Exception as e:
+            task.finish_error(str(e))
+        return
+
+    input_range = init.get('range')
+    first_line = input_range['first_line'] if input_range is not None else 0
+    output_file = resolve_path(init['output_file'])
+    checkpoint = task.checkpoint()
+    if not s3.is_s3(output_file):
+        available = existing_rows(output_file, VectorFormat.from_init(init), backend.dimension)
+    elif checkpoint is not None and 'upload' in checkpoint and s3.MultipartOutput.resume(output_file, checkpoint['upload']) is not None:
+        available = checkpoint['count']
+    else:
+        available = 0
+    index = None
+    if checkpoint is not None and checkpoint['count'] <= available:
+        count = checkpoint['count']
+        offset = checkpoint['offset']
+    else:
+        index = InputIndex.load_or_build(resolve_path(init['input_file']))
+        end_line = input_range['end_line'] if input_range is not None else len(index)
+        count = min(available, end_line - first_line)
+        offset = index.offset(first_line + count)
 
     print(f'resuming after having already vectorized {count}', file=sys.stderr)
     progress = task.progress()
@@ -126,32 +653,109 @@ def resume(task):
     if progress is not None:
         total = progress.get('total')
 
-    if total is None:
-        with open(resolve_path(init['input_file']), 'r') as input_fp:
-            total = sum(1 for line in input_fp)
+    if total is None and input_range is not None:
+        total = input_range['end_line'] - first_line
+    elif total is None:
+        if index is None:
+            index = InputIndex.load_or_build(resolve_path(init['input_file']))
+        total = len(index)
 
-    task.set_progress({'count': count, 'total': total})
+    resumed = {'count': count, 'offset': offset}
+    if checkpoint is not None and 'upload' in checkpoint and count == checkpoint['count']:
+        # an s3 output carries on with its upload
+        resumed['upload'] = checkpoint['upload']
+    task.set_progress({'count': count, 'total': total}, checkpoint=resumed)
 
     try:
-        start_(task, truncate=truncate_to, skip=count)
+        start_(task, count=count, offset=offset)
     except TaskInterrupted as e:
         pass
     except Exception as e:
         task.finish_error(str(e))
 
+class Prefetcher:
+    # Claims the next task while the current one is finishing, and
+    # indexes its input, so the model doesn't sit idle in between
+    # tasks. The claimed task keeps its own lease alive in the
+    # background until we get to it.
+    def __init__(self, queue):
+        self.queue = queue
+        self.thread = None
+        self.task = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._prefetch, name='prefetch', daemon=True)
+            self.thread.start()
+
+    def _prefetch(self):
+        try:
+            if self.queue.draining():
+                return
+            self.task = self.queue.next_task()
+            init = self.task.init()
+            if self.task.progress() is None and task_type(init) == 'vectorize':
+                InputIndex.load_or_build(resolve_path(init['input_file']))
+        except Exception as e:
+            # whatever went wrong will go wrong again when the task is
+            # started, and be reported then
+            print(f'prefetching failed: {e}', file=sys.stderr)
+
+    def next_task(self):
+        if self.thread is None:
+            return self.queue.next_task()
+
+        self.thread.join()
+        (task, self.task, self.thread) = (self.task, None, None)
+        if task is None:
+            return self.queue.next_task()
+        return task
+
+    def release(self):
+        # called on the way out. A task we claimed but never started
+        # goes back into the queue.
+        task = self.task
+        if task is not None:
+            self.task = None
+            task.unclaim()
+
 def main():
     global etcd
     global directory
     global identity
     global chunk_size
+    global sort_window
+    global tokenizer_threads
+    global pipeline_depth
+    global batcher
+    global prefetcher
+    global prefetch_windows
     global backend
+    global s3_part_size
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--etcd', help='hostname of etcd server')
     parser.add_argument('--identity', help='the identity this worker will use when claiming tasks')
     parser.add_argument('--directory', help='the directory where files are to be found')
     parser.add_argument('--chunk-size', type=int, help='the amount of vectors to process at once')
+    parser.add_argument('--sort-window', type=int, help='the amount of chunks to read ahead and sort by length before processing')
+    parser.add_argument('--tokenizer-threads', type=int, help='the amount of threads preparing model input ahead of inference')
+    parser.add_argument('--pipeline-depth', type=int, help='the amount of windows that can be queued between pipeline stages')
+    parser.add_argument('--token-budget', type=int, help='batch by a maximum amount of padded tokens per forward pass instead of by chunk size')
+    parser.add_argument('--target-latency', type=float, help='the forward pass latency in seconds the token budget adapts to')
+    parser.add_argument('--max-rss', type=int, help='shrink batches when the resident memory of this process, with its cpu inference processes, goes over this many megabytes')
+    parser.add_argument('--cache', type=str, help='path of an embedding cache shared between tasks')
+    parser.add_argument('--cache-size', type=int, help='the size in megabytes the embedding cache is allowed to grow to')
+    parser.add_argument('--prefetch', type=int, help='claim and prepare the next task when the current one has this many windows left')
+    parser.add_argument('--progress-interval', type=float, help='the minimum amount of seconds between progress updates in etcd')
     parser.add_argument('--backend', type=str, default=os.getenv('VECTORIZER_BACKEND', 'bloom'), help='the backend to use for vectorization')
+    parser.add_argument('--device', type=str, help='the device to run the model on, like cuda, cpu or auto')
+    parser.add_argument('--precision', choices=PRECISIONS, help='the numeric precision to run the model at')
+    parser.add_argument('--artifact-dir', type=str, help='where compiled backends keep their compiled models')
+    parser.add_argument('--processes', type=int, help='run the model on cpu in this many processes, each pinned to its own share of the cores')
+    parser.add_argument('--metrics-port', type=int, help='serve prometheus metrics on this port')
+    parser.add_argument('--metrics-host', type=str, help='the address to serve metrics on')
+    parser.add_argument('--s3-part-size', type=int, help='the size in megabytes of the parts s3 outputs are uploaded in, and so how often they are checkpointed')
     args = parser.parse_args()
     identity = args.identity if args.identity is not None else retrieve_identity()
 
@@ -160,38 +764,97 @@ def main():
         directory = os.getenv('VECTORIZER_DIRECTORY')
     print(f'using directory {directory}', file=sys.stderr)
 
-    chunk_size = args.chunk_size
-    if chunk_size is None:
-        chunk_size_str = os.getenv('VECTORIZER_CHUNK_SIZE')
-        chunk_size = int(chunk_size_str) if chunk_size_str else 100
+    chunk_size = option(args.chunk_size, 'VECTORIZER_CHUNK_SIZE', 100)
     print(f'using chunk size {chunk_size}', file=sys.stderr)
 
+    sort_window = option(args.sort_window, 'VECTORIZER_SORT_WINDOW', 8)
+    print(f'using sort window {sort_window}', file=sys.stderr)
+
+    tokenizer_threads = option(args.tokenizer_threads, 'VECTORIZER_TOKENIZER_THREADS', 1)
+    pipeline_depth = option(args.pipeline_depth, 'VECTORIZER_PIPELINE_DEPTH', 2)
+    print(f'using {tokenizer_threads} tokenizer threads with pipeline depth {pipeline_depth}', file=sys.stderr)
+
+    token_budget = option(args.token_budget, 'VECTORIZER_TOKEN_BUDGET', None)
+    target_latency = option(args.target_latency, 'VECTORIZER_TARGET_LATENCY', 1.0, convert=float)
+    max_rss = option(args.max_rss, 'VECTORIZER_MAX_RSS', None)
+    if max_rss is not None:
+        max_rss *= 1024 * 1024
+    batcher = AdaptiveBatcher(chunk_size, max_tokens=token_budget, target_latency=target_latency, max_rss=max_rss)
+    if token_budget is not None:
+        print(f'using a token budget of up to {token_budget} tokens', file=sys.stderr)
+
     etcd = args.etcd
     if etcd is None:
         etcd = os.getenv('ETCD_HOST')
 
+    progress_interval = option(args.progress_interval, 'VECTORIZER_PROGRESS_INTERVAL', 5.0, convert=float)
+    print(f'writing progress at most every {progress_interval} seconds', file=sys.stderr)
+
     if etcd is not None:
-        queue = TaskQueue('vectorizer', identity, host=etcd)
+        queue = TaskQueue('vectorizer', identity, progress_interval=progress_interval, host=etcd)
     else:
-        queue = TaskQueue('vectorizer', identity)
+        queue = TaskQueue('vectorizer', identity, progress_interval=progress_interval)
+
+    prefetch_windows = option(args.prefetch, 'VECTORIZER_PREFETCH', 0)
+    if prefetch_windows > 0:
+        print(f'prefetching the next task {prefetch_windows} windows before the end', file=sys.stderr)
+        prefetcher = Prefetcher(queue)
+
+    device = option(args.device, 'VECTORIZER_DEVICE', 'auto', convert=str)
+    precision = option(args.precision, 'VECTORIZER_PRECISION', 'fp32', convert=str)
+    artifact_dir = option(args.artifact_dir, 'VECTORIZER_ARTIFACT_DIR', None, convert=str)
+    processes = option(args.processes, 'VECTORIZER_PROCESSES', 1)
+    print(f'using {precision} precision', file=sys.stderr)
+    if processes > 1:
+        print(f'using {processes} cpu inference processes', file=sys.stderr)
+        backend = CpuPool(args.backend, processes, precision=precision, artifact_dir=artifact_dir)
+    else:
+        print(f'using device {device}', file=sys.stderr)
+        backend = vectorize.init_backend(args.backend, device=device, precision=precision, artifact_dir=artifact_dir)
+
+    cache_path = option(args.cache, 'VECTORIZER_CACHE', None, convert=str)
+    if cache_path is not None:
+        cache_size = option(args.cache_size, 'VECTORIZER_CACHE_SIZE', 10240)
+        print(f'using embedding cache {cache_path} of up to {cache_size}MB', file=sys.stderr)
+        backend.cache = EmbeddingCache(cache_path, max_bytes=cache_size*1024*1024)
+
+    s3_part_size = option(args.s3_part_size, 'VECTORIZER_S3_PART_SIZE', s3.PART_SIZE // (1024 * 1024)) * 1024 * 1024
+
+    metrics_port = option(args.metrics_port, 'VECTORIZER_METRICS_PORT', None)
+    if metrics_port is not None:
+        metrics.serve(metrics_port, host=option(args.metrics_host, 'VECTORIZER_METRICS_HOST', '127.0.0.1', convert=str))
 
-    backend = vectorize.init_backend(args.backend)
+    # make sure we get to clean up when asked to stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     print('start main loop', file=sys.stderr)
     try:
         while True:
-            task = queue.next_task()
+            if queue.stop_draining():
+                print('draining, not taking any more tasks', file=sys.stderr)
+                break
+            task = prefetcher.next_task() if prefetcher is not None else queue.next_task()
             print('wow a task: ' + task.status(), file=sys.stderr)
-            match task.status():
-                case 'pending':
-                    print('starting..', file=sys.stderr)
-                    start(task)
-                case 'resuming':
-                    resume(task)
-                case _:
-                    sys.stderr.write(f'cannot process task with status {task.status()}\n')
+            try:
+                match task.status():
+                    case 'pending':
+                        print('starting..', file=sys.stderr)
+                        start(task)
+                    case 'resuming':
+                        resume(task)
+                    case _:
+                        sys.stderr.write(f'cannot process task with status {task.status()}\n')
+            finally:
+                # however the task was left, its lease is of no use
+                # anymore, and its keepalive has to stop
+                task.release()
     except SystemExit:
         pass
+    finally:
+        if prefetcher is not None:
+            prefetcher.release()
+        if isinstance(backend, CpuPool):
+            backend.close()
 
 if __name__ == '__main__':
     main()